@@ -0,0 +1,592 @@
+"""
+Benchmarks for the nginx configuration library.
+
+Run with `python benchmarks.py --help` for the available options.
+`--suite` runs the fixed regression suite and compares it against the
+stored baseline, see benchmark_baseline.json.
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from nginx.nginx import loads, dump, dumps, iterparse, diff, Conf, Key, Location, RenderCache, Server
+from nginx.loader import load_tree, ParseCache
+from nginx.validator import validate
+from nginx_config_generator import fetch_inputs, build_conf, render_incremental
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+SIZES = {
+    '1KB': 1 << 10,
+    '10KB': 10 << 10,
+    '100KB': 100 << 10,
+    '1MB': 1 << 20,
+    '10MB': 10 << 20,
+    '100MB': 100 << 20,
+}
+
+
+def synthetic_conf(size):
+    """
+    Build a synthetic nginx configuration of roughly the requested size.
+    :param int size: Target size of the configuration in bytes
+    :return: nginx configuration as string
+    """
+    parts = []
+    total = 0
+    index = 0
+    while total < size:
+        block = (
+            'upstream app{0} {{\n'
+            '    server 127.0.0.1:{1};\n'
+            '    keepalive 16;\n'
+            '}}\n\n'
+            'server {{\n'
+            '    listen 0.0.0.0:80;\n'
+            '    server_name app{0}.example.com;\n\n'
+            '    location / {{\n'
+            '        proxy_pass http://app{0};\n'
+            '        allow 10.0.0.0/8;\n'
+            '        deny all;\n'
+            '    }}\n'
+            '}}\n\n'
+        ).format(index, 8000 + index % 1000)
+        parts.append(block)
+        total += len(block)
+        index += 1
+    return ''.join(parts)
+
+
+def timed(func, *args):
+    """
+    Run a callable once and measure its wall time.
+    :param func: Callable to run
+    :param args: Positional arguments for the callable
+    :return: Elapsed time in seconds
+    """
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_loads(max_size):
+    """
+    Measure `loads` throughput for inputs from 1KB up to `max_size`.
+    Linear scaling shows up as a constant MB/s column.
+    :param int max_size: Largest input size to benchmark, in bytes
+    :return: None
+    """
+    print('{0:>8} {1:>12} {2:>10}'.format('size', 'seconds', 'MB/s'))
+    for label, size in SIZES.items():
+        if size > max_size:
+            break
+        data = synthetic_conf(size)
+        elapsed = timed(loads, data)
+        print('{0:>8} {1:>12.4f} {2:>10.2f}'.format(
+            label, elapsed, len(data) / elapsed / (1 << 20)))
+
+
+def bench_dump(max_size):
+    """
+    Measure `dump` time and peak memory for inputs from 1KB up to `max_size`.
+    Output goes to os.devnull, so the peak column only reflects the serializer.
+    :param int max_size: Largest input size to benchmark, in bytes
+    :return: None
+    """
+    print('{0:>8} {1:>12} {2:>12}'.format('size', 'seconds', 'peak KB'))
+    for label, size in SIZES.items():
+        if size > max_size:
+            break
+        conf = loads(synthetic_conf(size))
+        with open(os.devnull, 'w') as f:
+            tracemalloc.start()
+            elapsed = timed(dump, conf, f)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print('{0:>8} {1:>12.4f} {2:>12.1f}'.format(label, elapsed, peak / 1024.0))
+
+
+def bench_iterparse(max_size):
+    """
+    Measure `iterparse` time and peak memory when scanning a file on disk
+    for `proxy_pass` directives, for inputs from 1KB up to `max_size`.
+    :param int max_size: Largest input size to benchmark, in bytes
+    :return: None
+    """
+    print('{0:>8} {1:>12} {2:>12}'.format('size', 'seconds', 'peak KB'))
+    for label, size in SIZES.items():
+        if size > max_size:
+            break
+        with tempfile.TemporaryFile('w+') as f:
+            f.write(synthetic_conf(size))
+            f.seek(0)
+            tracemalloc.start()
+            start = time.perf_counter()
+            for event, obj in iterparse(f):
+                if event == 'key' and obj.name == 'proxy_pass':
+                    pass
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print('{0:>8} {1:>12.4f} {2:>12.1f}'.format(label, elapsed, peak / 1024.0))
+
+
+def bench_memory(max_size, before=None):
+    """
+    Measure memory held by the object tree built by `loads`, per directive,
+    for inputs from 1KB up to `max_size`, next to the figures measured
+    before tree nodes used __slots__ and interned names.
+    :param int max_size: Largest input size to benchmark, in bytes
+    :param dict before: Bytes per directive before, per size label, see
+        memory_before_slots in benchmark_baseline.json
+    :return: None
+    """
+    before = before or {}
+    print('{0:>8} {1:>12} {2:>10} {3:>10} {4:>8}'.format(
+        'size', 'directives', 'before B', 'after B', 'change'))
+    for label, size in SIZES.items():
+        if size > max_size:
+            break
+        data = synthetic_conf(size)
+        directives = data.count(';') + data.count('{')
+        tracemalloc.start()
+        conf = loads(data)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del conf
+        after = held / float(directives)
+        if label in before:
+            print('{0:>8} {1:>12} {2:>10.1f} {3:>10.1f} {4:>+7.1f}%'.format(
+                label, directives, before[label], after,
+                (after / before[label] - 1) * 100))
+        else:
+            print('{0:>8} {1:>12} {2:>10} {3:>10.1f} {4:>8}'.format(
+                label, directives, '-', after, '-'))
+
+
+def build_wide(count):
+    """
+    Build a Conf with one server holding `count` locations, added one by one.
+    :param int count: Number of locations
+    :return: Conf object
+    """
+    server = Server(Key('listen', '80'))
+    conf = Conf(server)
+    for index in range(count):
+        server.add(Location('/app{0}'.format(index),
+                            Key('proxy_pass', 'http://app{0}'.format(index)),
+                            Key('deny', 'all')))
+    return conf
+
+
+def build_deep(depth):
+    """
+    Build a Conf with locations nested `depth` levels deep, wrapping the
+    innermost location first so every add() receives a complete subtree.
+    :param int depth: Nesting depth
+    :return: Conf object
+    """
+    inner = Location('/level{0}'.format(depth), Key('return', '404'))
+    for level in range(depth - 1, 0, -1):
+        inner = Location('/level{0}'.format(level), Key('deny', 'all'), inner)
+    return Conf(Server(Key('listen', '80'), inner))
+
+
+def bench_build():
+    """
+    Measure building, serializing and re-parsing wide and deeply nested trees.
+    Linear scaling shows up as build times growing with the node count.
+    :return: None
+    """
+    print('{0:>14} {1:>10} {2:>10} {3:>10}'.format('tree', 'build', 'dumps', 'loads'))
+    cases = [('wide', build_wide, n) for n in (1000, 10000, 100000)]
+    cases += [('deep', build_deep, n) for n in (10, 25, 50)]
+    for label, builder, size in cases:
+        build_time = timed(builder, size)
+        conf = builder(size)
+        dumps_time = timed(dumps, conf)
+        loads_time = timed(loads, dumps(conf))
+        print('{0:>14} {1:>10.4f} {2:>10.4f} {3:>10.4f}'.format(
+            '{0} {1}'.format(label, size), build_time, dumps_time, loads_time))
+
+
+def synthetic_input(apps, cidrs=10):
+    """
+    Build a parsed generator input with `apps` apps sharing an ipfilter of
+    `cidrs` networks.
+    :param int apps: Number of apps
+    :param int cidrs: Number of CIDR entries in the ipfilter
+    :return: Parsed yaml data as dict
+    """
+    return {
+        'ipfilter': {
+            # /28 networks 32 addresses apart, neither adjacent nor
+            # overlapping, so aggregation keeps every entry
+            'myfilter': ['10.{0}.{1}.{2}/28'.format(i >> 11, (i >> 3) & 255, (i & 7) << 5)
+                         for i in range(cidrs)],
+            'allowall': ['0.0.0.0/0', '::/0'],
+        },
+        'catchall': {'default': {'port': 7000}},
+        'app': dict(('app{0}'.format(index), {
+            'catchall': 'default',
+            'fqdn': ['app{0}.example.com'.format(index)],
+            'runtime_port': 8000 + index % 1000,
+            'path_based_access_restriction': {
+                '/': {'ipfilter': 'myfilter'},
+                '/public': {'ipfilter': 'allowall'},
+            },
+        }) for index in range(apps)),
+    }
+
+
+def suite_cases(quick=False):
+    """
+    List the regression suite cases. Each case is a name and a setup
+    callable returning the function to time, so setup stays out of the
+    measurement.
+    :param bool quick: Skip the 100k apps scale
+    :return: list of (name, setup) tuples
+    """
+    app_scales = (10, 1000) if quick else (10, 1000, 100000)
+    cases = []
+    for apps in app_scales:
+        def conf_setup(apps=apps):
+            return build_conf(synthetic_input(apps))
+
+        def loads_setup(apps=apps):
+            text = dumps(conf_setup(apps))
+            return lambda: loads(text)
+
+        def dumps_setup(apps=apps):
+            conf = conf_setup(apps)
+            return lambda: dumps(conf)
+
+        def dump_setup(apps=apps):
+            conf = conf_setup(apps)
+
+            def run():
+                with tempfile.TemporaryFile('w') as f:
+                    dump(conf, f)
+            return run
+
+        def dumps_cached_setup(apps=apps):
+            conf = conf_setup(apps)
+            # Room for the nested blocks and the blocks holding them
+            cache = RenderCache(max_size=4 * len(dumps(conf)))
+            cache.dumps(conf)
+            key = conf.children[len(conf.children) // 2].children[0]
+
+            def run():
+                # One changed directive between two dumps
+                key.value = key.value + '0'
+                cache.dumps(conf)
+            return run
+
+        def filter_setup(apps=apps):
+            conf = conf_setup(apps)
+            name = 'app{0}'.format(apps // 2)
+            conf.filter('Server')
+            return lambda: (conf.filter('Server'), conf.filter('Upstream', name))
+
+        def filter_cold_setup(apps=apps):
+            conf = conf_setup(apps)
+
+            def run():
+                conf.invalidate()
+                conf.filter('Server')
+            return run
+
+        def diff_setup(apps=apps):
+            old = conf_setup(apps)
+            new = conf_setup(apps)
+            # One changed directive in the middle of the tree
+            new.children[len(new.children) // 2].children[0].value = '127.0.0.1:1'
+            return lambda: diff(old, new)
+
+        def validate_setup(apps=apps):
+            conf = conf_setup(apps)
+            return lambda: validate(conf)
+
+        def render_setup(apps=apps):
+            data = synthetic_input(apps)
+            return lambda: dumps(build_conf(data))
+
+        cases += [
+            ('loads apps={0}'.format(apps), loads_setup),
+            ('dumps apps={0}'.format(apps), dumps_setup),
+            ('dump apps={0}'.format(apps), dump_setup),
+            ('dumps cached apps={0}'.format(apps), dumps_cached_setup),
+            ('filter apps={0}'.format(apps), filter_setup),
+            ('filter cold apps={0}'.format(apps), filter_cold_setup),
+            ('diff apps={0}'.format(apps), diff_setup),
+            ('validate apps={0}'.format(apps), validate_setup),
+            ('render apps={0}'.format(apps), render_setup),
+        ]
+    for cidrs in (10, 1000, 10000):
+        def cidr_setup(cidrs=cidrs):
+            data = synthetic_input(10, cidrs)
+            return lambda: dumps(build_conf(data))
+        cases.append(('render cidrs={0}'.format(cidrs), cidr_setup))
+
+    def incremental_setup(apps=2000):
+        data = synthetic_input(apps)
+        # Removed with the directory object once the case is done
+        tmp = tempfile.TemporaryDirectory()
+        manifest = os.path.join(tmp.name, 'nginx.conf.manifest')
+        render_incremental(data, manifest)
+
+        def run():
+            # One app out of all changes between two runs
+            data['app']['app1']['runtime_port'] += 1
+            return tmp, render_incremental(data, manifest)
+        return run
+
+    cases += [
+        ('render apps=2000', lambda: render_setup(2000)),
+        ('incremental apps=2000', incremental_setup),
+    ]
+    for depth in (10, 50):
+        def deep_loads_setup(depth=depth):
+            text = dumps(build_deep(depth))
+            return lambda: loads(text)
+
+        def deep_dumps_setup(depth=depth):
+            conf = build_deep(depth)
+            return lambda: dumps(conf)
+
+        cases += [
+            ('loads depth={0}'.format(depth), deep_loads_setup),
+            ('dumps depth={0}'.format(depth), deep_dumps_setup),
+        ]
+    return cases
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """
+    Time a callable: calibrate the number of loops so that one run takes at
+    least `min_time`, then take `repeat` runs.
+    :param func: Callable to time
+    :param int repeat: Number of runs
+    :param float min_time: Minimum duration of one run in seconds
+    :return: dict with the per call min and median in seconds and the loops
+    """
+    number = 1
+    while True:
+        elapsed = timed(lambda: [func() for _ in range(number)])
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    runs = [elapsed / number]
+    for _ in range(repeat - 1):
+        runs.append(timed(lambda: [func() for _ in range(number)]) / number)
+    return {'min': min(runs), 'median': statistics.median(runs), 'loops': number}
+
+
+def run_suite(quick=False, repeat=5, select=None):
+    """
+    Run the regression suite.
+    :param bool quick: Skip the 100k apps scale
+    :param int repeat: Number of timed runs per case
+    :param str select: Only run cases whose name contains this text
+    :return: dict with environment details and per case timings
+    """
+    results = {}
+    print('{0:<24} {1:>12} {2:>12} {3:>8}'.format('case', 'min ms', 'median ms', 'loops'))
+    for name, setup in suite_cases(quick):
+        if select and select not in name:
+            continue
+        func = setup()
+        results[name] = measure(func, repeat)
+        print('{0:<24} {1:>12.3f} {2:>12.3f} {3:>8}'.format(
+            name, results[name]['min'] * 1000, results[name]['median'] * 1000, results[name]['loops']))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compare suite results against a baseline by their min timings.
+    :param dict baseline: Suite output stored earlier
+    :param dict current: Suite output of this run
+    :param float threshold: Relative slowdown reported as a regression
+    :return: list of regressed case names
+    """
+    regressions = []
+    print('{0:<24} {1:>12} {2:>12} {3:>8}'.format('case', 'baseline ms', 'current ms', 'change'))
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        change = result['min'] / base['min'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{0:<24} {1:>12.3f} {2:>12.3f} {3:>+7.1f}%{4}'.format(
+            name, base['min'] * 1000, result['min'] * 1000, change * 100, flag))
+    return regressions
+
+
+class SlowInputHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves a small yaml document for any path after a fixed delay, standing in for a remote input store.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.02
+    body = b'apps: []\n'
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_fetch(count=500):
+    """
+    Measure fetching `count` inputs from a local HTTP server with 20ms of
+    latency per request, sequentially and concurrently, cold and revalidated.
+    :param int count: Number of inputs to fetch
+    :return: None
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowInputHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    uris = ['http://127.0.0.1:{0}/app{1}.yaml'.format(server.server_address[1], index) for index in range(count)]
+    print('{0:>14} {1:>10} {2:>12}'.format('fetch', 'cold', 'revalidate'))
+    try:
+        for label, concurrency in (('sequential', 1), ('concurrent 32', 32)):
+            fetch_dir = tempfile.mkdtemp()
+            try:
+                cold = timed(fetch_inputs, uris, fetch_dir, concurrency)
+                warm = timed(fetch_inputs, uris, fetch_dir, concurrency)
+            finally:
+                shutil.rmtree(fetch_dir)
+            print('{0:>14} {1:>10.4f} {2:>12.4f}'.format(label, cold, warm))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_load_tree(count=500):
+    """
+    Measure loading a tree of `count` included files, cold in this process
+    and in a process pool, and reloaded through a ParseCache after one file
+    changed.
+    :param int count: Number of included files
+    :return: None
+    """
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'conf.d'))
+        text = dumps(build_conf(synthetic_input(4)))
+        for index in range(count):
+            with open(os.path.join(root, 'conf.d', 'app{0}.conf'.format(index)), 'w') as f:
+                f.write(text)
+        path = os.path.join(root, 'nginx.conf')
+        with open(path, 'w') as f:
+            f.write('http {\n    include conf.d/*.conf;\n}\n')
+
+        serial = timed(load_tree, path, 1)
+        pooled = timed(load_tree, path)
+        cache = ParseCache()
+        load_tree(path, cache=cache)
+        with open(os.path.join(root, 'conf.d', 'app0.conf'), 'a') as f:
+            f.write('# changed\n')
+        reload_time = timed(load_tree, path, 1, cache)
+        print('{0:>14} {1:>10} {2:>10} {3:>12}'.format('load_tree', 'serial', 'pool', 'one changed'))
+        print('{0:>14} {1:>10.4f} {2:>10.4f} {3:>12.4f}'.format('{0} files'.format(count), serial, pooled,
+                                                                 reload_time))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the nginx configuration library')
+    parser.add_argument("--max-size", required=False, default='10MB', choices=list(SIZES),
+                        help="Largest synthetic input to benchmark", type=str)
+
+    parser.add_argument("--suite", required=False, action="store_true",
+                        help="Run the regression suite instead of the exploratory benchmarks")
+    parser.add_argument("--quick", required=False, action="store_true",
+                        help="Skip the 100k apps scale of the suite")
+    parser.add_argument("--repeat", required=False, default=5, type=int,
+                        help="Timed runs per suite case")
+    parser.add_argument("--select", required=False, default=None, type=str,
+                        help="Only run the suite cases whose name contains this text")
+    parser.add_argument("--baseline", required=False, default=BASELINE_PATH, type=str,
+                        help="Suite results to compare against")
+    parser.add_argument("--save-baseline", required=False, action="store_true",
+                        help="Store the suite results as the new baseline")
+    parser.add_argument("--json", required=False, default=None, type=str,
+                        help="Also write the suite results to this location")
+    parser.add_argument("--threshold", required=False, default=0.1, type=float,
+                        help="Relative slowdown against the baseline reported as a regression")
+
+    args = parser.parse_args()
+
+    if args.suite:
+        # The generator logs every section it builds, keep that out of the table
+        logging.getLogger('nginx_config_generator').setLevel(logging.ERROR)
+        current = run_suite(args.quick, args.repeat, args.select)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(current, f, indent=2, sort_keys=True)
+        if args.save_baseline:
+            if os.path.exists(args.baseline):
+                # Keep the stored results of the cases that were not run and
+                # the memory figures measured before __slots__
+                with open(args.baseline) as f:
+                    stored = json.load(f)
+                stored['results'].update(current['results'])
+                current['results'] = stored['results']
+                if 'memory_before_slots' in stored:
+                    current['memory_before_slots'] = stored['memory_before_slots']
+            with open(args.baseline, 'w') as f:
+                json.dump(current, f, indent=2, sort_keys=True)
+            print('Saved baseline to {0}'.format(args.baseline))
+        elif os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            print('')
+            if compare(baseline, current, args.threshold):
+                sys.exit(1)
+        sys.exit(0)
+
+    bench_loads(SIZES[args.max_size])
+    bench_dump(SIZES[args.max_size])
+    bench_iterparse(SIZES[args.max_size])
+    before = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            before = json.load(f).get('memory_before_slots')
+    bench_memory(SIZES[args.max_size], before)
+    bench_build()
+    bench_fetch()
+    bench_load_tree()
@@ -0,0 +1,123 @@
+import os
+import pickle
+import shutil
+import tempfile
+
+
+class ConfigCache(object):
+    """
+    On-disk cache of generated configurations keyed by the content hash of
+    their input, and optionally of parsed input files keyed by the hash of
+    the raw file. The least recently used entries are evicted once the
+    cache directory grows past its size limit.
+    """
+
+    entry_suffixes = ('.conf', '.pickle')
+
+    def __init__(self, cache_dir, max_bytes=256 << 20):
+        """
+        Initialize object.
+        :param str cache_dir: Directory holding the cached entries
+        :param int max_bytes: Size limit of the cache directory, in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, key):
+        """
+        Build the location of a cached configuration.
+        :param str key: Content hash of the input
+        :returns: Location of the cached configuration
+        """
+        return os.path.join(self.cache_dir, key + '.conf')
+
+    def get(self, key):
+        """
+        Look up a cached configuration and mark it as recently used.
+        :param str key: Content hash of the input
+        :returns: Location of the cached configuration, None on a miss
+        """
+        path = self.path_for(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key, source_path):
+        """
+        Store a generated configuration, then evict entries over the limit.
+        :param str key: Content hash of the input
+        :param str source_path: Location of the configuration to cache
+        :returns: Location of the cached configuration
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, self.path_for(key))
+        self.evict()
+        return self.path_for(key)
+
+    def get_parsed(self, key):
+        """
+        Look up a parsed input and mark it as recently used.
+        :param str key: Hash of the raw input file
+        :returns: Parsed input data, None on a miss
+        """
+        path = os.path.join(self.cache_dir, key + '.pickle')
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            os.utime(path, None)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return data
+
+    def put_parsed(self, key, data):
+        """
+        Store a parsed input, then evict entries over the limit.
+        :param str key: Hash of the raw input file
+        :param data: Parsed input data
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(self.cache_dir, key + '.pickle'))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its
+        size limit.
+        :returns: Number of entries removed
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.entry_suffixes):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        removed = 0
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import http.client
+import json
+import os
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HttpConnectionPool(object):
+    """
+    Thread safe pool of keep-alive HTTP(S) connections, reused across
+    requests to the same host.
+    """
+
+    def __init__(self, timeout=30):
+        """
+        Initialize object.
+        :param int timeout: Socket timeout of the connections, in seconds
+        """
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def get(self, url, headers=None):
+        """
+        Send a GET request over a pooled connection.
+        :param str url: http(s) URL to fetch
+        :param dict headers: Request headers
+        :returns: tuple of (status code, response headers, body)
+        """
+        parts = urllib.parse.urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        key = (parts.scheme, parts.netloc)
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = self._connect(*key)
+        try:
+            conn.request('GET', target, headers=headers or {})
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+            # The server may have dropped an idle keep-alive connection,
+            # retry once on a fresh one
+            conn = self._connect(*key)
+            conn.request('GET', target, headers=headers or {})
+            response = conn.getresponse()
+            body = response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        return response.status, response.headers, body
+
+    def close(self):
+        """Close the idle connections of the pool."""
+        with self._lock:
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+            self._idle = {}
+
+
+def is_remote_uri(uri):
+    """
+    Check if an input location is an http(s) URI.
+    :param str uri: Input location
+    :returns: True for http:// and https:// URIs
+    """
+    return urllib.parse.urlsplit(uri).scheme in ('http', 'https')
+
+
+def fetch_input(pool, uri, fetch_dir):
+    """
+    Resolve an input location to a local file, downloading http(s) URIs
+    into fetch_dir. Downloads are conditional on the ETag / Last-Modified
+    of the previously fetched copy, so an unchanged input costs a 304
+    response only.
+    :param HttpConnectionPool pool: Pool used for http(s) URIs
+    :param str uri: Plain path, file:// URI or http(s):// URI of the input
+    :param str fetch_dir: Directory keeping the fetched copies and their
+        validators
+    :returns: tuple of (local file location, how it was resolved: 'local',
+        'fetched' or 'not modified')
+    :raises IOError: When the server answers with an error status
+    """
+    parts = urllib.parse.urlsplit(uri)
+    if parts.scheme == 'file':
+        return urllib.request.url2pathname(parts.path), 'local'
+    if parts.scheme not in ('http', 'https'):
+        return uri, 'local'
+
+    name = hashlib.sha256(uri.encode('utf-8')).hexdigest()
+    body_path = os.path.join(fetch_dir, name + '.yaml')
+    meta_path = os.path.join(fetch_dir, name + '.json')
+    meta = {}
+    if os.path.exists(body_path):
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            meta = {}
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    status, response_headers, body = pool.get(uri, headers)
+    if status == 304 and meta:
+        return body_path, 'not modified'
+    if status != 200:
+        raise IOError('HTTP {0} while fetching {1}'.format(status, uri))
+
+    if not os.path.isdir(fetch_dir):
+        os.makedirs(fetch_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=fetch_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, body_path)
+    # Without Last-Modified the Date of the response stands in, never the
+    # local clock: a local clock ahead of the server's could get a changed
+    # input answered with 304. Without either, only the ETag is sent.
+    meta = {'uri': uri, 'etag': response_headers.get('ETag'),
+            'last_modified': (response_headers.get('Last-Modified') or
+                              response_headers.get('Date'))}
+    fd, tmp_path = tempfile.mkstemp(dir=fetch_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+    return body_path, 'fetched'
+
+
+async def _fetch_all_async(uris, fetch_dir, concurrency):
+    pool = HttpConnectionPool()
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    # http.client is blocking, so requests run on a thread per concurrent
+    # fetch while asyncio bounds and gathers them
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def fetch(uri):
+            async with semaphore:
+                return await loop.run_in_executor(
+                    executor, fetch_input, pool, uri, fetch_dir)
+
+        try:
+            return await asyncio.gather(*(fetch(uri) for uri in uris),
+                                        return_exceptions=True)
+        finally:
+            pool.close()
+
+
+def fetch_all(uris, fetch_dir, concurrency=32):
+    """
+    Resolve input locations to local files, see `fetch_input`, fetching
+    http(s) URIs concurrently over pooled keep-alive connections.
+    :param uris: Plain paths, file:// URIs or http(s):// URIs of the inputs
+    :param str fetch_dir: Directory keeping the fetched copies and their
+        validators
+    :param int concurrency: Maximum number of requests in flight
+    :returns: list of `fetch_input` results in input order, the exception
+        in place of the result of an input that failed
+    """
+    return asyncio.run(_fetch_all_async(uris, fetch_dir, concurrency))
@@ -0,0 +1,260 @@
+import collections
+import glob
+import os
+import pickle
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from .nginx import Conf, Container, loads
+
+
+class IncludeCycleError(ValueError):
+    """Raised by `load_tree` when files include each other in a cycle."""
+
+    def __init__(self, chain):
+        super(IncludeCycleError, self).__init__(
+            'include cycle: {0}'.format(' -> '.join(chain)))
+        self.chain = chain
+
+
+class Tree(Conf):
+    """
+    A Conf loaded by `load_tree`, with the include directives replaced by
+    the content of the files they name. Remembers which file every
+    directive comes from, see `source_of`, and every file loaded, in load
+    order, in `files`.
+    """
+
+    __slots__ = ('path', 'files', '_sources')
+
+    def __init__(self, path, *args):
+        """
+        Initialize object.
+        :param str path: Location of the root file
+        :param *args: Any objects to include in this Tree.
+        """
+        super(Tree, self).__init__(*args)
+        self.path = path
+        self.files = [path]
+        # id of the first level nodes of every included file to the node
+        # and the file; holding the node keeps its id from being reused
+        self._sources = {}
+
+    def source_of(self, obj):
+        """
+        Return the file an object of this tree was read from.
+        :param obj obj: Key or Container object within this tree
+        :returns: Location of the file, None when obj is not in this tree
+        """
+        node = obj
+        while node is not None and node is not self:
+            entry = self._sources.get(id(node))
+            if entry is not None and entry[0] is node:
+                return entry[1]
+            node = getattr(node, '_parent', None)
+        return self.path if node is self else None
+
+
+class ParseCache(object):
+    """
+    In memory cache of parsed files keyed by path, modification time and
+    size, so that reloading a tree only parses the files that changed.
+    Entries are kept serialized, every load gets its own fresh objects.
+    The least recently used entries are evicted beyond `max_size` bytes.
+    """
+
+    def __init__(self, max_size=256 << 20):
+        """
+        Initialize object.
+        :param int max_size: Limit of the cached data, in bytes
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, mtime, size):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[:2] == (mtime, size):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, path, mtime, size, data):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[2])
+            if len(data) > self.max_size:
+                return
+            self._entries[path] = (mtime, size, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                self.size -= len(self._entries.popitem(last=False)[1][2])
+
+    def clear(self):
+        """Drop every cached entry."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def parse_file(path):
+    """
+    Parse one file, for `load_tree` worker processes.
+    :param str path: Location of the file
+    :returns: tuple of (modification time, size, serialized Conf); the file
+        is stat'ed before it is read, so a change while reading shows as a
+        stale entry on the next load rather than being missed
+    :raises ValueError: When the file is malformed, naming the file
+    """
+    st = os.stat(path)
+    with open(path, 'r') as f:
+        data = f.read()
+    try:
+        conf = loads(data)
+    except ValueError as ex:
+        raise ValueError('{0}: {1}'.format(path, ex))
+    return (st.st_mtime_ns, st.st_size,
+            pickle.dumps(conf, pickle.HIGHEST_PROTOCOL))
+
+
+def resolve_include(pattern, base):
+    """
+    List the files an include directive names, the way nginx does.
+    :param str pattern: Value of the include directive, a path or a glob
+    :param str base: Directory relative paths are resolved against
+    :returns: list of absolute locations; glob matches are sorted, a glob
+        matching nothing is no error
+    :raises IOError: When a plain path does not exist
+    """
+    if pattern[:1] in '"\'' and pattern[-1:] == pattern[:1]:
+        pattern = pattern[1:-1]
+    pattern = os.path.join(base, pattern)
+    if glob.has_magic(pattern):
+        return sorted(os.path.abspath(p) for p in glob.glob(pattern)
+                      if os.path.isfile(p))
+    if not os.path.isfile(pattern):
+        raise IOError('included file {0} not found'.format(pattern))
+    return [os.path.abspath(pattern)]
+
+
+def iter_includes(nodes):
+    """
+    Walk objects and their descendants for include directives.
+    :param nodes: Key and Container objects
+    :returns: generator of include Key objects, in document order
+    """
+    stack = [iter(nodes)]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, Container):
+                stack.append(iter(x.children))
+                break
+            if x.name == 'include':
+                yield x
+        else:
+            stack.pop()
+
+
+def load_tree(path, jobs=None, cache=None):
+    """
+    Load an nginx configuration file together with every file it includes.
+    Include globs are resolved relative to the directory of the root file,
+    like nginx does for its main configuration, and the included objects
+    replace the include directive. Files are parsed one include level at a
+    time, the files of a level concurrently in a process pool.
+    :param str path: Location of the root file
+    :param int jobs: Number of worker processes, None for the CPU count,
+        1 parses in this process
+    :param ParseCache cache: Cache of parsed files, None parses every file
+    :returns: Tree object
+    :raises IncludeCycleError: When a file ends up including itself
+    """
+    root = os.path.abspath(path)
+    base = os.path.dirname(root)
+    tree = Tree(root)
+    pool = None
+    parsed = {}
+
+    def parse_all(paths):
+        nonlocal pool
+        todo = []
+        for p in dict.fromkeys(paths):
+            if p in parsed:
+                continue
+            data = None
+            if cache is not None:
+                st = os.stat(p)
+                data = cache.get(p, st.st_mtime_ns, st.st_size)
+            if data is None:
+                todo.append(p)
+            else:
+                parsed[p] = data
+        if len(todo) > 1 and jobs != 1:
+            workers = jobs or os.cpu_count() or 1
+            if pool is None:
+                pool = ProcessPoolExecutor(max_workers=workers)
+            results = pool.map(parse_file, todo,
+                               chunksize=max(1, len(todo) // (4 * workers)))
+        else:
+            results = map(parse_file, todo)
+        for p, (mtime, size, data) in zip(todo, results):
+            parsed[p] = data
+            if cache is not None:
+                cache.put(p, mtime, size, data)
+
+    try:
+        parse_all([root])
+        tree.add(*pickle.loads(parsed[root]).children)
+        pending = [(tree.children, (root,))]
+        while pending:
+            includes = []
+            for nodes, chain in pending:
+                for key in iter_includes(nodes):
+                    files = resolve_include(key.value, base)
+                    for f in files:
+                        if f in chain:
+                            raise IncludeCycleError(chain + (f,))
+                    includes.append((key, files, chain))
+            parse_all(f for key, files, chain in includes for f in files)
+
+            pending = []
+            replacements = {}
+            parents = {}
+            for key, files, chain in includes:
+                parent = key._parent
+                nodes = []
+                for f in files:
+                    children = pickle.loads(parsed[f]).children
+                    for x in children:
+                        x._parent = parent
+                        tree._sources[id(x)] = (x, f)
+                    nodes.extend(children)
+                    pending.append((children, chain + (f,)))
+                    tree.files.append(f)
+                replacements[id(key)] = nodes
+                parents[id(parent)] = parent
+            # Every parent is rebuilt once, however many includes it has
+            for parent in parents.values():
+                children = []
+                for x in parent.children:
+                    nodes = replacements.get(id(x))
+                    if nodes is None:
+                        children.append(x)
+                    else:
+                        x._parent = None
+                        children.extend(nodes)
+                parent.children[:] = children
+                parent.invalidate()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    # Snippets included several times are listed once
+    tree.files[:] = dict.fromkeys(tree.files)
+    return tree
@@ -1,13 +1,115 @@
+import codecs
+import collections
+import hashlib
 import re
+import sys
+import threading
 
 INDENT = '    '
 
 
-def bump_child_depth(obj, depth):
-    children = getattr(obj, 'children', [])
-    for child in children:
-        child._depth = depth + 1
-        bump_child_depth(child, child._depth)
+class ChildIndex(object):
+    """
+    Lookup tables over the child objects of a Conf or Container.
+    Children are indexed by type, by name (Key name or Container name) and by
+    (type name, value) for Containers, so that lookups cost O(matches)
+    instead of a scan over every child.
+    """
+
+    def __init__(self, children=()):
+        """
+        Initialize object.
+        :param children: Child objects to index
+        """
+        self.size = 0
+        self.types = {}
+        self.names = {}
+        self.values = {}
+        for x in children:
+            self.add(x)
+
+    def add(self, obj):
+        """
+        Add a child object to the index.
+        :param obj: Key or Container object
+        :returns: None
+        """
+        self.size += 1
+        self.types.setdefault(type(obj), []).append(obj)
+        name = getattr(obj, '_name', None)
+        if name is not None:
+            self.names.setdefault(name, []).append(obj)
+        if isinstance(obj, Container):
+            self.values.setdefault(
+                (type(obj).__name__, obj._value), []).append(obj)
+
+    def remove(self, obj):
+        """
+        Remove a child object from the index.
+        :param obj: Key or Container object
+        :returns: None
+        """
+        self.size -= 1
+        self._discard(self.types, type(obj), obj)
+        self._discard(self.names, getattr(obj, '_name', None), obj)
+        if isinstance(obj, Container):
+            self._discard(self.values, (type(obj).__name__, obj._value), obj)
+
+    @staticmethod
+    def _discard(table, key, obj):
+        matches = table.get(key)
+        if matches is not None:
+            matches.remove(obj)
+            if not matches:
+                del table[key]
+
+    def of_type(self, cls, children):
+        """
+        Return child objects that are instances of `cls`.
+        :param cls: Class to look up (e.g. Server)
+        :param list children: Indexed children, used to restore their order
+            when several indexed classes match
+        :returns: list of matching child objects
+        """
+        matches = [v for k, v in self.types.items() if issubclass(k, cls)]
+        if not matches:
+            return []
+        if len(matches) == 1:
+            return list(matches[0])
+        return [x for x in children if isinstance(x, cls)]
+
+    def named(self, name):
+        """
+        Return child objects (Keys and Containers) with the given name.
+        :param str name: Key or Container name (e.g. 'allow', 'location')
+        :returns: list of matching child objects
+        """
+        return list(self.names.get(name, ()))
+
+    def filter(self, btype, name, children):
+        """
+        Return child objects matching `Conf.filter` criteria.
+        :param str btype: Type of object to filter by (e.g. 'Key')
+        :param str name: Name of key OR container value to filter by
+        :param list children: Indexed children, used to restore their order
+            when both Keys and Containers match
+        :returns: list of matching child objects
+        """
+        if name:
+            keys = [x for x in self.names.get(name, ())
+                    if isinstance(x, Key)]
+            containers = self.values.get((btype, name), [])
+            if keys and containers:
+                matched = set(map(id, keys + containers))
+                return [x for x in children if id(x) in matched]
+            return keys or list(containers)
+        if btype:
+            matches = [v for k, v in self.types.items()
+                       if k.__name__ == btype]
+            if len(matches) == 1:
+                return list(matches[0])
+            return [x for x in children if type(x).__name__ == btype]
+        return []
 
 
 class Conf(object):
@@ -17,12 +119,40 @@ class Conf(object):
     and other types of containers. It can also include top-level comments.
     """
 
+    __slots__ = ('children', '_index', '_hash')
+
     def __init__(self, *args):
         """
         Initialize object.
         :param *args: Any objects to include in this Conf.
         """
         self.children = list(args)
+        self._index = None
+        self._hash = None
+        for x in args:
+            x._parent = self
+
+    @property
+    def index(self):
+        """
+        Return the ChildIndex over this Conf's children.
+        The index is built on first use and kept up to date by add() and
+        remove(), and dropped when a child is renamed. It is rebuilt if
+        children were appended to directly; call invalidate() after editing
+        `children` in place.
+        """
+        if self._index is None or self._index.size != len(self.children):
+            self._index = ChildIndex(self.children)
+        return self._index
+
+    def invalidate(self):
+        """
+        Drop the ChildIndex and the cached subtree hash of this node and its
+        ancestors, see `node_hash`. Needed after editing `children` in place;
+        add(), remove() and assignments to name or value do it already.
+        """
+        self._index = None
+        invalidate(self, force=True)
 
     def add(self, *args):
         """
@@ -31,6 +161,13 @@ class Conf(object):
         :returns: full list of Conf's child objects
         """
         self.children.extend(args)
+        index = self._index
+        for x in args:
+            x._parent = self
+            if index is not None:
+                index.add(x)
+        if self._hash is not None:
+            invalidate(self)
         return self.children
 
     def remove(self, *args):
@@ -41,6 +178,11 @@ class Conf(object):
         """
         for x in args:
             self.children.remove(x)
+            x._parent = None
+            if self._index is not None:
+                self._index.remove(x)
+        if self._hash is not None:
+            invalidate(self)
         return self.children
 
     def filter(self, btype='', name=''):
@@ -50,21 +192,21 @@ class Conf(object):
         :param str name: Name of key OR container value to filter by
         :returns: full list of matching child objects
         """
-        filtered = []
-        for x in self.children:
-            if name and isinstance(x, Key) and x.name == name:
-                filtered.append(x)
-            elif isinstance(x, Container) and x.__class__.__name__ == btype \
-                    and x.value == name:
-                filtered.append(x)
-            elif not name and btype and x.__class__.__name__ == btype:
-                filtered.append(x)
-        return filtered
+        return self.index.filter(btype, name, self.children)
+
+    def find(self, path):
+        """
+        Return descendant object(s) of this Conf matching a path query.
+        See `find` for the query syntax.
+        :param str path: Query (e.g. 'server[server_name=myapp.com]/location')
+        :returns: full list of matching objects
+        """
+        return find(self, path)
 
     @property
     def servers(self):
         """Return a list of child Server objects."""
-        return [x for x in self.children if isinstance(x, Server)]
+        return self.index.of_type(Server, self.children)
 
     @property
     def server(self):
@@ -84,16 +226,7 @@ class Conf(object):
     @property
     def as_strings(self):
         """Return the entire Conf as nginx config strings."""
-        ret = []
-        for x in self.children:
-            if isinstance(x, Key):
-                ret.append(x.as_strings)
-            else:
-                for y in x.as_strings:
-                    ret.append(y)
-        if ret:
-            ret[-1] = re.sub('}\n+$', '}\n', ret[-1])
-        return ret
+        return list(iter_dump(self))
 
 
 class Container(object):
@@ -103,17 +236,66 @@ class Container(object):
     Locations or Geo blocks.
     """
 
+    __slots__ = ('_name', '_value', 'children', '_index', '_parent', '_hash')
+
     def __init__(self, value, *args):
         """
         Initialize object.
         :param str value: Value to be used in name (e.g. regex for Location)
         :param *args: Any objects to include in this Conf.
         """
-        self.name = ''
-        self.value = value
-        self._depth = 0
+        self._name = ''
+        self._value = value
         self.children = list(args)
-        bump_child_depth(self, self._depth)
+        self._index = None
+        self._parent = None
+        self._hash = None
+        for x in args:
+            x._parent = self
+
+    @property
+    def name(self):
+        """Block directive name (e.g. 'location')."""
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        drop_index(self._parent)
+        invalidate(self)
+
+    @property
+    def value(self):
+        """Block directive arguments (e.g. the Location path)."""
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        drop_index(self._parent)
+        invalidate(self)
+
+    @property
+    def index(self):
+        """
+        Return the ChildIndex over this Container's children.
+        The index is built on first use and kept up to date by add() and
+        remove(), and dropped when a child is renamed. It is rebuilt if
+        children were appended to directly; call invalidate() after editing
+        `children` in place.
+        """
+        if self._index is None or self._index.size != len(self.children):
+            self._index = ChildIndex(self.children)
+        return self._index
+
+    def invalidate(self):
+        """
+        Drop the ChildIndex and the cached subtree hash of this node and its
+        ancestors, see `node_hash`. Needed after editing `children` in place;
+        add(), remove() and assignments to name or value do it already.
+        """
+        self._index = None
+        invalidate(self, force=True)
 
     def add(self, *args):
         """
@@ -122,7 +304,13 @@ class Container(object):
         :returns: full list of Container's child objects
         """
         self.children.extend(args)
-        bump_child_depth(self, self._depth)
+        index = self._index
+        for x in args:
+            x._parent = self
+            if index is not None:
+                index.add(x)
+        if self._hash is not None:
+            invalidate(self)
         return self.children
 
     def remove(self, *args):
@@ -133,6 +321,11 @@ class Container(object):
         """
         for x in args:
             self.children.remove(x)
+            x._parent = None
+            if self._index is not None:
+                self._index.remove(x)
+        if self._hash is not None:
+            invalidate(self)
         return self.children
 
     def filter(self, btype='', name=''):
@@ -142,26 +335,26 @@ class Container(object):
         :param str name: Name of key OR container value to filter by
         :returns: full list of matching child objects
         """
-        filtered = []
-        for x in self.children:
-            if name and isinstance(x, Key) and x.name == name:
-                filtered.append(x)
-            elif isinstance(x, Container) and x.__class__.__name__ == btype \
-                    and x.value == name:
-                filtered.append(x)
-            elif not name and btype and x.__class__.__name__ == btype:
-                filtered.append(x)
-        return filtered
+        return self.index.filter(btype, name, self.children)
+
+    def find(self, path):
+        """
+        Return descendant object(s) of this Container matching a path query.
+        See `find` for the query syntax.
+        :param str path: Query (e.g. 'server[server_name=myapp.com]/location')
+        :returns: full list of matching objects
+        """
+        return find(self, path)
 
     @property
     def locations(self):
         """Return a list of child Location objects."""
-        return [x for x in self.children if isinstance(x, Location)]
+        return self.index.of_type(Location, self.children)
 
     @property
     def keys(self):
         """Return a list of child Key objects."""
-        return [x for x in self.children if isinstance(x, Key)]
+        return self.index.of_type(Key, self.children)
 
     @property
     def as_list(self):
@@ -176,36 +369,23 @@ class Container(object):
 
     @property
     def as_strings(self):
-        """Return the entire Container as nginx config strings."""
-        ret = []
-        container_title = (INDENT * self._depth)
-        container_title += '{0}{1} {{\n'.format(
-            self.name, (' {0}'.format(self.value) if self.value else '')
-        )
-        ret.append(container_title)
-        for x in self.children:
-            if isinstance(x, Key):
-                ret.append(INDENT + x.as_strings)
-            elif isinstance(x, Container):
-                y = x.as_strings
-                ret.append('\n' + y[0])
-                for z in y[1:]:
-                    ret.append(INDENT + z)
-            else:
-                y = x.as_strings
-                ret.append(INDENT + y)
-        ret[-1] = re.sub('}\n+$', '}\n', ret[-1])
-        ret.append('}\n\n')
-        return ret
+        """
+        Return the entire Container as nginx config strings.
+        Indentation is derived from nesting at serialization time, with this
+        Container rendered as the outermost block.
+        """
+        return list(iter_dump(self))
 
 
 class Server(Container):
     """Container for server block configurations."""
 
+    __slots__ = ()
+
     def __init__(self, *args):
         """Initialize."""
         super(Server, self).__init__('', *args)
-        self.name = 'server'
+        self._name = 'server'
 
     @property
     def as_dict(self):
@@ -216,31 +396,99 @@ class Server(Container):
 class Location(Container):
     """Container for Location-based options."""
 
+    __slots__ = ()
+
     def __init__(self, value, *args):
         """Initialize."""
         super(Location, self).__init__(value, *args)
-        self.name = 'location'
+        self._name = 'location'
 
 
 class Upstream(Container):
     """Container for upstream configuration (reverse proxy)."""
 
+    __slots__ = ()
+
     def __init__(self, value, *args):
         """Initialize."""
         super(Upstream, self).__init__(value, *args)
-        self.name = 'upstream'
+        self._name = 'upstream'
+
+
+class Events(Container):
+    """Container for the events block (connection processing settings)."""
+
+    __slots__ = ()
+
+    def __init__(self, *args):
+        """Initialize."""
+        super(Events, self).__init__('', *args)
+        self._name = 'events'
+
+    @property
+    def as_dict(self):
+        """Return all child objects in nested dict."""
+        return {'events': [x.as_dict for x in self.children]}
+
+
+class Http(Container):
+    """Container for the http block, holding the HTTP servers."""
+
+    __slots__ = ()
+
+    def __init__(self, *args):
+        """Initialize."""
+        super(Http, self).__init__('', *args)
+        self._name = 'http'
+
+    @property
+    def as_dict(self):
+        """Return all child objects in nested dict."""
+        return {'http': [x.as_dict for x in self.children]}
+
+    @property
+    def servers(self):
+        """Return a list of child Server objects."""
+        return self.index.of_type(Server, self.children)
 
 
 class Key(object):
     """Represents a simple key/value object found in an nginx config."""
 
+    __slots__ = ('_name', '_value', '_parent')
+
     def __init__(self, name, value):
         """
         Initialize object.
         :param *args: Any objects to include in this Server block.
         """
-        self.name = name
-        self.value = value
+        # Directive names repeat heavily (allow, server, proxy_pass...), so
+        # all Keys share a single copy of each name.
+        self._name = sys.intern(name) if type(name) is str else name
+        self._value = value
+        self._parent = None
+
+    @property
+    def name(self):
+        """Directive name (e.g. 'proxy_pass')."""
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = sys.intern(name) if type(name) is str else name
+        drop_index(self._parent)
+        invalidate(self._parent)
+
+    @property
+    def value(self):
+        """Directive arguments, as a single string."""
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        drop_index(self._parent)
+        invalidate(self._parent)
 
     @property
     def as_list(self):
@@ -255,107 +503,597 @@ class Key(object):
     @property
     def as_strings(self):
         """Return key as nginx config string."""
-        if self.value == '' or self.value is None:
-            return '{0};\n'.format(self.name)
-        if '"' not in self.value and (';' in self.value or '#' in self.value):
-            return '{0} "{1}";\n'.format(self.name, self.value)
-        return '{0} {1};\n'.format(self.name, self.value)
+        name, value = self._name, self._value
+        if value == '' or value is None:
+            return '{0};\n'.format(name)
+        if '"' not in value and (';' in value or '#' in value):
+            return '{0} "{1}";\n'.format(name, value)
+        return '{0} {1};\n'.format(name, value)
 
 
-def loads(data, conf=True):
+# One step of a find() query: a name, optionally followed by a bracketed
+# predicate, separated from the next step by '/'.
+PATH_STEP_RE = re.compile(r'([^/\[\]]+)(?:\[([^\]]*)\])?(?:/|$)')
+
+
+def parse_path(path):
     """
-    Load an nginx configuration from a provided string.
-    :param str data: nginx configuration
-    :param bool conf: Load object(s) into a Conf object?
+    Split a find() query into (name, predicate) steps.
+    :param str path: Query (e.g. 'server[server_name=myapp.com]/location')
+    :returns: list of (name, predicate) tuples, predicate may be None
     """
-    f = Conf() if conf else []
-    lopen = []
-    index = 0
+    steps = []
+    pos = 0
+    path = path.strip('/')
+    while pos < len(path):
+        m = PATH_STEP_RE.match(path, pos)
+        if m is None:
+            raise ValueError('Invalid path {0!r} at offset {1}'.format(path, pos))
+        steps.append((m.group(1).strip(), m.group(2)))
+        pos = m.end()
+    return steps
+
+
+def matches_predicate(obj, predicate):
+    """
+    Check a find() predicate against an object.
+    `key=value` matches Containers with a child Key `key` set to `value` or
+    listing it among whitespace separated values (e.g. `server_name=a.com`
+    matches `server_name a.com www.a.com`); anything else matches
+    Containers or Keys whose value equals it.
+    :param obj: Key or Container object
+    :param str predicate: Predicate text between the brackets
+    :returns: True if the object matches
+    """
+    if predicate is None:
+        return True
+    name, sep, value = predicate.partition('=')
+    if sep and name and not re.search(r'\s', name):
+        if not isinstance(obj, Container):
+            return False
+        return any(x.value == value or value in (x.value or '').split()
+                   for x in obj.index.named(name) if isinstance(x, Key))
+    return obj.value == predicate
+
+
+def find(obj, path):
+    """
+    Return descendant object(s) of a Conf or Container matching a path query.
+    Steps are separated by '/' and select children by Key or Container name,
+    e.g. 'server[server_name=myapp.com]/location[/secret]/allow'. A step may
+    carry a predicate in brackets, either `key=value` (the Container has a
+    child Key with that value, or with that among its values) or a plain
+    value (the Container or Key value).
+    :param obj obj: nginx object (Conf, Server, Container)
+    :param str path: Query to evaluate
+    :returns: full list of matching objects
+    """
+    current = [obj]
+    for name, predicate in parse_path(path):
+        found = []
+        for parent in current:
+            if not isinstance(parent, (Conf, Container)):
+                continue
+            for x in parent.index.named(name):
+                if matches_predicate(x, predicate):
+                    found.append(x)
+        current = found
+    return current
+
+
+# Single pass tokenizer for nginx configuration text. Leading whitespace is
+# captured together with the token that follows it. Alternatives are tried in
+# order, so comments and quoted strings win over bare words. Bare words may
+# carry ``${var}`` references, which nginx allows to contain braces.
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s*)
+    (?:
+        (?P<comment>\#[^\n]*)
+      | (?P<word>"(?:[^"\\]|\\.)*"
+               | '(?:[^'\\]|\\.)*'
+               | (?:\$\{[^}\s]*\}|[^\s{};"'])(?:\$\{[^}\s]*\}|[^\s{};])*)
+      | (?P<punct>[{};])
+    )
+""", re.S | re.X)
+
+# The rest of the buffer after a word ending in '$' when it may be the
+# start of a ${var} reference cut off by the end of a chunk.
+UNTERMINATED_VAR_RE = re.compile(r'\{[^}\s]*\Z')
+
+# Block directives with a dedicated Container subclass. Anything else that
+# opens a block (map, geo, if...) becomes a generic Container.
+BLOCK_TYPES = {
+    'server': Server,
+    'location': Location,
+    'upstream': Upstream,
+    'events': Events,
+    'http': Http,
+}
+
+# Container subclasses whose blocks take no arguments
+NO_VALUE_TYPES = (Server, Events, Http)
+
+
+def tokenize(chunks):
+    """
+    Split nginx configuration text into tokens in a single pass.
+    :param chunks: iterable of nginx configuration strings, read in order
+    :returns: generator of (kind, text, space, line) tuples, where kind is
+        'word', '{', '}' or ';' and space is the whitespace preceding the token
+    """
+    line = 1
+    buf = ''
+    match = TOKEN_RE.match
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+        else:
+            buf += chunk
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            m = match(buf, pos)
+            if m is None:
+                if not final:
+                    break
+                if buf[pos:].isspace():
+                    pos = end
+                    break
+                raise ValueError(
+                    'Unterminated quoted string at line {0}'.format(line))
+            # A token running to the end of the buffer may continue in
+            # the next chunk, so it is rescanned once more data arrives.
+            if m.end() == end and not final and m.group('punct') is None:
+                break
+            space, comment, word, punct = m.groups()
+            # So does a word cut inside a ${var} reference: the word stops
+            # before the '{', which would otherwise open a block.
+            if (word is not None and word[-1] == '$' and not final and
+                    UNTERMINATED_VAR_RE.match(buf, m.end())):
+                break
+            pos = m.end()
+            if '\n' in space:
+                line += space.count('\n')
+            if word is not None:
+                yield 'word', word, space, line
+                if word[0] in '"\'' and '\n' in word:
+                    line += word.count('\n')
+            elif punct is not None:
+                yield punct, punct, space, line
+        buf = buf[pos:]
+
 
+def read_chunks(fobj, chunk_size=65536):
+    """
+    Read a file-like object in chunks.
+    Binary file objects (including mmap objects) are decoded as UTF-8.
+    :param obj fobj: file-like object to read from
+    :param int chunk_size: number of characters or bytes per read
+    :returns: generator of strings
+    """
+    decoder = None
     while True:
-        m = re.compile(r'^\s*server\s*{', re.S).search(data[index:])
-        if m:
-            s = Server()
-            lopen.insert(0, s)
-            index += m.end()
-            continue
+        chunk = fobj.read(chunk_size)
+        if not chunk:
+            break
+        if not isinstance(chunk, str):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            chunk = decoder.decode(chunk)
+        yield chunk
+    if decoder is not None:
+        yield decoder.decode(b'', True)
 
-        m = re.compile(r'^\s*location\s*([^;]*?)\s*{', re.S).search(data[index:])
-        if m:
-            l = Location(m.group(1))
-            lopen.insert(0, l)
-            index += m.end()
-            continue
 
-        m = re.compile(r'^\s*upstream\s*([^;]*?)\s*{', re.S).search(data[index:])
-        if m:
-            u = Upstream(m.group(1))
-            lopen.insert(0, u)
-            index += m.end()
-            continue
+def make_container(name, value):
+    """
+    Create the Container object for a block directive.
+    :param str name: Directive name (e.g. 'location')
+    :param str value: Arguments of the directive (e.g. '= /')
+    :returns: Container object
+    """
+    cls = BLOCK_TYPES.get(name)
+    if cls in NO_VALUE_TYPES:
+        if not value:
+            return cls()
+    elif cls is not None:
+        return cls(value)
+    c = Container(value)
+    c._name = sys.intern(name)
+    return c
 
-        m = re.compile(r'^\s*}', re.S).search(data[index:])
-        if m:
-            if isinstance(lopen[0], Container):
-                c = lopen[0]
-                lopen.pop(0)
-                if lopen and isinstance(lopen[0], Container):
-                    lopen[0].add(c)
-                else:
-                    f.add(c) if conf else f.append(c)
-            index += m.end()
-            continue
 
-        double = r'\s*"[^"]*"'
-        single = r'\s*\'[^\']*\''
-        normal = r'\s*[^;\s]*'
-        s1 = r'{}|{}|{}'.format(double, single, normal)
-        s = r'^\s*({})\s*((?:{})+);'.format(s1, s1)
-        m = re.compile(s, re.S).search(data[index:])
-        if m:
-            k = Key(m.group(1), m.group(2))
-            if lopen and isinstance(lopen[0], (Container, Server)):
-                lopen[0].add(k)
-            else:
-                f.add(k) if conf else f.append(k)
-            index += m.end()
+def parse(chunks):
+    """
+    Parse nginx configuration text into a stream of events.
+    :param chunks: iterable of nginx configuration strings, read in order
+    :returns: generator of (event, obj) tuples, see `iterparse`
+    """
+    stack = []
+    words = []
+    spaces = []
+
+    for kind, text, space, line in tokenize(chunks):
+        if kind == 'word':
+            words.append(text)
+            spaces.append(space)
             continue
 
-        m = re.compile(r'^\s*(\S+);', re.S).search(data[index:])
-        if m:
-            k = Key(m.group(1), '')
-            if lopen and isinstance(lopen[0], (Container, Server)):
-                lopen[0].add(k)
-            else:
-                f.add(k) if conf else f.append(k)
-            index += m.end()
+        if kind == '}':
+            if words:
+                raise ValueError(
+                    'Unexpected "}}" after "{0}" at line {1}'.format(
+                        words[0], line))
+            if not stack:
+                raise ValueError('Unexpected "}}" at line {0}'.format(line))
+            yield 'end', stack.pop()
             continue
 
-        break
+        if not words:
+            raise ValueError('Unexpected "{0}" at line {1}'.format(kind, line))
+        value = words[1] if len(words) > 1 else ''
+        for sep, word in zip(spaces[2:], words[2:]):
+            value += sep + word
+        if kind == '{':
+            c = make_container(words[0], value)
+            stack.append(c)
+            yield 'start', c
+        else:
+            yield 'key', Key(words[0], value)
+        del words[:]
+        del spaces[:]
+
+    if words:
+        raise ValueError('Missing ";" after "{0}"'.format(words[0]))
+    if stack:
+        raise ValueError('Unclosed "{0}" block'.format(stack[-1].name))
 
+
+def iterparse(fobj, chunk_size=65536):
+    """
+    Incrementally parse an nginx configuration from a file-like object.
+    Yields ('start', Container) when a block opens, ('key', Key) for every
+    directive and ('end', Container) when a block closes. Containers are
+    yielded empty: children are not attached, so memory use is bounded by
+    the nesting depth rather than by the size of the file.
+    :param obj fobj: file-like object to read from (text, binary or mmap)
+    :param int chunk_size: number of characters or bytes per read
+    :returns: generator of (event, obj) tuples
+    """
+    return parse(read_chunks(fobj, chunk_size))
+
+
+def loads(data, conf=True):
+    """
+    Load an nginx configuration from a provided string.
+    :param str data: nginx configuration
+    :param bool conf: Load object(s) into a Conf object?
+    """
+    f = Conf() if conf else []
+    parent = f if conf else None
+    children = f.children if conf else f
+    stack = []
+
+    # Children are appended directly: the tree is fresh, so there is no
+    # ChildIndex or subtree hash to keep up to date yet.
+    for event, obj in parse((data,)):
+        if event == 'key':
+            obj._parent = parent
+            children.append(obj)
+        elif event == 'start':
+            obj._parent = parent
+            children.append(obj)
+            stack.append((parent, children))
+            parent, children = obj, obj.children
+        else:
+            parent, children = stack.pop()
     return f
 
 
-def dumps(obj):
+def iter_dump(obj, depth=-1):
+    """
+    Serialize an nginx configuration piece by piece.
+    Walks the tree once without recursion, computing indentation from depth,
+    so only the current path from the root is held in memory.
+    :param obj obj: nginx object (Conf, Server, Container, Key)
+    :param int depth: For a Conf, the depth of the block its children are
+        rendered into: -1 for the top level, 0 renders them like the
+        children of a top level block (e.g. the content of an http block)
+    :returns: generator of nginx configuration strings
+    """
+    if isinstance(obj, Conf):
+        stack = [[None, obj.children, 0, depth, False]]
+    elif isinstance(obj, Container):
+        yield '{0}{1} {{\n'.format(
+            obj.name, (' {0}'.format(obj.value) if obj.value else ''))
+        stack = [[obj, obj.children, 0, 0, False]]
+    else:
+        yield obj.as_strings
+        return
+
+    while stack:
+        frame = stack[-1]
+        container, children, index, depth, last = frame
+        if index == len(children):
+            stack.pop()
+            if container is not None:
+                yield INDENT * depth + ('}\n' if last else '}\n\n')
+            continue
+        frame[2] = index + 1
+        x = children[index]
+        if isinstance(x, Container):
+            # Nested blocks are preceded by a blank line, which inherits
+            # the indentation of the enclosing blocks.
+            title = ((INDENT * depth + '\n') if depth >= 0 else '')
+            title += INDENT * (depth + 1)
+            title += '{0}{1} {{\n'.format(
+                x.name, (' {0}'.format(x.value) if x.value else ''))
+            yield title
+            stack.append(
+                [x, x.children, 0, depth + 1, index == len(children) - 1])
+        else:
+            yield INDENT * (depth + 1) + x.as_strings
+
+
+def dumps(obj, depth=-1):
     """
     Dump an nginx configuration to a string.
     :param obj obj: nginx object (Conf, Server, Container)
+    :param int depth: Depth a Conf is rendered at, see `iter_dump`
     :returns: nginx configuration as string
     """
-    return ''.join(obj.as_strings)
+    return ''.join(iter_dump(obj, depth))
 
 
-def dump(obj, fobj):
+def dump(obj, fobj, chunk_size=65536):
     """
     Write an nginx configuration to a file-like object.
+    Output is written in chunks as it is generated, so the full
+    configuration is never held in memory.
     :param obj obj: nginx object (Conf, Server, Container)
     :param obj fobj: file-like object to write to
+    :param int chunk_size: approximate number of characters per write
     :returns: file-like object that was written to
     """
-    fobj.write(dumps(obj))
+    buf = []
+    size = 0
+    for piece in iter_dump(obj):
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            fobj.write(''.join(buf))
+            buf = []
+            size = 0
+    if buf:
+        fobj.write(''.join(buf))
     return fobj
 
 
+def drop_index(node):
+    """
+    Drop the ChildIndex of a node, so that it is rebuilt on next use.
+    Needed when one of its children is renamed, as the index is keyed by
+    the names and values of the children.
+    :param node: Conf or Container object, or None
+    :returns: None
+    """
+    if node is not None:
+        node._index = None
+
+
+def invalidate(node, force=False):
+    """
+    Drop the cached subtree hash of a node and of its ancestors.
+    A node without a cached hash has none cached on its ancestors either,
+    so the walk stops there unless `force` is set.
+    :param node: Conf or Container object, or None
+    :param bool force: Walk up to the root regardless
+    :returns: None
+    """
+    while node is not None:
+        if node._hash is None and not force:
+            return
+        node._hash = None
+        node = getattr(node, '_parent', None)
+
+
+def _digest(node, child_digest):
+    """
+    Compute the Merkle hash of a Conf or Container from its header, its
+    Keys and the hashes of its child Containers.
+    :param node: Conf or Container object
+    :param child_digest: Callable returning the hash of a child Container
+    :returns: hex digest
+    """
+    # Conf subclasses, like the Tree of nginx.loader, hash like a Conf
+    kind = 'Conf' if isinstance(node, Conf) else type(node).__name__
+    parts = ['{0}\0{1}\0{2}\n'.format(
+        kind, getattr(node, 'name', ''), getattr(node, 'value', ''))]
+    for x in node.children:
+        if isinstance(x, Key):
+            parts.append('K{0}\0{1}\n'.format(x._name, x._value))
+        else:
+            parts.append('C' + child_digest(x))
+    return hashlib.blake2b(
+        ''.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def node_hash(obj):
+    """
+    Return the Merkle hash of a Conf or Container, as `subtree_hashes`
+    computes it. Hashes are cached on the nodes and dropped by add(),
+    remove() and assignments to name or value, so after a change only the
+    path to the root is rehashed.
+    Editing `children` in place is not tracked, call `invalidate()` on
+    the edited node afterwards.
+    :param obj obj: nginx object (Conf, Server, Container)
+    :returns: hex digest
+    """
+    stack = [(obj, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node._hash is not None:
+            continue
+        if expanded:
+            node._hash = _digest(node, lambda x: x._hash)
+        else:
+            stack.append((node, True))
+            stack.extend((x, False) for x in node.children
+                         if not isinstance(x, Key) and x._hash is None)
+    return obj._hash
+
+
+class RenderCache(object):
+    """
+    Content addressed cache of rendered Containers, for serializing trees
+    that change little between dumps. Rendered text is keyed by the
+    subtree hash (see `node_hash`) and the position the Container is
+    rendered at, so unchanged and identical subtrees are not rendered
+    again. The least recently used entries are evicted beyond `max_size`
+    characters. Output is identical to `dumps`.
+    """
+
+    def __init__(self, max_size=64 << 20):
+        """
+        Initialize object.
+        :param int max_size: Limit of the cached text, in characters
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return text
+
+    def put(self, key, text):
+        with self._lock:
+            if key in self._entries or len(text) > self.max_size:
+                return
+            self._entries[key] = text
+            self.size += len(text)
+            while self.size > self.max_size:
+                self.size -= len(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        """Drop every cached entry."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def iter_dump(self, obj):
+        """
+        Serialize an nginx configuration like `iter_dump`, taking unchanged
+        Containers from the cache.
+        :param obj obj: nginx object (Conf, Server, Container, Key)
+        :returns: generator of nginx configuration strings
+        """
+        if isinstance(obj, Key):
+            yield obj.as_strings
+            return
+        node_hash(obj)
+        if isinstance(obj, Container):
+            yield '{0}{1} {{\n'.format(
+                obj.name, (' {0}'.format(obj.value) if obj.value else ''))
+            depth = 0
+        else:
+            depth = -1
+        children = obj.children
+        for index, x in enumerate(children):
+            if isinstance(x, Container):
+                yield self.render(x, depth, index == len(children) - 1)
+            else:
+                yield INDENT * (depth + 1) + x.as_strings
+        if isinstance(obj, Container):
+            yield '}\n\n'
+
+    def render(self, obj, depth, last):
+        """
+        Render a Container the way `iter_dump` does at a given position.
+        :param obj obj: Container object, with its subtree hash computed
+        :param int depth: Depth of the enclosing block, -1 at the top level
+        :param bool last: Is the Container the last child of its parent?
+        :returns: nginx configuration as string
+        """
+        key = (obj._hash, depth, last)
+        text = self.get(key)
+        if text is not None:
+            return text
+        # Render without recursion: each frame collects the text of one
+        # Container, taking cached child Containers as they are.
+        stack = [self._frame(obj, depth, last)]
+        while True:
+            frame = stack[-1]
+            container, index, parts, depth, last = frame
+            children = container.children
+            nested = None
+            while index < len(children):
+                x = children[index]
+                index += 1
+                if not isinstance(x, Container):
+                    parts.append(INDENT * (depth + 2) + x.as_strings)
+                    continue
+                child_last = index == len(children)
+                text = self.get((x._hash, depth + 1, child_last))
+                if text is None:
+                    nested = self._frame(x, depth + 1, child_last)
+                    break
+                parts.append(text)
+            frame[1] = index
+            if nested is not None:
+                stack.append(nested)
+                continue
+
+            parts.append(INDENT * (depth + 1) + ('}\n' if last else '}\n\n'))
+            text = ''.join(parts)
+            self.put((container._hash, depth, last), text)
+            stack.pop()
+            if not stack:
+                return text
+            stack[-1][2].append(text)
+
+    @staticmethod
+    def _frame(obj, depth, last):
+        # Nested blocks are preceded by a blank line, which inherits the
+        # indentation of the enclosing blocks, as in iter_dump.
+        title = ((INDENT * depth + '\n') if depth >= 0 else '')
+        title += INDENT * (depth + 1)
+        title += '{0}{1} {{\n'.format(
+            obj.name, (' {0}'.format(obj.value) if obj.value else ''))
+        return [obj, 0, [title], depth, last]
+
+    def dumps(self, obj):
+        """
+        Dump an nginx configuration to a string, see `dumps`.
+        :param obj obj: nginx object (Conf, Server, Container)
+        :returns: nginx configuration as string
+        """
+        return ''.join(self.iter_dump(obj))
+
+    def dump(self, obj, fobj):
+        """
+        Write an nginx configuration to a file-like object, see `dump`.
+        :param obj obj: nginx object (Conf, Server, Container)
+        :param obj fobj: file-like object to write to
+        :returns: file-like object that was written to
+        """
+        for piece in self.iter_dump(obj):
+            fobj.write(piece)
+        return fobj
+
+
 def dumpf(obj, path):
     """
     Write an nginx configuration to file.
@@ -366,3 +1104,210 @@ def dumpf(obj, path):
     with open(path, 'w') as f:
         dump(obj, f)
     return path
+
+
+class Change(object):
+    """Represents one difference reported by `diff`."""
+
+    __slots__ = ('action', 'path', 'old', 'new')
+
+    def __init__(self, action, path, old=None, new=None):
+        """
+        Initialize object.
+        :param str action: 'added', 'removed', 'changed' or 'reordered'
+        :param str path: Location of the difference, in `find` query syntax
+        :param old: Object (or list of objects when reordered) before
+        :param new: Object (or list of objects when reordered) after
+        """
+        self.action = action
+        self.path = path
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return '<Change {0} {1}>'.format(self.action, self.path)
+
+    def __str__(self):
+        """Return the change as a single line, prefixed by +, -, ~ or ^."""
+        def text(obj):
+            if isinstance(obj, Key):
+                return obj.as_strings.strip()
+            return '{0} {{...}}'.format(
+                ' '.join(x for x in (obj.name, obj.value) if x))
+        if self.action == 'added':
+            return '+ {0}: {1}'.format(self.path, text(self.new))
+        if self.action == 'removed':
+            return '- {0}: {1}'.format(self.path, text(self.old))
+        if self.action == 'changed':
+            return '~ {0}: {1} -> {2}'.format(
+                self.path, text(self.old), text(self.new))
+        return '^ {0}: order of {1} changed'.format(
+            self.path, ', '.join(sorted(set(x.name for x in self.new))))
+
+
+def subtree_hashes(obj, hashes=None):
+    """
+    Compute a Merkle hash of every Conf and Container below and including
+    `obj`: it covers the node's type, name and value, its Keys and the
+    hashes of its child Containers in order, so equal hashes mean equal
+    subtrees.
+    :param obj obj: nginx object (Conf, Server, Container)
+    :param dict hashes: Table to fill, keyed by id() of the nodes
+    :returns: dict of id(node) to hex digest
+    """
+    if hashes is None:
+        hashes = {}
+    # Post-order walk without recursion: a container is hashed once all of
+    # its child containers are. Keys are hashed as part of their parent.
+    stack = [(obj, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            hashes[id(node)] = _digest(node, lambda x: hashes[id(x)])
+        else:
+            stack.append((node, True))
+            stack.extend((x, False) for x in node.children
+                         if not isinstance(x, Key))
+    return hashes
+
+
+def path_step(obj):
+    """
+    Build the `find` query step identifying a Container among its siblings.
+    Servers are identified by their first server_name (or listen), other
+    Containers by their value.
+    :param obj obj: Container object
+    :returns: query step as string
+    """
+    if isinstance(obj, Server):
+        for name in ('server_name', 'listen'):
+            for x in obj.children:
+                if isinstance(x, Key) and x.name == name:
+                    return 'server[{0}={1}]'.format(name, x.value)
+        return 'server'
+    if obj.value:
+        return '{0}[{1}]'.format(obj.name, obj.value)
+    return obj.name
+
+
+def match_key(obj):
+    """
+    Build the key Containers are paired by in `diff`: servers by their
+    server_name values, other Containers by type, name and value.
+    :param obj obj: Container object
+    :returns: hashable key
+    """
+    if isinstance(obj, Server):
+        names = tuple(x.value for x in obj.children
+                      if isinstance(x, Key) and x.name == 'server_name')
+        if names:
+            return ('Server', names)
+        return ('Server', tuple(x.value for x in obj.children
+                                if isinstance(x, Key) and x.name == 'listen'))
+    return (type(obj).__name__, obj.name, obj.value)
+
+
+def _diff_keys(old, new, path, changes):
+    """
+    Compare the Key children of two matched Containers. Keys are compared
+    per name as multisets of values; a name set once on both sides with
+    different values is reported as changed.
+    """
+    old_by_name = {}
+    for x in old:
+        old_by_name.setdefault(x.name, []).append(x)
+    new_by_name = {}
+    for x in new:
+        new_by_name.setdefault(x.name, []).append(x)
+
+    names = list(old_by_name)
+    names += [name for name in new_by_name if name not in old_by_name]
+    for name in names:
+        before = old_by_name.get(name, [])
+        after = new_by_name.get(name, [])
+        removed = _unmatched(before, after)
+        added = _unmatched(after, before)
+        key_path = _join(path, name)
+        if len(removed) == 1 and len(added) == 1:
+            changes.append(Change('changed', key_path, removed[0], added[0]))
+            continue
+        for x in removed:
+            changes.append(Change('removed', key_path, old=x))
+        for x in added:
+            changes.append(Change('added', key_path, new=x))
+
+
+def _unmatched(keys, others):
+    """Return the Keys whose value is not matched by one of `others`."""
+    counts = {}
+    for x in others:
+        counts[x.value] = counts.get(x.value, 0) + 1
+    unmatched = []
+    for x in keys:
+        if counts.get(x.value):
+            counts[x.value] -= 1
+        else:
+            unmatched.append(x)
+    return unmatched
+
+
+def _join(path, step):
+    return '{0}/{1}'.format(path, step) if path else step
+
+
+def diff(a, b):
+    """
+    Compare two nginx configuration trees structurally.
+    Containers are paired by `match_key` and compared recursively, Keys per
+    name. Subtrees with equal Merkle hashes (see `subtree_hashes`) are
+    skipped without being visited, so the cost is linear in the size of the
+    trees and small when few parts differ.
+    :param obj a: nginx object (Conf, Server, Container) before
+    :param obj b: nginx object (Conf, Server, Container) after
+    :returns: list of Change objects, in document order
+    """
+    hashes = subtree_hashes(a)
+    subtree_hashes(b, hashes)
+    changes = []
+    if isinstance(a, Container):
+        stack = [(a, b, path_step(a))]
+    else:
+        stack = [(a, b, '')]
+    while stack:
+        x, y, path = stack.pop()
+        if hashes[id(x)] == hashes[id(y)]:
+            continue
+        before = len(changes)
+        _diff_keys([c for c in x.children if isinstance(c, Key)],
+                   [c for c in y.children if isinstance(c, Key)],
+                   path, changes)
+
+        old = {}
+        for c in x.children:
+            if isinstance(c, Container):
+                old.setdefault(match_key(c), []).append(c)
+        new = {}
+        for c in y.children:
+            if isinstance(c, Container):
+                new.setdefault(match_key(c), []).append(c)
+        matched = []
+        for key in list(old) + [k for k in new if k not in old]:
+            before_list = old.get(key, [])
+            after_list = new.get(key, [])
+            for i in range(max(len(before_list), len(after_list))):
+                if i >= len(after_list):
+                    c = before_list[i]
+                    changes.append(Change('removed', _join(path, path_step(c)), old=c))
+                elif i >= len(before_list):
+                    c = after_list[i]
+                    changes.append(Change('added', _join(path, path_step(c)), new=c))
+                else:
+                    matched.append((before_list[i], after_list[i]))
+
+        if len(changes) == before and all(hashes[id(o)] == hashes[id(n)] for o, n in matched):
+            # Same children, so only their order differs
+            changes.append(Change('reordered', path or '/', list(x.children), list(y.children)))
+        # Pushed in reverse, so that nested changes come out in document order
+        for o, n in reversed(matched):
+            stack.append((o, n, _join(path, path_step(n))))
+    return changes
@@ -0,0 +1,261 @@
+import re
+
+from .nginx import Container, Key, Location, Server, Upstream, _join, path_step
+
+# listen address[:port] | port | unix:path, followed by parameters
+LISTEN_ADDRESS_RE = re.compile(r"""
+    ^(?:
+        (?P<unix>unix:\S+)
+      | (?:(?P<host>\[[0-9A-Fa-f:.]+\]|[^\s:\[\]]+):)?(?P<port>\d+)
+      | (?P<bare>\[[0-9A-Fa-f:.]+\]|[^\s:\[\]]+)
+    )$
+""", re.X)
+
+LISTEN_FLAGS = frozenset((
+    'default_server', 'default', 'ssl', 'http2', 'quic', 'proxy_protocol',
+    'reuseport', 'deferred', 'bind',
+))
+LISTEN_OPTIONS = frozenset((
+    'ipv6only', 'backlog', 'rcvbuf', 'sndbuf', 'accept_filter', 'fastopen',
+    'so_keepalive', 'setfib', 'max_conn',
+))
+
+# Addresses meaning "every IPv4 address"; a bare port listens on them too
+WILDCARD_ADDRESSES = frozenset(('*', '0.0.0.0'))
+
+# Targets on unix sockets (http://unix:/path:/uri) have no host to check
+PROXY_PASS_RE = re.compile(
+    r'^(?:https?|grpcs?|uwsgi|fastcgi)://(?!unix:)([^/:$]+)(:\d+)?', re.I)
+
+
+class Problem(object):
+    """Represents one issue found by `validate`."""
+
+    __slots__ = ('level', 'path', 'message')
+
+    def __init__(self, level, path, message):
+        """
+        Initialize object.
+        :param str level: 'error' or 'warning'
+        :param str path: Location of the issue, in `find` query syntax
+        :param str message: Description of the issue
+        """
+        self.level = level
+        self.path = path
+        self.message = message
+
+    def __repr__(self):
+        return '<Problem {0} {1}>'.format(self.level, self.path)
+
+    def __str__(self):
+        return '{0}: {1}: {2}'.format(self.level, self.path, self.message)
+
+
+class ValidationError(ValueError):
+    """Raised by `check` when a configuration has errors."""
+
+    def __init__(self, problems):
+        errors = [p for p in problems if p.level == 'error']
+        super(ValidationError, self).__init__(
+            '{0} error(s) in the configuration, first: {1}'.format(
+                len(errors), errors[0]))
+        self.problems = problems
+
+
+def parse_listen(value):
+    """
+    Split a listen value into its address, port and parameters.
+    :param str value: Value of a listen directive
+        (e.g. '0.0.0.0:80 default_server')
+    :returns: tuple of (address, port, parameters), address is '*' for
+        wildcard IPv4 listens, port is None for unix sockets
+    :raises ValueError: When the address or a parameter is malformed
+    """
+    parts = (value or '').split()
+    if not parts:
+        raise ValueError('listen without an address')
+    m = LISTEN_ADDRESS_RE.match(parts[0])
+    if m is None:
+        raise ValueError('malformed listen address {0!r}'.format(parts[0]))
+    if m.group('unix'):
+        address, port = m.group('unix'), None
+    elif m.group('port'):
+        address, port = m.group('host') or '*', int(m.group('port'))
+        if not 0 < port < 65536:
+            raise ValueError('listen port {0} out of range'.format(port))
+    else:
+        address, port = m.group('bare'), 80
+    for param in parts[1:]:
+        name, sep, option = param.partition('=')
+        if sep and name in LISTEN_OPTIONS and option:
+            continue
+        if not sep and param in LISTEN_FLAGS:
+            continue
+        raise ValueError('unknown listen parameter {0!r}'.format(param))
+    if address in WILDCARD_ADDRESSES:
+        address = '*'
+    return address, port, parts[1:]
+
+
+def summarize(conf, path=None):
+    """
+    Collect what `validate` checks in a configuration tree, as records that
+    can be stored and combined with the records of other trees, see
+    `merge`. Issues within a block (malformed listen values, locations
+    defined twice) are found here, the ones spanning servers on merging.
+    :param obj conf: nginx object (Conf, Server, Container)
+    :param str path: Location of conf in `find` query syntax, defaults to
+        its own path step ('' for a Conf)
+    :returns: list of JSON serializable records, in document order
+    """
+    records = []
+    servers = 0
+    if path is None:
+        path = path_step(conf) if isinstance(conf, Container) else ''
+
+    stack = [(conf, path)]
+    while stack:
+        node, path = stack.pop()
+        if isinstance(node, Upstream):
+            records.append(['upstream', node.value])
+        locations = {}
+        listens = []
+        names = []
+        nested = []
+        for x in node.children:
+            if isinstance(x, Key):
+                if x.name == 'listen':
+                    listens.append(x)
+                elif x.name == 'server_name':
+                    names.extend((x.value or '').split())
+                elif x.name == 'proxy_pass':
+                    records.append(
+                        ['proxy_pass', _join(path, 'proxy_pass'), x.value])
+                continue
+            child_path = _join(path, path_step(x))
+            if isinstance(x, Location):
+                location = ' '.join((x.value or '').split())
+                if location in locations:
+                    records.append([
+                        'problem', 'error', child_path,
+                        'location {0} is defined twice'.format(location)])
+                locations[location] = x
+            nested.append((x, child_path))
+        # Reversed, so that nested blocks are checked in document order
+        stack.extend(reversed(nested))
+
+        if not isinstance(node, Server):
+            continue
+        servers += 1
+        addresses = []
+        for x in listens:
+            try:
+                address, port, params = parse_listen(x.value)
+            except ValueError as ex:
+                records.append(['problem', 'error', _join(path, 'listen'),
+                                '{0} in {1!r}'.format(ex, x.value)])
+                continue
+            addresses.append((address, port))
+            if 'default_server' in params or 'default' in params:
+                records.append(['default', servers, path, address, port])
+        if not listens:
+            addresses.append(('*', 80))
+        for name in names or ['']:
+            for address, port in addresses:
+                records.append(['name', servers, path, name, address, port])
+    return records
+
+
+def merge(summaries):
+    """
+    Check the records of one or more trees, see `summarize`, for the issues
+    spanning servers: several default servers for one address and port,
+    server_name and listen pairs served by several servers and proxy_pass
+    targets with neither a matching upstream nor a resolvable looking host
+    name. The trees are checked as if they were one configuration.
+    :param summaries: lists of records, in configuration order
+    :returns: list of Problem objects
+    """
+    problems = []
+    default_servers = {}
+    server_names = {}
+    upstreams = set()
+    proxy_passes = []
+
+    for index, records in enumerate(summaries):
+        for record in records:
+            kind = record[0]
+            if kind == 'problem':
+                problems.append(Problem(*record[1:]))
+            elif kind == 'upstream':
+                upstreams.add(record[1])
+            elif kind == 'proxy_pass':
+                proxy_passes.append(record[1:])
+            elif kind == 'default':
+                server, path, address, port = record[1:]
+                first, first_path = default_servers.setdefault(
+                    (address, port), ((index, server), path))
+                if first != (index, server):
+                    problems.append(Problem(
+                        'error', path,
+                        'duplicate default server for {0}:{1}, already set '
+                        'in {2}'.format(address, port, first_path)))
+            elif kind == 'name':
+                server, path, name, address, port = record[1:]
+                first, first_path = server_names.setdefault(
+                    (name, address, port), ((index, server), path))
+                if first != (index, server):
+                    problems.append(Problem(
+                        'warning', path,
+                        'server name {0!r} on {1}:{2} is already served by '
+                        '{3}'.format(name, address, port, first_path)))
+
+    for path, value in proxy_passes:
+        m = PROXY_PASS_RE.match(value or '')
+        if m is None:
+            continue
+        host = m.group(1)
+        # Host names with a port or a domain are resolved by nginx itself
+        if host in upstreams or m.group(2) or '.' in host or host == 'localhost':
+            continue
+        problems.append(Problem(
+            'error', path,
+            'proxy_pass to {0!r} without an upstream {1}'.format(value, host)))
+    return problems
+
+
+def validate(conf):
+    """
+    Check an nginx configuration tree for common mistakes in a single pass:
+    malformed listen values, several default servers for one address and
+    port, server_name and listen pairs served by several servers, locations
+    defined twice within a block and proxy_pass targets with neither a
+    matching upstream nor a resolvable looking host name.
+    :param obj conf: nginx object (Conf, Server, Container)
+    :returns: list of Problem objects
+    """
+    return merge([summarize(conf)])
+
+
+def check(conf):
+    """
+    Validate a configuration and raise on errors.
+    :param obj conf: nginx object (Conf, Server, Container)
+    :returns: list of warnings
+    :raises ValidationError: When there is at least one error
+    """
+    return check_summaries([summarize(conf)])
+
+
+def check_summaries(summaries):
+    """
+    Validate the records of one or more trees, see `merge`, and raise on
+    errors.
+    :param summaries: lists of records, in configuration order
+    :returns: list of warnings
+    :raises ValidationError: When there is at least one error
+    """
+    problems = merge(summaries)
+    if any(p.level == 'error' for p in problems):
+        raise ValidationError(problems)
+    return problems
@@ -0,0 +1,131 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+class PollingWatcher(object):
+    """
+    Watches files for changes by comparing their modification time, size
+    and inode at a fixed interval.
+    """
+
+    def __init__(self, paths, interval=0.05):
+        """
+        Initialize object.
+        :param paths: Locations of the files to watch
+        :param float interval: Seconds between two checks
+        """
+        self.interval = interval
+        self.signatures = dict((os.path.abspath(path), self.signature(path))
+                               for path in paths)
+
+    @staticmethod
+    def signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def wait(self, timeout):
+        """
+        Wait for changes of the watched files.
+        :param float timeout: Maximum seconds to wait
+        :returns: set of the changed file locations, empty when the timeout
+            expired
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, previous in self.signatures.items():
+                current = self.signature(path)
+                if current != previous:
+                    self.signatures[path] = current
+                    if current is not None:
+                        changed.add(path)
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Watches files for changes with Linux inotify. The parent directories
+    are watched, so that files replaced by a rename (as many editors save)
+    keep being watched.
+    """
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, paths):
+        """
+        Initialize object.
+        :param paths: Locations of the files to watch
+        :raises OSError: When inotify is not available
+        """
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = set(os.path.abspath(path) for path in paths)
+        self.directories = {}
+        try:
+            for directory in set(os.path.dirname(p) for p in self.paths):
+                wd = self.libc.inotify_add_watch(
+                    self.fd, os.fsencode(directory),
+                    self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+                if wd < 0:
+                    raise OSError(
+                        ctypes.get_errno(),
+                        'inotify_add_watch failed for {0}'.format(directory))
+                self.directories[wd] = directory
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def wait(self, timeout):
+        """
+        Wait for changes of the watched files.
+        :param float timeout: Maximum seconds to wait
+        :returns: set of the changed file locations, empty when the timeout
+            expired
+        """
+        deadline = time.monotonic() + timeout
+        changed = set()
+        while not changed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select(
+                    [self.fd], [], [], remaining)[0]:
+                break
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(
+                    buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                path = os.path.join(self.directories.get(wd, ''),
+                                    os.fsdecode(name))
+                if path in self.paths:
+                    changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
@@ -1,20 +1,183 @@
 # Some TODO items
-# Add capability to load input from a URI
-# Add capability to generate a new config on every run , in cases to prevent over-ride ( Can be controlled via command line flag)
 # Adding travis CI to the project
 
 
 import argparse
+import contextlib
+import contextvars
+import cProfile
+import datetime
+import filecmp
+import functools
+import hashlib
+import ipaddress
+import json
 import logging
+import os
+import pickle
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import yaml
 
 try:
-    from yaml import CLoader as Loader, CDumper as Dumper
+    from yaml import CSafeLoader as SafeLoader
 except ImportError:
-    from yaml import Loader, Dumper
+    from yaml import SafeLoader
 
-from nginx.nginx import Conf, Upstream, Key, Server, Location, dump
+from nginx.nginx import Conf, Container, Upstream, Key, Server, Location, Events, Http, dump, dumps, loads, \
+    make_container, diff
+from nginx.cache import ConfigCache
+from nginx.fetch import fetch_all, is_remote_uri
+from nginx.loader import load_tree
+from nginx.validator import ValidationError, check, check_summaries, summarize
+from nginx.watcher import InotifyWatcher, PollingWatcher
+
+logger = logging.getLogger(__name__)
+
+# Bump when the generated output changes for the same input
+GENERATOR_VERSION = '1.2'
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nginx-config-generator')
+DEFAULT_CACHE_SIZE_MB = 256
+
+DEFAULT_FETCH_DIR = os.path.join(DEFAULT_CACHE_DIR, 'fetched')
+DEFAULT_FETCH_CONCURRENCY = 32
+DEFAULT_SHARD_JOBS = 8
+
+# Ends the incremental regeneration manifest: the offset of its index, after the section texts, see load_manifest
+MANIFEST_TRAILER = struct.Struct('>Q')
+
+# How locations restrict access to an ipfilter list: 'inline' repeats the allow rules in every location, 'geo'
+# emits one geo block per ipfilter and checks its variable from the locations
+IPFILTER_MODES = ('inline', 'geo')
+
+# Host the upstream of an app points to when the app lists no backends, see the upstream_host app entry
+DEFAULT_UPSTREAM_HOST = '127.0.0.1'
+# Load balancing methods of an upstream besides the default round robin; hash takes a key, e.g. hash $request_uri
+BALANCING_METHODS = ('least_conn', 'ip_hash', 'hash')
+# Per backend server parameters accepted from the input
+BACKEND_OPTIONS = ('weight', 'max_fails', 'fail_timeout')
+
+# Settings of the tuning profiles per context: 'main' for the top level, 'events' and 'http' for their blocks. The
+# worker_processes and worker_rlimit_nofile settings are derived, see NginxConfigGenerator.tuning_settings
+TUNING_PROFILES = {
+    # Many concurrent connections and large responses: big socket writes, long lived client connections, compression
+    'high-throughput': {
+        'main': {},
+        'events': {
+            'worker_connections': '8192',
+            'multi_accept': 'on',
+        },
+        'http': {
+            'sendfile': 'on',
+            'tcp_nopush': 'on',
+            'tcp_nodelay': 'on',
+            'keepalive_timeout': '65s',
+            'keepalive_requests': '10000',
+            'open_file_cache': 'max=100000 inactive=60s',
+            'open_file_cache_valid': '120s',
+            'open_file_cache_min_uses': '2',
+            'open_file_cache_errors': 'on',
+            'proxy_buffering': 'on',
+            'proxy_buffer_size': '16k',
+            'proxy_buffers': '64 16k',
+            'proxy_busy_buffers_size': '32k',
+            'gzip': 'on',
+            'gzip_comp_level': '5',
+            'gzip_min_length': '1024',
+            'gzip_proxied': 'any',
+            'gzip_vary': 'on',
+            'gzip_types': 'text/plain text/css text/xml application/json application/javascript application/xml',
+        },
+    },
+    # Short responses as early as possible: no write coalescing, responses streamed instead of buffered, cheap
+    # compression, workers pinned to CPUs
+    'low-latency': {
+        'main': {
+            'worker_cpu_affinity': 'auto',
+        },
+        'events': {
+            'worker_connections': '4096',
+            'multi_accept': 'off',
+        },
+        'http': {
+            'sendfile': 'on',
+            'tcp_nopush': 'off',
+            'tcp_nodelay': 'on',
+            'keepalive_timeout': '15s',
+            'keepalive_requests': '1000',
+            'open_file_cache': 'max=10000 inactive=30s',
+            'open_file_cache_valid': '60s',
+            'open_file_cache_min_uses': '1',
+            'open_file_cache_errors': 'on',
+            'proxy_buffering': 'off',
+            'proxy_buffer_size': '8k',
+            'gzip': 'on',
+            'gzip_comp_level': '1',
+            'gzip_min_length': '1024',
+            'gzip_proxied': 'any',
+            'gzip_vary': 'on',
+            'gzip_types': 'text/plain text/css text/xml application/json application/javascript application/xml',
+        },
+    },
+}
+TUNING_CONTEXTS = ('main', 'events', 'http')
+# Directives the tuning entry of an app may set on its server blocks: the http level settings of the profiles, which
+# nginx all accepts in the server context too, and the client and proxy limits and timeouts
+SERVER_TUNING_DIRECTIVES = frozenset(
+    set(name for profile in TUNING_PROFILES.values() for name in profile['http']) | {
+        'client_body_buffer_size', 'client_body_timeout', 'client_header_buffer_size', 'client_header_timeout',
+        'client_max_body_size', 'large_client_header_buffers', 'send_timeout', 'reset_timedout_connection',
+        'lingering_close', 'lingering_time', 'lingering_timeout', 'proxy_connect_timeout', 'proxy_read_timeout',
+        'proxy_send_timeout', 'proxy_request_buffering', 'proxy_max_temp_file_size', 'gzip_buffers',
+        'gzip_disable', 'gzip_http_version',
+    })
+
+_source_digest = None
+
+
+def generator_version():
+    """
+    Builds the generator version used in cache keys, the declared version plus a digest of the generator
+    sources so that cached output is not reused across code changes
+    :return: Generator version string
+    """
+    global _source_digest
+    if _source_digest is None:
+        digest = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for path in (os.path.abspath(__file__), os.path.join(here, 'nginx', 'nginx.py')):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        _source_digest = digest.hexdigest()[:16]
+    return '{}+{}'.format(GENERATOR_VERSION, _source_digest)
+
+
+def setup_logging():
+    """
+    Attaches the console handler to the module logger, once per process
+    :return: None
+    """
+    logger.setLevel(logging.DEBUG)
+    if logger.handlers:
+        return
+    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(logging.INFO)
+
+    logger.addHandler(stream_handler)
 
 
 def is_list_empty(list):
@@ -29,18 +192,384 @@ def is_list_empty(list):
         return False
 
 
+def backend_server(backend, runtime_port=None, env=None):
+    """
+    Builds the value of an upstream server directive from a backend entry of the input
+    :param backend: 'host[:port]' string, or dict with the address and any of BACKEND_OPTIONS, e.g.
+                    {'address': '10.0.0.1:8001', 'weight': 3, 'max_fails': 2, 'fail_timeout': '10s'}
+    :param runtime_port: Port of addresses given without one
+    :param env: Name of the app entry, for error messages
+    :return: Server directive value, e.g. '10.0.0.1:8001 weight=3 max_fails=2 fail_timeout=10s'
+    """
+    options = {}
+    if isinstance(backend, dict):
+        options = dict(backend)
+        backend = options.pop('address', None)
+        unknown = sorted(set(options) - set(BACKEND_OPTIONS))
+        if unknown:
+            raise ValueError("Unknown backend option(s) {} for env {}, expected any of {}".format(
+                ', '.join(unknown), env, BACKEND_OPTIONS))
+    if not backend:
+        raise ValueError("Backend without an address for env {}".format(env))
+    address = str(backend)
+    # Bracketed IPv6 addresses, e.g. [::1]:8001, contain colons of their own, unix sockets have no port
+    if not address.startswith('unix:') and not re.search(r'(^[^:]*|\]):\d+$', address):
+        if runtime_port is None:
+            raise ValueError("Backend {} for env {} has no port and runtime_port is not set".format(address, env))
+        address += ':' + str(runtime_port)
+    for name in BACKEND_OPTIONS:
+        value = options.get(name)
+        if value is None:
+            continue
+        if name != 'fail_timeout' and (type(value) is not int or value < (name == 'weight')):
+            raise ValueError("Backend option {} of {} for env {} must be a{} integer, got {!r}".format(
+                name, address, env, ' positive' if name == 'weight' else ' non negative', value))
+        address += ' {}={}'.format(name, value)
+    return address
+
+
+def directive_value(value):
+    """
+    Formats a directive value from the input, where yaml turns on / off into booleans
+    :param value: Value from the input
+    :return: Directive value as string
+    """
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    return str(value)
+
+
+def aggregate_cidrs(cidrs):
+    """
+    Deduplicates a CIDR list and collapses overlapping, contained and adjacent networks into the minimal covering set.
+    Networks are merged as sorted integer ranges per IP version, so large lists stay fast. Entries that are not IP
+    networks are kept as they are, after the networks
+    :param cidrs: List of IPv4 / IPv6 networks or addresses
+    :return: Aggregated list, IPv4 networks first, each in ascending order
+    """
+    ranges = {4: [], 6: []}
+    others = []
+    for entry in cidrs:
+        try:
+            net = ipaddress.ip_network(str(entry).strip(), strict=False)
+        except ValueError:
+            if entry not in others:
+                others.append(entry)
+            continue
+        first = int(net.network_address)
+        ranges[net.version].append((first, first + (1 << (net.max_prefixlen - net.prefixlen)), net))
+
+    aggregated = []
+    for version, address_class in ((4, ipaddress.IPv4Address), (6, ipaddress.IPv6Address)):
+        merged = []
+        for start, end, net in sorted(ranges[version], key=lambda r: (r[0], -r[1])):
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1][1] = end
+                    merged[-1][2] = None
+                continue
+            merged.append([start, end, net])
+        for start, end, net in merged:
+            if net is not None:
+                nets = [net]
+            else:
+                nets = ipaddress.summarize_address_range(address_class(start), address_class(end - 1))
+            for n in nets:
+                aggregated.append(str(n.network_address) if n.prefixlen == n.max_prefixlen else str(n))
+    return aggregated + others
+
+
+@functools.lru_cache(maxsize=256)
+def _shared_cidr_list(cidrs, aggregate):
+    return tuple(aggregate_cidrs(cidrs)) if aggregate else cidrs
+
+
+def shared_cidr_list(cidrs, aggregate=True):
+    """
+    Builds the CIDR list of an ipfilter once per distinct input list. The result is an immutable tuple shared by every
+    generator rendering the same list, also across threads
+    :param cidrs: CIDR list from the input
+    :param aggregate: Deduplicate and collapse the list, see aggregate_cidrs
+    :return: Tuple of CIDR entries
+    """
+    try:
+        return _shared_cidr_list(tuple(cidrs), aggregate)
+    except TypeError:
+        # Unhashable entries in the input, nothing to share
+        return tuple(aggregate_cidrs(cidrs)) if aggregate else tuple(cidrs)
+
+
+class StageProfiler:
+    """
+    Records wall time, memory allocations and object / line counts of the pipeline stages run while it is active.
+    Stages are marked with profile_stage, which does nothing when no profiler is active
+    """
+
+    def __init__(self, trace_allocations=True, cprofile=False):
+        """
+        Initialize object.
+        :param trace_allocations: Record allocated and peak memory per stage with tracemalloc
+        :param cprofile: Also run cProfile while active, see write_pstats
+        """
+        self.trace_allocations = trace_allocations
+        self.records = []
+        self.profile = cProfile.Profile() if cprofile else None
+        self._open = []
+        self._token = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._token = _active_profiler.set(self)
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+        _active_profiler.reset(self._token)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measures one stage, nested stages are recorded with their depth
+        :param name: Stage name, per app stages are named app:<name>
+        :return: Context manager yielding a dict the stage can store counts in
+        """
+        counts = {}
+        record = {'name': name, 'depth': len(self._open), 'counts': counts}
+        self.records.append(record)
+        tracing = self.trace_allocations and tracemalloc.is_tracing()
+        # tracemalloc.reset_peak is new in Python 3.9, before that only the net allocations of a stage are recorded
+        track_peak = tracing and hasattr(tracemalloc, 'reset_peak')
+        start_bytes = 0
+        if tracing:
+            start_bytes, peak = tracemalloc.get_traced_memory()
+        if track_peak:
+            # The tracemalloc peak is global: hand the peak so far to the enclosing stage before resetting it
+            if self._open:
+                self._open[-1][1] = max(self._open[-1][1], peak)
+            tracemalloc.reset_peak()
+        frame = [record, 0]
+        self._open.append(frame)
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self._open.pop()
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                # Net memory still held after the stage, and the highest usage above the start of the stage
+                record['allocated_bytes'] = current - start_bytes
+            if track_peak:
+                peak = max(peak, frame[1])
+                record['peak_bytes'] = peak - start_bytes
+                if self._open:
+                    self._open[-1][1] = max(self._open[-1][1], peak)
+
+    def summary(self, top=10):
+        """
+        Builds the summary table, per app stages are folded into one row followed by the slowest apps
+        :param top: Number of slowest apps listed
+        :return: List of table lines
+        """
+        rows = []
+        apps = [record for record in self.records if record['name'].startswith('app:')]
+        for record in self.records:
+            if record['name'].startswith('app:'):
+                if record is not apps[0]:
+                    continue
+                folded = {'name': 'apps ({})'.format(len(apps)), 'depth': record['depth'],
+                          'seconds': sum(r['seconds'] for r in apps), 'counts': {}}
+                if 'allocated_bytes' in record:
+                    folded['allocated_bytes'] = sum(r['allocated_bytes'] for r in apps)
+                if 'peak_bytes' in record:
+                    folded['peak_bytes'] = max(r['peak_bytes'] for r in apps)
+                for r in apps:
+                    for key, value in r['counts'].items():
+                        folded['counts'][key] = folded['counts'].get(key, 0) + value
+                rows.append(folded)
+                for r in sorted(apps, key=lambda r: r['seconds'], reverse=True)[:top]:
+                    rows.append(dict(r, depth=record['depth'] + 1))
+            else:
+                rows.append(record)
+
+        lines = ["{:<40} {:>10} {:>12} {:>12} {:>10} {:>10}".format(
+            'stage', 'ms', 'alloc KB', 'peak KB', 'objects', 'lines')]
+        for row in rows:
+            lines.append("{:<40} {:>10.2f} {:>12} {:>12} {:>10} {:>10}".format(
+                ('  ' * row['depth'] + row['name'])[:40], row['seconds'] * 1000,
+                '{:.1f}'.format(row['allocated_bytes'] / 1024.0) if 'allocated_bytes' in row else '-',
+                '{:.1f}'.format(row['peak_bytes'] / 1024.0) if 'peak_bytes' in row else '-',
+                row['counts'].get('objects', '-'), row['counts'].get('lines', '-')))
+        return lines
+
+    def log_summary(self, top=10):
+        """
+        Logs the summary table
+        :param top: Number of slowest apps listed
+        :return: None
+        """
+        for line in self.summary(top):
+            logger.info(line)
+
+    def write_json(self, path):
+        """
+        Writes every stage record as JSON
+        :param path: Location of the JSON file
+        :return: None
+        """
+        with open(path, 'w') as f:
+            json.dump({'version': generator_version(), 'stages': self.records}, f, indent=2)
+
+    def write_pstats(self, path):
+        """
+        Writes the cProfile statistics in pstats format, readable with pstats.Stats or snakeviz
+        :param path: Location of the pstats file
+        :return: None
+        """
+        self.profile.dump_stats(path)
+
+
+_active_profiler = contextvars.ContextVar('nginx_config_generator_profiler', default=None)
+_no_stage = contextlib.nullcontext()
+
+
+def profile_stage(name):
+    """
+    Marks a pipeline stage for the active StageProfiler
+    :param name: Stage name
+    :return: Context manager yielding a dict for object / line counts, or None when profiling is disabled
+    """
+    profiler = _active_profiler.get()
+    if profiler is None:
+        return _no_stage
+    return profiler.stage(name)
+
+
 class NginxConfigGenerator:
-    cidr_filter_list = []
-    cidr_allow_all_list = []
-    default_catch_all_map = {}
-    data = None
+    """
+    Builds the configuration sections for one parsed input. Instances hold no state shared with other instances, so
+    inputs can be rendered concurrently with one generator per render
+    """
 
-    def __init__(self, data):
+    def __init__(self, data, ipfilter_mode='inline', aggregate=True):
         """
         Initialize object.
         :param data: Parsed yaml data as dict
+        :param ipfilter_mode: One of IPFILTER_MODES
+        :param aggregate: Deduplicate and collapse the ipfilter CIDR lists, see aggregate_cidrs
         """
+        if ipfilter_mode not in IPFILTER_MODES:
+            raise ValueError("Unknown ipfilter mode {}, expected one of {}".format(ipfilter_mode, IPFILTER_MODES))
         self.data = data
+        self.ipfilter_mode = ipfilter_mode
+        self.aggregate = aggregate
+        # Per instance, so that rendering several inputs in one process does not
+        # leak CIDR entries from one input into the next
+        self.cidr_filter_list = ()
+        self.cidr_allow_all_list = ()
+        self.default_catch_all_map = {}
+        # ipfilter name to the snippet file locations include instead of repeating the allow rules, see
+        # build_ipfilter_shard. Only used in inline mode
+        self.ipfilter_includes = {}
+        # ipfilter name to the digest of its CIDR list, see ipfilter_digest
+        self.ipfilter_digests = {}
+
+    def content_hash(self):
+        """
+        Computes a stable hash of the normalized input data and the generator version
+        :return: Hex digest identifying the configuration generated for this input
+        """
+        normalized = json.dumps([self.ipfilter_mode, self.aggregate, self.data], sort_keys=True, separators=(',', ':'),
+                                default=str)
+        digest = hashlib.sha256(generator_version().encode('utf-8'))
+        digest.update(normalized.encode('utf-8'))
+        return digest.hexdigest()
+
+    def section_inputs(self, section, item=None, nested=False):
+        """
+        Collects the inputs one section of the configuration is built from, together with the ipfilter mode
+        :param section: 'ipfilter' for the shared ipfilter blocks, 'default' for the default server section or 'app'
+        :param item: Name of the app entry, for 'app' sections. App sections cover the app entry, the catch all entry
+                     and the ipfilter lists it references ( only their names when the lists are shared blocks ).
+                     For 'ipfilter' sections the name of a single ipfilter, None covers all of them
+        :param nested: The section is rendered into the http block of the tuning section, see render_sections
+        :return: List of the section inputs, JSON serializable
+        """
+        if section == 'ipfilter':
+            names = sorted(self.data['ipfilter']) if item is None else [item]
+            inputs = dict((name, self.ipfilter_digest(name)) for name in names)
+        elif section == 'default':
+            inputs = {'catchall': self.data['catchall']['default']}
+        else:
+            app = self.data['app'][item]
+            filters = sorted(set(entry['ipfilter'] for entry in (app['path_based_access_restriction'] or {}).values()
+                                 if entry and entry.get('ipfilter')))
+            if self.ipfilter_mode == 'inline' and not self.ipfilter_includes:
+                filters = dict((name, self.ipfilter_digest(name)) for name in filters)
+            inputs = {
+                'app': app,
+                'ipfilter': filters,
+                'catchall': self.data['catchall'].get(app['catchall'])
+            }
+        return [section, item, self.ipfilter_mode, self.aggregate, self.ipfilter_includes, nested, inputs]
+
+    @staticmethod
+    def inputs_hash(inputs):
+        """
+        Computes a stable hash of section inputs and the generator version
+        :param inputs: Section inputs, see section_inputs
+        :return: Hex digest identifying the generated section
+        """
+        normalized = json.dumps(inputs, sort_keys=True, separators=(',', ':'), default=str)
+        digest = hashlib.sha256(generator_version().encode('utf-8'))
+        digest.update(normalized.encode('utf-8'))
+        return digest.hexdigest()
+
+    def section_hash(self, section, item=None, nested=False):
+        """
+        Computes a stable hash of the inputs one section of the configuration is built from
+        :param section: Section kind, see section_inputs
+        :param item: Name of the app entry or of the ipfilter, see section_inputs
+        :param nested: The section is rendered into the http block of the tuning section
+        :return: Hex digest identifying the generated section
+        """
+        return self.inputs_hash(self.section_inputs(section, item, nested))
+
+    def ipfilter_digest(self, name):
+        """
+        Computes the digest of an ipfilter CIDR list once per generator, so that the hash of every app section
+        referencing the list covers it without encoding the list again
+        :param name: ipfilter name
+        :return: Hex digest of the CIDR list, None for an ipfilter missing from the input
+        """
+        digest = self.ipfilter_digests.get(name)
+        if digest is None and name in self.data['ipfilter']:
+            normalized = json.dumps(self.data['ipfilter'][name], separators=(',', ':'), default=str)
+            digest = self.ipfilter_digests[name] = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        return digest
+
+    def prepare_cidr_list(self, name, cidrs):
+        """
+        Prepares an ipfilter CIDR list from the input, aggregated when enabled
+        :param name: ipfilter name
+        :param cidrs: CIDR list from the input
+        :return: Shared tuple of CIDR entries to build the allow rules from, see shared_cidr_list
+        """
+        if not self.aggregate:
+            return shared_cidr_list(cidrs, False)
+        aggregated = shared_cidr_list(cidrs)
+        logger.info("Aggregated ipfilter {}: {} entries before, {} after".format(name, len(cidrs), len(aggregated)))
+        return aggregated
 
     def build_ip_filters(self):
         """
@@ -48,8 +577,7 @@ class NginxConfigGenerator:
         :return: None
         """
         if is_list_empty(self.data['ipfilter']['myfilter']) is False:
-            for item in self.data['ipfilter']['myfilter']:
-                self.cidr_filter_list.append(item)
+            self.cidr_filter_list = self.prepare_cidr_list('myfilter', self.data['ipfilter']['myfilter'])
         else:
             logger.warning(
                 "my filter field is empty in the given input file , rules for the same will not be created in "
@@ -61,13 +589,129 @@ class NginxConfigGenerator:
         :return: None
         """
         if is_list_empty(self.data['ipfilter']['allowall']) is False:
-            for item in self.data['ipfilter']['allowall']:
-                self.cidr_allow_all_list.append(item)
+            self.cidr_allow_all_list = self.prepare_cidr_list('allowall', self.data['ipfilter']['allowall'])
         else:
             logger.warning(
                 'allow all field is empty in the given input file , rules for the same will not be created in '
                 'the Nginx configuration ')
 
+    def ipfilter_lists(self):
+        """
+        Maps the ipfilter names that locations can reference to their CIDR lists
+        :return: dict of ipfilter name to CIDR list
+        """
+        return {'myfilter': self.cidr_filter_list, 'allowall': self.cidr_allow_all_list}
+
+    @staticmethod
+    def ipfilter_variable(name):
+        """
+        Builds the name of the variable set by the geo block of an ipfilter
+        :param name: ipfilter name
+        :return: nginx variable name, including the leading $
+        """
+        return '$ipfilter_' + re.sub(r'[^A-Za-z0-9_]', '_', name)
+
+    def build_ipfilter_conf(self):
+        """
+        Builds one geo block per ipfilter, setting its variable to 1 for clients within the CIDR list and to 0 for
+        everyone else, so that the list is held once instead of being repeated in every location
+        :return: List of geo Container Objects to be added to the overall generated Nginx Configuration
+        """
+        return [self.build_geo_block(name, cidrs) for name, cidrs in sorted(self.ipfilter_lists().items())]
+
+    def build_geo_block(self, name, cidrs):
+        """
+        Builds the geo block of one ipfilter, see build_ipfilter_conf
+        :param name: ipfilter name
+        :param cidrs: CIDR list of the ipfilter
+        :return: geo Container Object
+        """
+        logger.info('Building the shared geo block for ipfilter: {}'.format(name))
+        geo = make_container('geo', self.ipfilter_variable(name))
+        geo.add(Key('default', '0'))
+        for cidr in cidrs:
+            geo.add(Key(cidr, '1'))
+        return geo
+
+    def build_ipfilter_shard(self, name):
+        """
+        Builds the content of the shard holding one ipfilter in sharded output: its geo block in geo mode, otherwise
+        the allow and deny rules that the locations referencing the ipfilter include
+        :param name: ipfilter name
+        :return: List of Configuration Objects making up the shard
+        """
+        cidrs = self.ipfilter_lists()[name]
+        if self.ipfilter_mode == 'geo':
+            return [self.build_geo_block(name, cidrs)]
+        logger.info('Building the shared allow rules for ipfilter: {}'.format(name))
+        return [Key('allow', cidr) for cidr in cidrs] + [Key('deny', 'all')]
+
+    def tuning_settings(self):
+        """
+        Resolves the tuning section of the input: the settings of its profile per context, with worker_processes
+        derived from the CPU count of the nginx host ( 'auto' when the section does not set cpus ), worker_rlimit_nofile
+        from worker_connections, and the overrides of the section applied last. An override of None removes a setting
+        :return: dict of context to dict of directive name to value in output order, None without a tuning section
+        """
+        tuning = self.data.get('tuning')
+        if tuning is None:
+            return None
+        profile = tuning.get('profile')
+        if profile not in TUNING_PROFILES:
+            raise ValueError("Unknown tuning profile {}, expected one of {}".format(profile, sorted(TUNING_PROFILES)))
+        unknown = sorted(set(tuning) - set(TUNING_CONTEXTS) - {'profile', 'cpus'})
+        if unknown:
+            raise ValueError("Unknown tuning entries {}, expected profile, cpus or one of {}".format(
+                ', '.join(unknown), TUNING_CONTEXTS))
+
+        cpus = tuning.get('cpus')
+        if cpus is None:
+            workers = 'auto'
+        elif type(cpus) is not int or cpus < 1:
+            raise ValueError("tuning cpus must be a positive integer, got {!r}".format(cpus))
+        elif profile == 'low-latency' and cpus > 2:
+            # Leaves a CPU to the network interrupts and the rest of the host
+            workers = str(cpus - 1)
+        else:
+            workers = str(cpus)
+
+        def resolve(context, values):
+            for name, value in (tuning.get(context) or {}).items():
+                if value is None:
+                    values.pop(name, None)
+                else:
+                    values[name] = directive_value(value)
+            return values
+
+        profile_settings = TUNING_PROFILES[profile]
+        events = resolve('events', dict(profile_settings['events']))
+        http = resolve('http', dict(profile_settings['http']))
+        worker_connections = events.get('worker_connections', '512')
+        if not worker_connections.isdigit() or int(worker_connections) < 1:
+            raise ValueError("tuning worker_connections must be a positive integer, got {!r}".format(
+                worker_connections))
+        main = {'worker_processes': workers}
+        # Every proxied request holds a client and a backend connection
+        main['worker_rlimit_nofile'] = str(2 * int(worker_connections))
+        main.update(profile_settings['main'])
+        return {'main': resolve('main', main), 'events': events, 'http': http}
+
+    def build_tuning_conf(self):
+        """
+        Builds the top level directives and the events and http blocks of the tuning section, see tuning_settings. The
+        configuration sections ( upstreams, servers, geo blocks ) go into the http block, which holds only the tuning
+        directives when returned
+        :return: List of the top level Key Objects followed by the Events and Http Configuration Objects, None without
+                 a tuning section
+        """
+        settings = self.tuning_settings()
+        if settings is None:
+            return None
+        logger.info('Building the events and http blocks for tuning profile: {}'.format(self.data['tuning']['profile']))
+        return ([Key(name, value) for name, value in settings['main'].items()] +
+                [Events(*[Key(name, value) for name, value in settings['events'].items()]),
+                 Http(*[Key(name, value) for name, value in settings['http'].items()])])
+
     def build_default_catch_all_map(self):
         """
         Builds the map for catchall configurations
@@ -76,22 +720,48 @@ class NginxConfigGenerator:
         self.default_catch_all_map = self.data['catchall']
 
     @staticmethod
-    def build_upstream_conf(env=None, runtime_port=None, upstream_default_host=None):
+    def build_upstream_conf(env=None, runtime_port=None, upstream_default_host=None, backends=None, balancing=None,
+                            keepalive=None):
         """
         Builds the upstream section configuration for the env passed
         :param env: env being acceptance , prodcution etc
-        :param runtime_port: port on which the virtual host for env listens on being served by same Nginx host
-        :param upstream_default_host:
+        :param runtime_port: port on which the virtual host for env listens on being served by same Nginx host, also
+                             the port of backends listed without one
+        :param upstream_default_host: Host of the single backend used when no backends are listed
+        :param backends: List of backends, each a 'host[:port]' string or a dict with an address and any of
+                         BACKEND_OPTIONS, see backend_server
+        :param balancing: One of BALANCING_METHODS followed by its arguments, None for round robin
+        :param keepalive: Number of idle connections to the backends each worker keeps open, None disables
         :return: Upstream configuration Object to be added to the overall generated Nginx Configuration
         """
 
         logger.info('Building the upstream configuration for env: {}'.format(env))
-        upstream_conf = Upstream(env,
-                                 Key('server', upstream_default_host + ':' + str(runtime_port)))
+        upstream_conf = Upstream(env)
+        if balancing:
+            method, _, arguments = str(balancing).partition(' ')
+            if method not in BALANCING_METHODS:
+                raise ValueError("Unknown balancing method {} for env {}, expected one of {}".format(
+                    method, env, BALANCING_METHODS))
+            if (method == 'hash') != bool(arguments.strip()):
+                raise ValueError("Balancing method {} for env {} takes {}".format(
+                    method, env, 'a key' if method == 'hash' else 'no arguments'))
+            # The method has to precede keepalive
+            upstream_conf.add(Key(method, arguments.strip()))
+        if not backends:
+            if runtime_port is None:
+                raise ValueError("Neither runtime_port nor backends are set for env {}".format(env))
+            backends = [upstream_default_host]
+        for backend in backends:
+            upstream_conf.add(Key('server', backend_server(backend, runtime_port, env)))
+        if keepalive is not None:
+            if type(keepalive) is not int or keepalive < 1:
+                raise ValueError("keepalive for env {} must be a positive integer, got {!r}".format(env, keepalive))
+            upstream_conf.add(Key('keepalive', str(keepalive)))
         return upstream_conf
 
-    def build_server_conf(self, is_default=False, env=None, server_name_list=[], location_config=None,
-                          default_config_identifier=None, default_port=None, default_root_directory=None):
+    def build_server_conf(self, is_default=False, env=None, server_name_list=None, location_config=None,
+                          default_config_identifier=None, default_port=None, default_root_directory=None,
+                          keepalive=False, settings=None):
         """
         Builds the Nginx server section configuration for the env passed
         :param is_default: is passed as True , will build the config for default server ( env )
@@ -101,8 +771,17 @@ class NginxConfigGenerator:
         :param default_config_identifier: Builds the listen construct for the default catchall runtime port
         :param default_port: Default port value to build default server configuration, applicable only when is_default entry is set to True
         :param default_root_directory: Default path for the default server configuration , applicable only when is_default is set to True
+        :param keepalive: The upstream of the env keeps idle connections, so locations proxy with HTTP/1.1 and without
+                          a Connection: close header to reuse them
+        :param settings: Tuning directives of the env, directive name to value, overriding the http level settings of
+                         the tuning profile for this server
         :return: Server Configuration Object to be added to overall generated Nginx Configuration.
         """
+        unknown = sorted(set(name for name, value in (settings or {}).items() if value is not None) -
+                         SERVER_TUNING_DIRECTIVES)
+        if unknown:
+            raise ValueError("Tuning directives {} of {} are not allowed in a server block, expected any of {}".format(
+                ', '.join(unknown), env, ', '.join(sorted(SERVER_TUNING_DIRECTIVES))))
         server_conf = Server()
 
         if is_default is False:
@@ -116,24 +795,33 @@ class NginxConfigGenerator:
                     )
             else:
                 logger.warning("Server Name for env {} are not set".format(env))
+            # Only the catch all server is the default server of the port, and listen socket options such as
+            # ipv6only may only be set once per port, so they are left to the catch all server as well
             server_conf.add(
-                Key('listen', '[::]:' + str(
-                    self.default_catch_all_map[default_config_identifier]['port']) + 'default_server ipv6only=on'),
-                Key('listen',
-                    '0.0.0.0:' + str(self.default_catch_all_map[default_config_identifier]['port']) + 'default_server'))
+                Key('listen', '[::]:' + str(self.default_catch_all_map[default_config_identifier]['port'])),
+                Key('listen', '0.0.0.0:' + str(self.default_catch_all_map[default_config_identifier]['port'])))
+            for name, value in (settings or {}).items():
+                if value is not None:
+                    server_conf.add(Key(name, directive_value(value)))
 
             if location_config:
                 for key in location_config:
                     loc = Location(key)
                     loc.add(Key('proxy_pass', 'http://' + env)),
+                    if keepalive:
+                        loc.add(Key('proxy_http_version', '1.1'), Key('proxy_set_header', 'Connection ""'))
 
-                    if location_config[key]['ipfilter'] == 'myfilter':
-                        for cidr in self.cidr_filter_list:
-                            loc.add(Key('allow', cidr))
-                    elif location_config[key]['ipfilter'] == 'allowall':
-                        for cidr in self.cidr_allow_all_list:
+                    ipfilter = location_config[key]['ipfilter']
+                    if ipfilter in self.ipfilter_lists() and self.ipfilter_mode == 'geo':
+                        check = make_container('if', '({} = 0)'.format(self.ipfilter_variable(ipfilter)))
+                        check.add(Key('return', '403'))
+                        loc.add(check)
+                    elif ipfilter in self.ipfilter_includes:
+                        loc.add(Key('include', self.ipfilter_includes[ipfilter]))
+                    else:
+                        for cidr in self.ipfilter_lists().get(ipfilter, []):
                             loc.add(Key('allow', cidr))
-                    loc.add(Key('deny', 'all'))
+                        loc.add(Key('deny', 'all'))
 
                     server_conf.add(loc)
             else:
@@ -143,8 +831,8 @@ class NginxConfigGenerator:
             if str(default_port) is None or len(str(default_port)) == 0:
                 logger.warning("Default port not set, Nginx config for default host might now work properly !!")
             server_conf.add(
-                Key('listen', '[::]:' + str(default_port) + 'default_server ipv6only=on'),
-                Key('listen', '0.0.0.0:' + str(default_port) + 'default_server'),
+                Key('listen', '[::]:' + str(default_port) + ' default_server ipv6only=on'),
+                Key('listen', '0.0.0.0:' + str(default_port) + ' default_server'),
                 Key('root', default_root_directory)
             )
             if not server_name_list:
@@ -162,60 +850,105 @@ class NginxConfigGenerator:
         return server_conf
 
 
-if __name__ == "__main__":
+def fetch_inputs(uris, fetch_dir=DEFAULT_FETCH_DIR, concurrency=DEFAULT_FETCH_CONCURRENCY):
     """
-    The Starting block for the program
+    Resolves input locations to local files, fetching http(s) URIs concurrently, see nginx.fetch.fetch_all, and logs
+    how every input was resolved
+    :param uris: Plain paths, file:// URIs or http(s):// URIs of the inputs
+    :param fetch_dir: Directory keeping the fetched copies and their validators
+    :param concurrency: Maximum number of requests in flight
+    :return: List of (local file location, error message) tuples in input order, error message is None on success
     """
-    parser = argparse.ArgumentParser(description='Script to generate Nginx Configuration')
-    parser.add_argument("--input", required=True, help="Location of the input.yaml file to process", type=str)
-    parser.add_argument("--output", required=False,
-                        help="Location where the output nginx donfig would be dumped "
-                             "(this includes the output file name as well",
-                        type=str)
-
-    args = parser.parse_args()
+    start = time.perf_counter()
+    with profile_stage('fetch_inputs') as counts:
+        results = fetch_all(uris, fetch_dir, concurrency)
+        if counts is not None:
+            counts['objects'] = len(uris)
+    resolved = []
+    outcomes = {}
+    for uri, result in zip(uris, results):
+        if isinstance(result, BaseException):
+            resolved.append((None, "{0}: {1}".format(type(result).__name__, result)))
+            outcomes['failed'] = outcomes.get('failed', 0) + 1
+        else:
+            resolved.append((result[0], None))
+            outcomes[result[1]] = outcomes.get(result[1], 0) + 1
+    if any(is_remote_uri(uri) for uri in uris):
+        logger.info("Resolved {} input(s) in {:.1f} ms: {}".format(
+            len(uris), (time.perf_counter() - start) * 1000,
+            ', '.join('{} {}'.format(count, outcome) for outcome, count in sorted(outcomes.items()))))
+    return resolved
 
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
 
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-    stream_handler.setLevel(logging.INFO)
+def load_input(input_path, cache=None):
+    """
+    Reads and parses the input yaml file, with the libyaml based safe loader when available
+    :param input_path: Location of the input yaml file
+    :param cache: ConfigCache holding parsed inputs by file content hash, None always parses the yaml
+    :return: Parsed yaml data as dict
+    """
+    start = time.perf_counter()
+    with profile_stage('load_input') as counts:
+        with open(input_path, "rb") as file:
+            raw = file.read()
 
-    logger.addHandler(stream_handler)
+        data = None
+        source = 'parsed with {}'.format(SafeLoader.__name__)
+        if cache is not None:
+            key = hashlib.sha256(SafeLoader.__name__.encode('utf-8') + b'\0' + raw).hexdigest()
+            data = cache.get_parsed(key)
+            if data is not None:
+                source = 'from the input cache'
+        if data is None:
+            logger.info("Parsing the provided yaml configuration")
+            data = yaml.load(raw, Loader=SafeLoader)
+            if cache is not None:
+                cache.put_parsed(key, data)
+        if counts is not None:
+            counts['objects'] = len(data.get('app') or {})
+            counts['lines'] = raw.count(b'\n')
 
-    logger.info("Reading Yaml file from location {}".format(args.input))
+    logger.info("Loaded input {} ({} bytes) in {:.1f} ms, {}".format(
+        input_path, len(raw), (time.perf_counter() - start) * 1000, source))
+    return data
 
-    if not args.output:
-        logger.warning("Output location not specified , will be storing the generated nginx under resources folder")
-    else:
-        logger.info(
-            "Output location specified as {}, will be used to store the generate Nginx file".format(args.output))
-
-    try:
-        with open(args.input, "r") as file:
-            logger.info("Parsing the provided yaml configuration")
-            data = yaml.load(file, Loader=yaml.FullLoader)
-    except Exception as ex:
-        logger.error("An exception of type '{0}' occurred.".format(type(ex).__name__))
-        exit(1)
 
+def init_generator(data, ipfilter_mode='inline', aggregate=True):
+    """
+    Creates the Nginx Config Generator for the parsed input and loads its IP filters and catch all configuration
+    :param data: Parsed yaml data as dict
+    :param ipfilter_mode: One of IPFILTER_MODES
+    :param aggregate: Deduplicate and collapse the ipfilter CIDR lists
+    :return: NginxConfigGenerator object
+    """
     logger.info("Initializing the Nginx Config Generator")
 
-    ng = NginxConfigGenerator(data)
+    ng = NginxConfigGenerator(data, ipfilter_mode, aggregate)
 
     logger.info("Initializing the  IP Filters from provided yaml files")
-    ng.build_ip_filters()
+    with profile_stage('build_ip_filters') as counts:
+        ng.build_ip_filters()
+        if counts is not None:
+            counts['objects'] = len(ng.cidr_filter_list)
 
     logger.info("Initializing the allowed IP CIDR List")
-    ng.build_allow_all_ip_list()
+    with profile_stage('build_allow_all_ip_list') as counts:
+        ng.build_allow_all_ip_list()
+        if counts is not None:
+            counts['objects'] = len(ng.cidr_allow_all_list)
 
     logger.info("Initializing the default catch all configuration")
-    ng.build_default_catch_all_map()
+    with profile_stage('build_default_catch_all_map'):
+        ng.build_default_catch_all_map()
+    return ng
 
-    c = Conf()
 
+def build_default_server(ng):
+    """
+    Builds the default (catch all) server section of the Nginx configuration
+    :param ng: Initialized NginxConfigGenerator
+    :return: Server Configuration Object for the default server
+    """
     # Building Default server configuration
     default_path_map = {
         '/': {
@@ -227,41 +960,1189 @@ if __name__ == "__main__":
     default_root_dir = "/var/www"
     logger.info("Using the default root dir path as {}".format(default_root_dir))
 
-    upstream_default_host = "127.0.0.1"
-    logger.info("Using the upstream section for default host")
-
     server_name_list = []
 
-    runtime_port = data['catchall']['default']['port']
+    runtime_port = ng.data['catchall']['default']['port']
     logger.info("Using the Runtime port value as {}".format(runtime_port))
 
     logger.info('Building the default server section for the Nginx configuration with '
                 'location config as {} , default port as {} and default root directory as {}'.
                 format(default_path_map, runtime_port, default_root_dir))
-    c.add(ng.build_server_conf(is_default=True, server_name_list=server_name_list, location_config=default_path_map,
-                               default_port=runtime_port, default_root_directory=default_root_dir))
-
-    for item in data['app'].keys():
-        runtime_port = data['app'][item]['runtime_port']
-        fdqn_list = data['app'][item]['fqdn']
-        path_map = data['app'][item]['path_based_access_restriction']
-        catch_all_config_identifier = data['app'][item]['catchall']
-
-        c.add(ng.build_upstream_conf(env=item, runtime_port=runtime_port, upstream_default_host=upstream_default_host))
-        c.add(ng.build_server_conf(is_default=False, env=item, server_name_list=fdqn_list,
-                                   location_config=path_map,
-                                   default_config_identifier=catch_all_config_identifier))
-
-    file_handler = None
-    output_path = None
-    if args.output:
-        output_path = args.output
-        file_handler = open(args.output, "w")
+    return ng.build_server_conf(is_default=True, server_name_list=server_name_list, location_config=default_path_map,
+                                default_port=runtime_port, default_root_directory=default_root_dir)
+
+
+def build_app_conf(ng, item, upstream_default_host=DEFAULT_UPSTREAM_HOST):
+    """
+    Builds the upstream and server sections for one app entry of the input
+    :param ng: Initialized NginxConfigGenerator
+    :param item: Name of the app entry ( env ) under the app section of the input
+    :param upstream_default_host: Host the upstream server entry points to when the app entry lists no backends and
+                                  sets no upstream_host
+    :return: List of the Upstream and Server Configuration Objects for the app
+    """
+    app = ng.data['app'][item]
+    runtime_port = app.get('runtime_port')
+    fdqn_list = app['fqdn']
+    path_map = app['path_based_access_restriction']
+    catch_all_config_identifier = app['catchall']
+    keepalive = app.get('keepalive')
+
+    return [ng.build_upstream_conf(env=item, runtime_port=runtime_port,
+                                   upstream_default_host=app.get('upstream_host') or upstream_default_host,
+                                   backends=app.get('backends'), balancing=app.get('balancing'), keepalive=keepalive),
+            ng.build_server_conf(is_default=False, env=item, server_name_list=fdqn_list,
+                                 location_config=path_map,
+                                 default_config_identifier=catch_all_config_identifier,
+                                 keepalive=keepalive is not None, settings=app.get('tuning'))]
+
+
+def build_conf(data, ipfilter_mode='inline', aggregate=True):
+    """
+    Builds the complete Nginx configuration for the parsed input
+    :param data: Parsed yaml data as dict
+    :param ipfilter_mode: One of IPFILTER_MODES
+    :param aggregate: Deduplicate and collapse the ipfilter CIDR lists
+    :return: Conf object holding the generated Nginx configuration
+    """
+    with profile_stage('build_conf') as conf_counts:
+        ng = init_generator(data, ipfilter_mode, aggregate)
+
+        c = Conf()
+        # The configuration sections go into the http block of the tuning section, when there is one
+        top = c
+        tuning = ng.build_tuning_conf()
+        if tuning is not None:
+            c.add(*tuning)
+            top = tuning[-1]
+        if ipfilter_mode == 'geo':
+            with profile_stage('build_ipfilter_conf'):
+                top.add(*ng.build_ipfilter_conf())
+        with profile_stage('build_default_server'):
+            top.add(build_default_server(ng))
+
+        for item in data['app'].keys():
+            with profile_stage('app:' + item) as counts:
+                blocks = build_app_conf(ng, item)
+                if counts is not None:
+                    counts['objects'] = sum(count_directives(block) + 1 for block in blocks)
+            top.add(*blocks)
+        if conf_counts is not None:
+            conf_counts['objects'] = count_directives(c)
+    return c
+
+
+def render(data, ipfilter_mode='inline', aggregate=True):
+    """
+    Renders the Nginx configuration for parsed input, without touching the file system or any cache. Safe to call
+    concurrently from several threads as long as the input is not modified while rendering
+    :param data: Parsed yaml data as dict
+    :param ipfilter_mode: One of IPFILTER_MODES
+    :param aggregate: Deduplicate and collapse the ipfilter CIDR lists
+    :return: Conf object holding the generated Nginx configuration
+    """
+    return build_conf(data, ipfilter_mode, aggregate)
+
+
+def render_to(data, fobj, ipfilter_mode='inline', aggregate=True):
+    """
+    Renders the Nginx configuration for parsed input and streams it to a file object, see render
+    :param data: Parsed yaml data as dict
+    :param fobj: Text file object the configuration is written to
+    :param ipfilter_mode: One of IPFILTER_MODES
+    :param aggregate: Deduplicate and collapse the ipfilter CIDR lists
+    :return: Conf object holding the generated Nginx configuration
+    """
+    c = build_conf(data, ipfilter_mode, aggregate)
+    dump(c, fobj)
+    return c
+
+
+def load_manifest(manifest_path):
+    """
+    Reads the incremental regeneration manifest written by a previous run. The manifest is a single file holding the
+    rendered section texts, followed by the pickled index of the sections and the offset of that index
+    :param manifest_path: Location of the manifest file
+    :return: Tuple of ( index as dict, manifest content as bytes, offset of the index ). The index is empty and the
+             content None when the manifest is missing, unreadable or written by another generator version
+    """
+    try:
+        with open(manifest_path, "rb") as f:
+            content = f.read()
+        offset, = MANIFEST_TRAILER.unpack_from(content, len(content) - MANIFEST_TRAILER.size)
+        manifest = pickle.loads(content[offset:-MANIFEST_TRAILER.size])
+    except (IOError, OSError, struct.error, EOFError, ValueError, pickle.UnpicklingError):
+        return {}, None, 0
+    if not isinstance(manifest, dict) or manifest.get('version') != generator_version():
+        return {}, None, 0
+    return manifest, content, offset
+
+
+def save_manifest(manifest_path, sections, texts, append_at=None):
+    """
+    Writes the incremental regeneration manifest, see load_manifest. With append_at, the texts are appended to the
+    texts of the current manifest in place of its index, so that the texts of unchanged sections are not written again;
+    a run interrupted meanwhile leaves a manifest that reads as empty, and the next run rebuilds every section. Without,
+    the manifest is written anew and replaces the previous one atomically
+    :param manifest_path: Location of the manifest file
+    :param sections: Section name to manifest entry dict, in output order
+    :param texts: List of ( manifest entry, text ) tuples of the texts to write, the entries get the span of the text
+    :param append_at: Offset of the index of the current manifest, see load_manifest
+    :return: None
+    """
+    if append_at is None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_path)), suffix='.tmp')
+        f = os.fdopen(fd, "wb")
     else:
+        f = open(manifest_path, "r+b")
+        f.seek(append_at)
+    with f:
+        for entry, text in texts:
+            encoded = text.encode('utf-8')
+            entry['span'] = (f.tell(), len(encoded))
+            f.write(encoded)
+        offset = f.tell()
+        pickle.dump({'version': generator_version(), 'sections': sections}, f, pickle.HIGHEST_PROTOCOL)
+        f.write(MANIFEST_TRAILER.pack(offset))
+        f.truncate()
+    if append_at is None:
+        os.replace(tmp_path, manifest_path)
+
+
+def section_builders(ng, sharded=False):
+    """
+    Lists the sections the Nginx configuration is built from, in output order
+    :param ng: Initialized NginxConfigGenerator
+    :param sharded: One section per ipfilter, see NginxConfigGenerator.build_ipfilter_shard, instead of one section
+                    holding all geo blocks in geo mode
+    :return: List of ( section, item, build ) tuples, build returns the list of Configuration Objects of the section
+    """
+    builders = []
+    if sharded:
+        for name in sorted(ng.ipfilter_lists()):
+            builders.append(('ipfilter', name, lambda name=name: ng.build_ipfilter_shard(name)))
+    elif ng.ipfilter_mode == 'geo':
+        builders.append(('ipfilter', None, ng.build_ipfilter_conf))
+    builders.append(('default', None, lambda: [build_default_server(ng)]))
+    for item in ng.data['app'].keys():
+        builders.append(('app', item, lambda item=item: build_app_conf(ng, item)))
+    return builders
+
+
+def render_sections(ng, builders, manifest_path=None, nested=False, validate=False):
+    """
+    Renders the text of every section, reusing the text rendered by the run that wrote the manifest for the sections
+    whose inputs did not change since. The manifest holds the inputs and their hash for every section, the texts are
+    kept in a single section store file next to it ( see section_store_for ), read once and appended only the texts of
+    the rebuilt sections. The store is written anew once the texts no longer used take more room than the others. With
+    validate, the validation records of every section ( see nginx.validator.summarize ) are collected from the built
+    objects and kept in the manifest, so that the output is validated without parsing it again
+    :param ng: Initialized NginxConfigGenerator
+    :param builders: Sections as listed by section_builders
+    :param manifest_path: Location of the manifest holding per section input hashes, None renders every section
+    :param nested: Render the sections as the content of a top level block ( the http block of the tuning section )
+    :param validate: Also collect the validation records of every section
+    :return: List of ( section name, text, validation records ) tuples in output order, the records are None without
+             validate
+    """
+    manifest, content, texts_end = load_manifest(manifest_path) if manifest_path else ({}, None, 0)
+    previous_sections = manifest.get('sections', {})
+    sections = {}
+    rendered = []
+    rebuilt = []
+    changed = False
+
+    for section, item, build in builders:
+        name = section if item is None else section + ':' + item
+        entry = previous_sections.get(name)
+        text = None
+        if manifest_path:
+            inputs = ng.section_inputs(section, item, nested)
+            # Comparing the inputs is much cheaper than hashing them, unchanged sections are not hashed again
+            if entry is not None and entry['inputs'] == inputs:
+                section_hash = entry['hash']
+            else:
+                section_hash = ng.inputs_hash(inputs)
+        if entry is not None and entry['hash'] == section_hash and (not validate or 'summary' in entry):
+            offset, length = entry['span']
+            text = content[offset:offset + length].decode('utf-8')
+            summary = entry.get('summary') if validate else None
+            if entry['inputs'] != inputs:
+                entry['inputs'] = inputs
+                changed = True
+            sections[name] = entry
+        if text is None:
+            with profile_stage(name) as counts:
+                blocks = build()
+                if nested:
+                    # Blocks end with a blank line like at the top level, join_sections drops the last one
+                    text = dumps(Conf(*blocks), 0) + '\n'
+                else:
+                    text = ''.join(dumps(block) for block in blocks)
+                summary = summarize(Conf(*blocks), 'http' if nested else '') if validate else None
+                if counts is not None:
+                    counts['lines'] = text.count('\n')
+            if manifest_path:
+                sections[name] = {'hash': section_hash, 'inputs': inputs}
+                if summary is not None:
+                    sections[name]['summary'] = summary
+                rebuilt.append((sections[name], text))
+        rendered.append((name, text, summary))
+
+    if manifest_path:
+        logger.info("Incremental regeneration: rebuilt {} of {} section(s)".format(len(rebuilt), len(builders)))
+        live = sum(entry['span'][1] for entry in sections.values() if 'span' in entry)
+        if content is None or texts_end - live > live:
+            # The texts of the sections that changed or are gone take more room than the current ones, start over
+            save_manifest(manifest_path, sections, [(sections[name], text) for name, text, summary in rendered])
+        elif changed or rebuilt or sections.keys() != previous_sections.keys():
+            save_manifest(manifest_path, sections, rebuilt, texts_end)
+    return rendered
+
+
+def join_sections(texts):
+    """
+    Joins rendered sections into one configuration text
+    :param texts: Rendered section texts in output order
+    :return: Nginx configuration as string
+    """
+    # Top level blocks are separated by a blank line, except after the last one
+    text = ''.join(texts)
+    if text.endswith('}\n\n'):
+        text = text[:-1]
+    return text
+
+
+def render_incremental(data, manifest_path, ipfilter_mode='inline', aggregate=True, validate=False):
+    """
+    Renders the complete Nginx configuration, rebuilding only the sections whose inputs changed since the run that
+    wrote the manifest and reusing the previously rendered text for the others
+    :param data: Parsed yaml data as dict
+    :param manifest_path: Location of the manifest holding per section input hashes, see render_sections
+    :param ipfilter_mode: One of IPFILTER_MODES
+    :param aggregate: Deduplicate and collapse the ipfilter CIDR lists
+    :param validate: Validate the configuration from the validation records of its sections, see render_sections
+    :return: Generated Nginx configuration as string
+    :raises nginx.validator.ValidationError: With validate, when the configuration has errors
+    """
+    ng = init_generator(data, ipfilter_mode, aggregate)
+    tuning = ng.build_tuning_conf()
+    sections = render_sections(ng, section_builders(ng), manifest_path, nested=tuning is not None, validate=validate)
+    if validate:
+        validate_sections([summary for name, text, summary in sections])
+    text = join_sections(text for name, text, summary in sections)
+    if tuning is None:
+        return text
+    # The http block is the last block of the tuning section, the sections go in front of its closing brace
+    head = dumps(Conf(*tuning))
+    return head[:-len('}\n')] + text + '}\n'
+
+
+class GenerationOptions:
+    """
+    Options controlling how configurations are generated and written, shared by single and batch runs
+    """
+
+    def __init__(self, cache=None, incremental=False, ipfilter_mode='inline', aggregate=True, cache_inputs=False,
+                 fetch_dir=DEFAULT_FETCH_DIR, fetch_concurrency=DEFAULT_FETCH_CONCURRENCY, keep_versions=0,
+                 validate=True, sharded=False, shard_jobs=DEFAULT_SHARD_JOBS):
+        """
+        Initialize object.
+        :param cache: ConfigCache to reuse previously generated output from, None disables caching
+        :param incremental: Rebuild only the sections whose inputs changed, see render_incremental
+        :param ipfilter_mode: One of IPFILTER_MODES
+        :param aggregate: Deduplicate and collapse the ipfilter CIDR lists
+        :param cache_inputs: Also keep parsed inputs in the cache, so that unchanged inputs skip yaml parsing
+        :param fetch_dir: Directory keeping copies of inputs fetched from http(s) URIs
+        :param fetch_concurrency: Maximum number of input fetches in flight
+        :param keep_versions: Also keep a timestamped copy of every changed output, retaining this many, 0 disables
+        :param validate: Check generated configurations with nginx.validator, outputs with errors are not written
+        :param sharded: Write a root file including one file per section instead of a single file, see render_sharded
+        :param shard_jobs: Number of threads writing the shards
+        """
+        self.cache = cache
+        self.cache_inputs = cache_inputs
+        self.fetch_dir = fetch_dir
+        self.fetch_concurrency = fetch_concurrency
+        self.incremental = incremental
+        self.ipfilter_mode = ipfilter_mode
+        self.aggregate = aggregate
+        self.keep_versions = keep_versions
+        self.validate = validate
+        self.sharded = sharded
+        self.shard_jobs = shard_jobs
+
+
+def generate_file(input_path, output_path, options=None):
+    """
+    Generates the Nginx configuration for one input file
+    :param input_path: Location of the input yaml file
+    :param output_path: Location where the generated Nginx configuration is written
+    :param options: GenerationOptions, defaults apply when None
+    :return: 'hit' or 'miss' for the cache lookup, None when caching is disabled
+    """
+    logger.info("Reading Yaml file from location {}".format(input_path))
+    options = options or GenerationOptions()
+    data = load_input(input_path, options.cache if options.cache_inputs else None)
+    return generate_data(data, output_path, options)
+
+
+def manifest_path_for(output_path):
+    """
+    Builds the location of the incremental regeneration manifest kept next to an output file
+    :param output_path: Location of the generated Nginx configuration
+    :return: Location of the manifest file
+    """
+    return output_path + '.manifest'
+
+
+def render_output(data, output_path, options):
+    """
+    Renders the Nginx configuration for parsed input and writes it to the location specified
+    :param data: Parsed yaml data as dict
+    :param output_path: Location where the generated Nginx configuration is written
+    :param options: GenerationOptions
+    :return: Location of the generated Nginx configuration
+    :raises nginx.validator.ValidationError: When validation is enabled and the configuration has errors, the output
+                                             is not written then
+    """
+    if options.sharded:
+        return render_sharded(data, output_path, options)
+    if options.incremental:
+        text = render_incremental(data, manifest_path_for(output_path), options.ipfilter_mode, options.aggregate,
+                                  options.validate)
+        return write_text(text, output_path, options.keep_versions)
+    c = build_conf(data, options.ipfilter_mode, options.aggregate)
+    if options.validate:
+        validate_conf(c)
+    return write_conf(c, output_path, options.keep_versions)
+
+
+def validate_conf(c):
+    """
+    Validates the generated Nginx configuration, see nginx.validator, logging warnings and errors
+    :param c: Conf object holding the generated Nginx configuration
+    :return: List of warnings
+    :raises nginx.validator.ValidationError: When the configuration has errors
+    """
+    return report_validation(lambda: check(c))
+
+
+def validate_sections(summaries):
+    """
+    Validates the generated Nginx configuration from the validation records of its sections, see render_sections,
+    logging warnings and errors
+    :param summaries: Validation records of every section, in output order
+    :return: List of warnings
+    :raises nginx.validator.ValidationError: When the configuration has errors
+    """
+    return report_validation(lambda: check_summaries(summaries))
+
+
+def report_validation(run_check):
+    """
+    Runs a validation, logging the warnings and errors it finds
+    :param run_check: Callable returning the list of warnings, raising nginx.validator.ValidationError on errors
+    :return: List of warnings
+    :raises nginx.validator.ValidationError: When the configuration has errors
+    """
+    with profile_stage('validate') as counts:
+        try:
+            warnings = run_check()
+        except ValidationError as ex:
+            for problem in ex.problems:
+                logger.error(str(problem))
+            raise
+        if counts is not None:
+            counts['objects'] = len(warnings)
+    for problem in warnings:
+        logger.warning(str(problem))
+    return warnings
+
+
+SHARD_NAME_RE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def shard_dir_for(output_path):
+    """
+    Builds the location of the directory holding the shards of a sharded output, next to its root file
+    :param output_path: Location of the root file of the generated Nginx configuration
+    :return: Location of the shard directory, <output without extension>.d
+    """
+    return os.path.splitext(os.path.abspath(output_path))[0] + '.d'
+
+
+def shard_path_for(shard_dir, name):
+    """
+    Builds the location of the shard holding one section
+    :param shard_dir: Shard directory, see shard_dir_for
+    :param name: Section name as returned by render_sections, e.g. app:production
+    :return: Location of the shard, e.g. <shard_dir>/app-production.conf
+    """
+    return os.path.join(shard_dir, SHARD_NAME_RE.sub('_', name.replace(':', '-', 1)) + '.conf')
+
+
+def read_includes(root_path):
+    """
+    Lists the files a previously written root file of a sharded output includes, at the top level or within the http
+    block of the tuning section
+    :param root_path: Location of the root file
+    :return: List of included locations, empty when the root file is missing or unreadable
+    """
+    try:
+        with open(root_path, 'r') as f:
+            root = loads(f.read())
+    except (IOError, OSError, ValueError):
+        return []
+    nodes = list(root.children)
+    for http in [x for x in root.children if isinstance(x, Http)]:
+        nodes.extend(http.children)
+    return [key.value for key in nodes if isinstance(key, Key) and key.name == 'include']
+
+
+def write_shard(text, shard_path, keep_versions=0):
+    """
+    Writes one shard atomically, comparing it with the current content in memory first so that unchanged shards cost a
+    read and no write
+    :param text: Rendered shard content
+    :param shard_path: Location of the shard
+    :param keep_versions: Also keep a timestamped copy of a changed shard, retaining this many
+    :return: True when the shard was written, False when it was already up to date
+    """
+    content = text.encode('utf-8')
+    try:
+        if os.path.getsize(shard_path) == len(content):
+            with open(shard_path, 'rb') as f:
+                if f.read() == content:
+                    return False
+    except OSError:
+        pass
+    return write_atomic(shard_path, lambda file_handler: file_handler.write(text), keep_versions)
+
+
+def render_sharded(data, output_path, options):
+    """
+    Renders the Nginx configuration as one shard per section ( every app, the default server and every ipfilter ) in
+    the shard directory, see shard_dir_for, and a root file at the output location including them. Shards are written
+    concurrently and only when their content changed, so that the I/O and the data to sync after a change scale with
+    the change instead of the number of apps. Shards are written before the root file, shards the root file no longer
+    includes are removed after it
+    :param data: Parsed yaml data as dict
+    :param output_path: Location of the root file
+    :param options: GenerationOptions
+    :return: Location of the root file
+    :raises nginx.validator.ValidationError: When validation is enabled and the configuration has errors, nothing is
+                                             written then
+    """
+    shard_dir = shard_dir_for(output_path)
+    ng = init_generator(data, options.ipfilter_mode, options.aggregate)
+    builders = section_builders(ng, sharded=True)
+    if options.ipfilter_mode == 'inline':
+        ng.ipfilter_includes = dict((item, shard_path_for(shard_dir, section + ':' + item))
+                                    for section, item, build in builders if section == 'ipfilter')
+    manifest_path = manifest_path_for(output_path) if options.incremental else None
+    sections = render_sections(ng, builders, manifest_path, validate=options.validate)
+    shards = [(shard_path_for(shard_dir, name), text) for name, text, summary in sections]
+    if len(set(path for path, text in shards)) != len(shards):
+        raise ValueError("App names map to the same shard file name in {}".format(shard_dir))
+    # Inline ipfilter shards are included by the locations, at the top level their allow and deny rules would apply to
+    # every location without rules of its own
+    snippets = set(ng.ipfilter_includes.values())
+    included = [(path, text) for path, text in shards if path not in snippets]
+    if options.validate:
+        validate_sections([section[2] for (path, text), section in zip(shards, sections) if path not in snippets])
+
+    os.makedirs(shard_dir, exist_ok=True)
+    with profile_stage('write_shards') as counts:
+        with ThreadPoolExecutor(max_workers=max(1, options.shard_jobs)) as pool:
+            written = list(pool.map(lambda shard: write_shard(join_sections([shard[1]]), shard[0],
+                                                              options.keep_versions), shards))
+        if counts is not None:
+            counts['objects'] = sum(written)
+    logger.info("Sharded output: wrote {} of {} shard(s) in {}".format(sum(written), len(shards), shard_dir))
+
+    previous = read_includes(output_path)
+    includes = [Key('include', path) for path, text in included]
+    tuning = ng.build_tuning_conf()
+    if tuning is not None:
+        tuning[-1].add(*includes)
+        root = Conf(*tuning)
+    else:
+        root = Conf(*includes)
+    write_text(dumps(root), output_path, options.keep_versions)
+    current = set(path for path, text in shards)
+    for path in previous:
+        # Only ever remove shards this generator wrote
+        if path not in current and os.path.dirname(path) == shard_dir and os.path.exists(path):
+            os.unlink(path)
+            logger.info("Removed shard {}, its section is gone".format(path))
+    return output_path
+
+
+def generate_data(data, output_path, options=None):
+    """
+    Generates the Nginx configuration for parsed input, reusing cached output when the input is unchanged
+    :param data: Parsed yaml data as dict
+    :param output_path: Location where the generated Nginx configuration is written
+    :param options: GenerationOptions, defaults apply when None
+    :return: 'hit' or 'miss' for the cache lookup, None when caching is disabled
+    """
+    options = options or GenerationOptions()
+    cache = options.cache
+    # The cache holds single file outputs only
+    if cache is None or options.sharded:
+        render_output(data, output_path, options)
+        return None
+
+    with profile_stage('cache_lookup'):
+        key = NginxConfigGenerator(data, options.ipfilter_mode, options.aggregate).content_hash()
+        cached_path = cache.get(key)
+    if cached_path is None:
+        logger.info("Cache miss for input hash {}".format(key[:12]))
+        render_output(data, output_path, options)
+        # Only validated outputs are cached, so cache hits never skip validation
+        if options.validate:
+            cache.put(key, output_path)
+        return 'miss'
+
+    logger.info("Cache hit for input hash {}".format(key[:12]))
+    if os.path.exists(output_path) and filecmp.cmp(cached_path, output_path, shallow=False):
+        logger.info('Generated Nginx Configuration at {} is up to date, not rewriting it'.format(output_path))
+    else:
+        def copy(file_handler):
+            with open(cached_path, 'r') as cached:
+                shutil.copyfileobj(cached, file_handler)
+        if write_atomic(output_path, copy, options.keep_versions):
+            logger.info('Generated Nginx Configuration is present location {}'.format(output_path))
+    return 'hit'
+
+
+def file_digest(path):
+    """
+    Computes the sha256 digest of a file, reading it in chunks
+    :param path: Location of the file
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_atomic(output_path, write, keep_versions=0):
+    """
+    Writes a file atomically: the content goes to a temporary file in the same directory, which is fsynced and then
+    renamed over the output, so readers never see a partially written file. When the output already holds the same
+    content ( compared by hash ) it is left untouched, keeping its modification time. A symlinked output keeps its
+    link, the file it points to is replaced
+    :param output_path: Location of the file to write
+    :param write: Callable writing the content to the text file object it receives
+    :param keep_versions: Also keep a timestamped copy of the new content, retaining this many, 0 disables
+    :return: True when the output was written, False when it was already up to date
+    """
+    # Replace the file a symlinked output points to, renaming over the link would turn it into a regular file
+    output_path = os.path.realpath(output_path)
+    directory = os.path.dirname(output_path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(output_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file_handler:
+            write(file_handler)
+            file_handler.flush()
+            os.fsync(file_handler.fileno())
+
+        if os.path.exists(output_path):
+            if os.path.getsize(output_path) == os.path.getsize(tmp_path) and \
+                    file_digest(output_path) == file_digest(tmp_path):
+                os.unlink(tmp_path)
+                logger.info('Generated Nginx Configuration at {} is up to date, not rewriting it'.format(output_path))
+                return False
+            os.chmod(tmp_path, os.stat(output_path).st_mode & 0o7777)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    # Persist the rename itself
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+    if keep_versions > 0:
+        save_version(output_path, keep_versions)
+    return True
+
+
+VERSION_SUFFIX_RE = re.compile(r'\.\d{8}-\d{6}-\d{6}$')
+
+
+def list_versions(output_path):
+    """
+    Lists the timestamped copies of an output file kept by save_version
+    :param output_path: Location of the generated Nginx configuration
+    :return: Locations of the copies, oldest first
+    """
+    directory = os.path.dirname(os.path.abspath(output_path))
+    base = os.path.basename(output_path)
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.startswith(base) and VERSION_SUFFIX_RE.match(name[len(base):]))
+
+
+def save_version(output_path, keep_versions):
+    """
+    Keeps a timestamped copy ( <output>.<YYYYmmdd-HHMMSS-ffffff> ) of an output file and removes the oldest copies
+    beyond the retention. The suffix keeps the copies out of nginx include patterns like *.conf
+    :param output_path: Location of the generated Nginx configuration
+    :param keep_versions: Number of copies to retain
+    :return: Location of the new copy
+    """
+    version_path = '{}.{}'.format(output_path, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+    try:
+        # The output is only ever replaced by a rename, so a hard link keeps this content
+        os.link(output_path, version_path)
+    except OSError:
+        shutil.copy2(output_path, version_path)
+    logger.info('Saved version {} of the generated Nginx Configuration'.format(version_path))
+
+    for old_path in list_versions(output_path)[:-keep_versions]:
+        os.unlink(old_path)
+        logger.info('Removed old version {}'.format(old_path))
+    return version_path
+
+
+def write_conf(c, output_path, keep_versions=0):
+    """
+    Writes the generated Nginx configuration to the location specified, atomically and only when it changed
+    :param c: Conf object holding the generated Nginx configuration
+    :param output_path: Location where the generated Nginx configuration is written
+    :param keep_versions: Also keep a timestamped copy of a changed configuration, retaining this many
+    :return: Location of the generated Nginx configuration
+    """
+    with profile_stage('dump') as counts:
+        written = write_atomic(output_path, lambda file_handler: dump(c, file_handler), keep_versions)
+    if counts is not None:
+        with open(output_path, "rb") as f:
+            counts['lines'] = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 16), b''))
+
+    if written:
+        logger.info('Generated Nginx Configuration is present location {}'.format(output_path))
+    return output_path
+
+
+def write_text(text, output_path, keep_versions=0):
+    """
+    Writes already rendered Nginx configuration text to the location specified, atomically and only when it changed
+    :param text: Generated Nginx configuration as string
+    :param output_path: Location where the generated Nginx configuration is written
+    :param keep_versions: Also keep a timestamped copy of a changed configuration, retaining this many
+    :return: Location of the generated Nginx configuration
+    """
+    with profile_stage('write') as counts:
+        written = write_atomic(output_path, lambda file_handler: file_handler.write(text), keep_versions)
+        if counts is not None:
+            counts['lines'] = text.count('\n')
+
+    if written:
+        logger.info('Generated Nginx Configuration is present location {}'.format(output_path))
+    return output_path
+
+
+def _generate_file_task(input_path, output_path, options=None):
+    """
+    Process pool task wrapping generate_file, reports failures instead of raising them
+    :param input_path: Location of the input yaml file
+    :param output_path: Location where the generated Nginx configuration is written
+    :param options: GenerationOptions, defaults apply when None
+    :return: Tuple of input path, output path, error message ( None on success ) and cache outcome
+    """
+    try:
+        outcome = generate_file(input_path, output_path, options)
+    except Exception as ex:
+        return input_path, output_path, "{0}: {1}".format(type(ex).__name__, ex), None
+    return input_path, output_path, None, outcome
+
+
+def list_input_files(input_dir):
+    """
+    Lists the yaml input files present in a directory
+    :param input_dir: Directory holding the input yaml files
+    :return: Sorted list of input file paths
+    """
+    return sorted(os.path.join(input_dir, name) for name in os.listdir(input_dir)
+                  if name.endswith(('.yaml', '.yml')))
+
+
+def output_path_for(input_path, output_dir):
+    """
+    Builds the output file location for an input file in batch mode
+    :param input_path: Location or URI of the input yaml file
+    :param output_dir: Directory where the generated Nginx configurations are written
+    :return: Output file location, the input file name with a .conf extension
+    """
+    if is_remote_uri(input_path) or input_path.startswith('file:'):
+        input_path = urllib.parse.urlsplit(input_path).path
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(output_dir, name + '.conf')
+
+
+def batch_output_paths(input_paths, output_dir):
+    """
+    Builds the output file locations for the inputs of a batch, see output_path_for, making sure no two inputs write
+    the same output
+    :param input_paths: Locations or URIs of the input yaml files
+    :param output_dir: Directory where the generated Nginx configurations are written
+    :return: List of output file locations, in input order
+    :raises ValueError: When two inputs map to the same output file, e.g. a/x.yaml and b/x.yaml
+    """
+    output_paths = [output_path_for(input_path, output_dir) for input_path in input_paths]
+    seen = {}
+    for index, output_path in enumerate(output_paths):
+        first = seen.setdefault(os.path.normcase(os.path.abspath(output_path)), index)
+        if first != index:
+            raise ValueError("Inputs {} and {} would both be written to {}".format(
+                input_paths[first], input_paths[index], output_path))
+    return output_paths
+
+
+def generate_batch(input_paths, output_dir, jobs=None, options=None):
+    """
+    Generates the Nginx configuration for every input file using a pool of processes. Inputs given as http(s) URIs are
+    fetched concurrently beforehand
+    :param input_paths: Locations or URIs of the input yaml files
+    :param output_dir: Directory where the generated Nginx configurations are written
+    :param jobs: Number of worker processes, defaults to the number of CPUs
+    :param options: GenerationOptions, defaults apply when None
+    :return: List of (input path, output path, error message, cache outcome) tuples, error message is None on success
+    :raises ValueError: When two inputs map to the same output file, nothing is generated then
+    """
+    output_paths = batch_output_paths(input_paths, output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    options = options or GenerationOptions()
+    resolved = fetch_inputs(input_paths, options.fetch_dir, options.fetch_concurrency)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=setup_logging) as executor:
+        futures = []
+        for output_path, (local_path, error) in zip(output_paths, resolved):
+            if error is None:
+                futures.append(executor.submit(_generate_file_task, local_path, output_path, options))
+            else:
+                futures.append(None)
+        results = []
+        for uri, output_path, (local_path, error), future in zip(input_paths, output_paths, resolved, futures):
+            if future is None:
+                results.append((uri, output_path, error, None))
+            else:
+                results.append((uri,) + future.result()[1:])
+        return results
+
+
+def report_batch(results):
+    """
+    Logs the per file outcome of a batch run
+    :param results: List of (input path, output path, error message, cache outcome) tuples as returned by
+                    generate_batch
+    :return: Number of failed files
+    """
+    failed = 0
+    for input_path, output_path, error, outcome in results:
+        if error is None:
+            logger.info("OK     {} -> {}{}".format(input_path, output_path,
+                                                   ' (cached)' if outcome == 'hit' else ''))
+        else:
+            failed += 1
+            logger.error("FAILED {}: {}".format(input_path, error))
+    logger.info("Batch finished: {} succeeded, {} failed".format(len(results) - failed, failed))
+    if any(outcome is not None for _, _, _, outcome in results):
+        log_cache_counters(sum(1 for result in results if result[3] == 'hit'),
+                           sum(1 for result in results if result[3] == 'miss'))
+    return failed
+
+
+def log_cache_counters(hits, misses):
+    """
+    Logs the cache hit/miss counters of a run
+    :param hits: Number of cache hits
+    :param misses: Number of cache misses
+    :return: None
+    """
+    logger.info("Cache hits: {}, misses: {}".format(hits, misses))
+
+
+def make_watcher(paths, polling=False, poll_interval=0.05):
+    """
+    Creates an inotify watcher for the files, or a polling one when inotify is not available or polling is requested
+    :param paths: Locations of the files to watch
+    :param polling: Always poll
+    :param poll_interval: Seconds between two checks of the polling watcher
+    :return: InotifyWatcher or PollingWatcher
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as ex:
+            logger.warning("inotify is not available ({}), falling back to polling".format(ex))
+    return PollingWatcher(paths, poll_interval)
+
+
+def output_signature(output_path, sharded=False):
+    """
+    Identifies the current content of an output. Outputs are only replaced by a rename when their content changes,
+    see write_atomic, so the inode and modification time change exactly when the content does
+    :param output_path: Location of the generated Nginx configuration
+    :param sharded: Also cover the shards of a sharded output, see render_sharded
+    :return: Tuple of inode and modification time, None when the output does not exist
+    """
+    try:
+        st = os.stat(output_path)
+    except OSError:
+        return None
+    if not sharded:
+        return st.st_ino, st.st_mtime_ns
+    shard_dir = shard_dir_for(output_path)
+    shards = []
+    for name in sorted(os.listdir(shard_dir)) if os.path.isdir(shard_dir) else ():
+        try:
+            shard_st = os.stat(os.path.join(shard_dir, name))
+        except OSError:
+            continue
+        shards.append((name, shard_st.st_ino, shard_st.st_mtime_ns))
+    return st.st_ino, st.st_mtime_ns, tuple(shards)
+
+
+def regenerate(jobs, options):
+    """
+    Generates the configuration of every ( input, output ) job, logging failures instead of raising them
+    :param jobs: List of ( input path, output path ) tuples
+    :param options: GenerationOptions
+    :return: Number of outputs whose content changed
+    """
+    changed = 0
+    for input_path, output_path in jobs:
+        before = output_signature(output_path, options.sharded)
+        error = _generate_file_task(input_path, output_path, options)[2]
+        if error is not None:
+            logger.error("Could not regenerate {} from {}: {}".format(output_path, input_path, error))
+        elif output_signature(output_path, options.sharded) != before:
+            changed += 1
+    return changed
+
+
+def run_hook(hook):
+    """
+    Runs the post generate hook through the shell
+    :param hook: Shell command, e.g. nginx -t && nginx -s reload
+    :return: Exit status of the command
+    """
+    logger.info("Running post generate hook: {}".format(hook))
+    status = subprocess.run(hook, shell=True).returncode
+    if status != 0:
+        logger.error("Post generate hook exited with status {}".format(status))
+    return status
+
+
+def watch(jobs, options=None, debounce=0.05, hook=None, hook_min_interval=0.0, polling=False, poll_interval=0.05,
+          stop=None):
+    """
+    Keeps the configurations up to date with their inputs: generates every job once, then regenerates the jobs whose
+    input changed. Bursts of changes are debounced, and the hook runs after the outputs changed, at most once per
+    hook_min_interval seconds
+    :param jobs: List of ( input path, output path ) tuples
+    :param options: GenerationOptions, defaults apply when None
+    :param debounce: Seconds without further changes to wait for before regenerating
+    :param hook: Shell command run after outputs changed, None disables it
+    :param hook_min_interval: Minimum seconds between two hook runs, later changes are picked up by the delayed run
+    :param polling: Always poll instead of using inotify
+    :param poll_interval: Seconds between two checks of the polling watcher
+    :param stop: threading.Event ending the watch when set, None watches until interrupted
+    :return: None
+    """
+    options = options or GenerationOptions()
+    outputs = dict((os.path.abspath(input_path), output_path) for input_path, output_path in jobs)
+    watcher = make_watcher(list(outputs), polling, poll_interval)
+    logger.info("Watching {} input(s) with {}".format(len(outputs), type(watcher).__name__))
+    try:
+        hook_pending = regenerate(list(outputs.items()), options) > 0
+        last_hook = None
+        while stop is None or not stop.is_set():
+            timeout = 0.2
+            if hook_pending and hook and last_hook is not None:
+                timeout = max(0.0, min(timeout, last_hook + hook_min_interval - time.monotonic()))
+            changed = watcher.wait(timeout)
+            if changed:
+                # Debounce: wait for a quiet period, bounded so a constantly changing input is still picked up
+                first = time.monotonic()
+                while time.monotonic() - first < max(1.0, debounce * 20):
+                    more = watcher.wait(debounce)
+                    if not more:
+                        break
+                    changed |= more
+                start = time.perf_counter()
+                updated = regenerate([(path, outputs[path]) for path in sorted(changed)], options)
+                logger.info("Regenerated {} input(s) in {:.1f} ms, {} output(s) changed".format(
+                    len(changed), (time.perf_counter() - start) * 1000, updated))
+                hook_pending = hook_pending or updated > 0
+            if hook_pending and hook and (last_hook is None or time.monotonic() - last_hook >= hook_min_interval):
+                run_hook(hook)
+                last_hook = time.monotonic()
+                hook_pending = False
+    finally:
+        watcher.close()
+
+
+def count_directives(obj):
+    """
+    Counts the directives ( keys and blocks ) of a configuration tree
+    :param obj: Conf or Container object
+    :return: Number of directives
+    """
+    count = 0
+    stack = [obj]
+    while stack:
+        for child in stack.pop().children:
+            count += 1
+            if isinstance(child, Container):
+                stack.append(child)
+    return count
+
+
+def report_ipfilter_modes(data, aggregate=True):
+    """
+    Renders the input in every ipfilter mode and logs the output size and estimated reload cost of each. nginx parses
+    every directive on reload and builds an access rule list for every location, so the number of directives and of
+    CIDR entries are used as the reload cost estimate
+    :param data: Parsed yaml data as dict
+    :param aggregate: Deduplicate and collapse the ipfilter CIDR lists
+    :return: List of (mode, bytes, directives, cidr entries) tuples
+    """
+    rows = []
+    for mode in IPFILTER_MODES:
+        c = build_conf(data, mode, aggregate)
+        cidr_entries = len(c.find('server/location/allow')) + sum(
+            len(geo.children) - 1 for geo in c.find('geo'))
+        rows.append((mode, len(dumps(c).encode('utf-8')), count_directives(c), cidr_entries))
+    logger.info("{:<8} {:>12} {:>12} {:>14}".format('mode', 'bytes', 'directives', 'cidr entries'))
+    for row in rows:
+        logger.info("{:<8} {:>12} {:>12} {:>14}".format(*row))
+    return rows
+
+
+def finish_profile(profiler, json_path=None, pstats_path=None):
+    """
+    Stops the profiler, logs its summary table and writes the requested profile files
+    :param profiler: Active StageProfiler
+    :param json_path: Location of the JSON stage records, None skips them
+    :param pstats_path: Location of the cProfile statistics, None skips them
+    :return: None
+    """
+    profiler.__exit__(None, None, None)
+    profiler.log_summary()
+    if json_path:
+        profiler.write_json(json_path)
+        logger.info("Wrote stage profile to {}".format(json_path))
+    if pstats_path:
+        profiler.write_pstats(pstats_path)
+        logger.info("Wrote cProfile statistics to {}".format(pstats_path))
+
+
+def report_diff(existing, output_path):
+    """
+    Logs the structural differences between an existing Nginx configuration and the generated one, with the included
+    files of both spliced in, see nginx.loader.load_tree
+    :param existing: Conf object holding the existing configuration
+    :param output_path: Location of the generated Nginx configuration
+    :return: List of Change objects, see nginx.nginx.diff
+    """
+    changes = diff(existing, load_tree(output_path, jobs=1))
+    for change in changes:
+        logger.info(str(change))
+    counts = {}
+    for change in changes:
+        counts[change.action] = counts.get(change.action, 0) + 1
+    logger.info("Diff against the existing configuration: {}".format(
+        ', '.join('{} {}'.format(count, action) for action, count in sorted(counts.items())) or 'no changes'))
+    return changes
+
+
+if __name__ == "__main__":
+    """
+    The Starting block for the program
+    """
+    parser = argparse.ArgumentParser(description='Script to generate Nginx Configuration')
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--input", help="Location of the input.yaml file to process, "
+                                             "a path or a file:// or http(s):// URI", type=str)
+    input_group.add_argument("--input-dir", help="Directory of input yaml files to process in batch mode", type=str)
+    input_group.add_argument("--inputs", nargs='+', help="Input yaml files ( paths or URIs ) to process in batch mode",
+                             type=str)
+    parser.add_argument("--output", required=False,
+                        help="Location where the output nginx donfig would be dumped "
+                             "(this includes the output file name as well",
+                        type=str)
+    parser.add_argument("--output-dir", required=False, default="./resources/generated",
+                        help="Directory where batch mode writes one <input name>.conf per input file",
+                        type=str)
+    parser.add_argument("--jobs", required=False, default=None,
+                        help="Number of worker processes for batch mode (defaults to the number of CPUs)",
+                        type=int)
+    parser.add_argument("--cache-dir", required=False, default=DEFAULT_CACHE_DIR,
+                        help="Directory caching generated configurations by input hash", type=str)
+    parser.add_argument("--cache-size", required=False, default=DEFAULT_CACHE_SIZE_MB,
+                        help="Size limit of the cache directory in MB, least recently used entries are evicted",
+                        type=int)
+    parser.add_argument("--no-cache", required=False, action="store_true",
+                        help="Always regenerate the configuration, without reading or filling the cache")
+    parser.add_argument("--cache-inputs", required=False, action="store_true",
+                        help="Also cache parsed input files by content hash, so unchanged inputs skip yaml parsing")
+    parser.add_argument("--fetch-dir", required=False, default=DEFAULT_FETCH_DIR,
+                        help="Directory keeping copies of inputs fetched from http(s) URIs, used for conditional "
+                             "requests", type=str)
+    parser.add_argument("--fetch-concurrency", required=False, default=DEFAULT_FETCH_CONCURRENCY,
+                        help="Maximum number of input fetches in flight", type=int)
+    parser.add_argument("--sharded", required=False, action="store_true",
+                        help="Write one file per app, ipfilter and the default server into <output without "
+                             "extension>.d and a root file at the output location including them; only changed files "
+                             "are written")
+    parser.add_argument("--shard-jobs", required=False, default=DEFAULT_SHARD_JOBS, type=int,
+                        help="Number of threads writing the shards of a sharded output "
+                             "(default: {})".format(DEFAULT_SHARD_JOBS))
+    parser.add_argument("--no-validate", required=False, action="store_true",
+                        help="Write the generated configuration without checking it for errors first")
+    parser.add_argument("--keep-versions", required=False, default=0, metavar='N',
+                        help="Also keep a timestamped copy of the output every time it changes, retaining the last N "
+                             "copies", type=int)
+    parser.add_argument("--incremental", required=False, action="store_true",
+                        help="Rebuild only the app sections whose input changed since the previous run, "
+                             "using a manifest kept next to the output file")
+    parser.add_argument("--ipfilter-mode", required=False, default='inline', choices=IPFILTER_MODES,
+                        help="inline repeats the allow rules of an ipfilter in every location, geo emits one geo "
+                             "block per ipfilter that locations check", type=str)
+    parser.add_argument("--no-aggregate-cidrs", required=False, action="store_true",
+                        help="Keep the ipfilter CIDR lists as given instead of deduplicating and collapsing them")
+    parser.add_argument("--ipfilter-report", required=False, action="store_true",
+                        help="Log the output size and estimated reload cost of every ipfilter mode")
+    parser.add_argument("--diff-against", required=False, default=None,
+                        help="Log the structural differences between this existing configuration and the generated "
+                             "one, it may be the output location itself", type=str)
+    parser.add_argument("--watch", required=False, action="store_true",
+                        help="Keep running and regenerate the outputs whenever their input files change")
+    parser.add_argument("--watch-polling", required=False, action="store_true",
+                        help="With --watch, poll the input files instead of using inotify")
+    parser.add_argument("--debounce-ms", required=False, default=50,
+                        help="With --watch, milliseconds without further changes to wait for before regenerating",
+                        type=int)
+    parser.add_argument("--post-hook", required=False, default=None,
+                        help="With --watch, shell command run after outputs changed, "
+                             "e.g. 'nginx -t && nginx -s reload'", type=str)
+    parser.add_argument("--hook-min-interval", required=False, default=0.0,
+                        help="With --watch, minimum seconds between two runs of the post hook", type=float)
+    parser.add_argument("--profile", required=False, action="store_true",
+                        help="Record wall time, allocations and object / line counts per stage and per app, "
+                             "and log a summary table")
+    parser.add_argument("--profile-json", required=False, default=None,
+                        help="With --profile, also write the stage records as JSON to this location", type=str)
+    parser.add_argument("--profile-pstats", required=False, default=None,
+                        help="With --profile, also run cProfile and write its statistics to this location", type=str)
+
+    args = parser.parse_args()
+
+    setup_logging()
+
+    cache = None
+    if not args.no_cache:
+        cache = ConfigCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    options = GenerationOptions(cache=cache, incremental=args.incremental, ipfilter_mode=args.ipfilter_mode,
+                                aggregate=not args.no_aggregate_cidrs, cache_inputs=args.cache_inputs,
+                                fetch_dir=args.fetch_dir, fetch_concurrency=args.fetch_concurrency,
+                                keep_versions=args.keep_versions, validate=not args.no_validate,
+                                sharded=args.sharded, shard_jobs=args.shard_jobs)
+
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(cprofile=args.profile_pstats is not None)
+        profiler.__enter__()
+    elif args.profile_json or args.profile_pstats:
+        logger.warning("--profile-json and --profile-pstats have no effect without --profile")
+
+    if args.watch:
+        if args.input_dir or args.inputs:
+            input_paths = list_input_files(args.input_dir) if args.input_dir else args.inputs
+            try:
+                jobs = list(zip(input_paths, batch_output_paths(input_paths, args.output_dir)))
+            except ValueError as ex:
+                logger.error(str(ex))
+                sys.exit(1)
+            if not os.path.isdir(args.output_dir):
+                os.makedirs(args.output_dir, exist_ok=True)
+        else:
+            jobs = [(args.input, args.output or "./resources/generated_nginx.conf")]
+        jobs = [(urllib.request.url2pathname(urllib.parse.urlsplit(path).path) if path.startswith('file:') else path,
+                 output) for path, output in jobs]
+        if any(is_remote_uri(path) for path, _ in jobs):
+            logger.error("--watch only supports local input files")
+            sys.exit(1)
+        try:
+            watch(jobs, options, args.debounce_ms / 1000.0, args.post_hook, args.hook_min_interval,
+                  args.watch_polling)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        sys.exit(0)
+
+    if args.input_dir or args.inputs:
+        if profiler is not None:
+            logger.warning("Batch mode generates in worker processes, --profile only covers fetching the inputs")
+        input_paths = list_input_files(args.input_dir) if args.input_dir else args.inputs
+        logger.info("Batch mode: generating {} configuration(s) into {}".format(len(input_paths), args.output_dir))
+        try:
+            failed = report_batch(generate_batch(input_paths, args.output_dir, args.jobs, options))
+        except ValueError as ex:
+            logger.error(str(ex))
+            sys.exit(1)
+        if profiler is not None:
+            finish_profile(profiler, args.profile_json, args.profile_pstats)
+        sys.exit(1 if failed else 0)
+
+    if not args.output:
+        logger.warning("Output location not specified , will be storing the generated nginx under resources folder")
         output_path = "./resources/generated_nginx.conf"
-        file_handler = open(output_path, "w")
+    else:
+        logger.info(
+            "Output location specified as {}, will be used to store the generate Nginx file".format(args.output))
+        output_path = args.output
 
-    # Writing the Nginx configuration to the location specified
-    dump(c, file_handler)
+    try:
+        input_path, error = fetch_inputs([args.input], options.fetch_dir, options.fetch_concurrency)[0]
+        if error is not None:
+            logger.error("Could not fetch input {}: {}".format(args.input, error))
+            exit(1)
+        data = load_input(input_path, cache if options.cache_inputs else None)
+    except Exception as ex:
+        logger.error("An exception of type '{0}' occurred.".format(type(ex).__name__))
+        exit(1)
+
+    existing = None
+    if args.diff_against:
+        # Read before generating, the existing configuration may be the one about to be replaced
+        existing = load_tree(args.diff_against, jobs=1)
 
-    logger.info('Generated Nginx Configuration is present location {}'.format(output_path))
+    try:
+        generate_data(data, output_path, options)
+    except ValidationError:
+        # The problems are logged already
+        logger.error("Not writing {}, the generated configuration has errors".format(output_path))
+        sys.exit(1)
+    except ValueError as ex:
+        logger.error("Not writing {}, the input is invalid: {}".format(output_path, ex))
+        sys.exit(1)
+    if existing is not None:
+        report_diff(existing, output_path)
+    if args.ipfilter_report:
+        report_ipfilter_modes(data, options.aggregate)
+    if cache is not None:
+        log_cache_counters(cache.hits, cache.misses)
+    if profiler is not None:
+        finish_profile(profiler, args.profile_json, args.profile_pstats)
@@ -1,4 +1,21 @@
-from nginx.nginx import loads, dumps
+from nginx.nginx import loads, dumps, dump, iterparse, diff, node_hash, Conf, Key, Location, RenderCache, Server, \
+    Http
+from nginx.loader import load_tree, ParseCache, IncludeCycleError
+from nginx.validator import validate, check, parse_listen, summarize, merge, ValidationError
+from nginx.cache import ConfigCache
+from nginx_config_generator import generate_batch, generate_file, GenerationOptions, build_conf, \
+    load_input, generate_data, render_incremental, load_manifest, shard_dir_for, aggregate_cidrs, fetch_inputs, \
+    StageProfiler, render, render_to, init_generator, write_text, list_versions, watch
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import http.server
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
 
 TESTBLOCK_CASE_1 = """
@@ -80,6 +97,39 @@ server {
 }
 """
 
+TESTBLOCK_CASE_5 = """
+# generic blocks
+http {
+    map $http_upgrade $connection_upgrade {
+        default upgrade;
+        '' close;
+    }
+    server {
+        if ($request_method = POST) {
+            return 405;
+        }
+    }
+}
+"""
+
+DUMPED_CASE_5 = (
+    "http {\n"
+    "\n"
+    "    map $http_upgrade $connection_upgrade {\n"
+    "        default upgrade;\n"
+    "        '' close;\n"
+    "    }\n"
+    "\n"
+    "\n"
+    "    server {\n"
+    "    \n"
+    "        if ($request_method = POST) {\n"
+    "            return 405;\n"
+    "        }\n"
+    "    }\n"
+    "}\n"
+)
+
 
 class TestPythonNginx(unittest.TestCase):
 
@@ -108,6 +158,657 @@ class TestPythonNginx(unittest.TestCase):
         out_data = '\n' + dumps(inp_data)
         self.assertEqual(TESTBLOCK_CASE_4, out_data)
 
+    def test_generic_blocks(self):
+        data = loads(TESTBLOCK_CASE_5)
+        http = data.children[0]
+        self.assertEqual(http.name, 'http')
+        mapping = http.children[0]
+        self.assertEqual(mapping.name, 'map')
+        self.assertEqual(mapping.value, '$http_upgrade $connection_upgrade')
+        self.assertEqual(mapping.keys[1].name, "''")
+        self.assertEqual(http.children[1].children[0].value, '($request_method = POST)')
+
+    def test_unbalanced_blocks(self):
+        self.assertRaises(ValueError, loads, 'server { listen 80;')
+        self.assertRaises(ValueError, loads, 'listen 80; }')
+        self.assertRaises(ValueError, loads, 'listen 80')
+
+    def test_streaming_dump(self):
+        for case in (TESTBLOCK_CASE_1, TESTBLOCK_CASE_4, TESTBLOCK_CASE_5):
+            data = loads(case)
+            expected = dumps(data)
+            self.assertEqual(''.join(data.as_strings), expected)
+            self.assertEqual(dump(data, io.StringIO(), chunk_size=16).getvalue(), expected)
+        self.assertEqual(dumps(loads(TESTBLOCK_CASE_5)), DUMPED_CASE_5)
+
+    def test_depth_from_nesting(self):
+        server = Server(Key('listen', '80'))
+        conf = Conf(server)
+        outer = Location('/')
+        server.add(outer)
+        outer.add(Location('/inner', Key('return', '404')))
+        self.assertEqual(dumps(conf), (
+            'server {\n'
+            '    listen 80;\n'
+            '\n'
+            '    location / {\n'
+            '    \n'
+            '        location /inner {\n'
+            '            return 404;\n'
+            '        }\n'
+            '    }\n'
+            '}\n'))
+        self.assertEqual(dumps(outer).split('\n')[2], '    location /inner {')
+
+    def test_iterparse_events(self):
+        events = list(iterparse(io.StringIO(TESTBLOCK_CASE_4), chunk_size=5))
+        self.assertEqual([e for e, _ in events],
+                         ['start', 'key', 'key', 'key', 'end',
+                          'start', 'key', 'start', 'key', 'key', 'end', 'end'])
+        self.assertEqual(events[0][1].value, 'xx.com_backend')
+        self.assertEqual(events[0][1].children, [])
+        self.assertEqual(events[8][1].value, "$xlocation 'test'")
+        proxy_pass = [o.value for e, o in iterparse(io.BytesIO(TESTBLOCK_CASE_4.encode()))
+                      if e == 'key' and o.name == 'proxy_pass']
+        self.assertEqual(proxy_pass, ['http://xx.com_backend'])
+
+    def test_iterparse_chunk_boundaries(self):
+        text = ('set $a ${foo}bar;  # c ${d\n'
+                'location ~ ^/x$ {\n'
+                '    proxy_pass http://x${host};\n'
+                '    return 200 "a; ${b} {c}";\n'
+                '}\n')
+        expected = dumps(loads(text))
+        for chunk_size in range(1, len(text) + 1):
+            conf = Conf()
+            stack = [conf]
+            for event, obj in iterparse(io.StringIO(text), chunk_size=chunk_size):
+                if event == 'end':
+                    stack.pop()
+                    continue
+                stack[-1].add(obj)
+                if event == 'start':
+                    stack.append(obj)
+            self.assertEqual(dumps(conf), expected, chunk_size)
+
+    def test_index_add_remove(self):
+        data = loads(TESTBLOCK_CASE_1)
+        server = data.server
+        self.assertEqual(len(server.locations), 1)
+        location = Location('/extra', Key('allow', '10.0.0.0/8'))
+        server.add(location)
+        self.assertEqual(server.filter('Location', '/extra'), [location])
+        self.assertEqual(server.locations[-1], location)
+        server.remove(location)
+        self.assertEqual(server.filter('Location', '/extra'), [])
+        self.assertEqual([x.value for x in data.filter('Upstream')], ['test0', 'test1', 'test2'])
+        self.assertEqual(data.filter('Upstream', 'test1')[0].keys[0].value, '127.0.0.2:8080')
+
+    def test_index_rename_reorder(self):
+        data = loads(TESTBLOCK_CASE_1)
+        upstream = data.filter('Upstream', 'test1')[0]
+        upstream.value = 'renamed'
+        self.assertEqual(data.filter('Upstream', 'test1'), [])
+        self.assertEqual(data.filter('Upstream', 'renamed'), [upstream])
+        key = upstream.keys[0]
+        key.name = 'backup'
+        self.assertEqual(upstream.filter('Key', 'server'), [])
+        self.assertEqual(upstream.filter('Key', 'backup'), [key])
+        upstream.children.reverse()
+        upstream.invalidate()
+        self.assertEqual(upstream.keys, upstream.children)
+        self.assertEqual(upstream.keys[-1], key)
+
+    def test_find(self):
+        data = loads(TESTBLOCK_CASE_4)
+        self.assertEqual([x.value for x in data.find('upstream[xx.com_backend]/server')],
+                         ['10.193.2.2:9061 weight=1 max_fails=2 fail_timeout=30s',
+                          '10.193.2.1:9061 weight=1 max_fails=2 fail_timeout=30s'])
+        self.assertEqual([x.value for x in data.find('server[listen=80]/location[/]/proxy_pass')],
+                         ['http://xx.com_backend'])
+        self.assertEqual(data.find('server[listen=443]/location'), [])
+
+        data = loads('server { server_name a.com www.a.com; listen 80; }\nserver { server_name b.a.com; }\n')
+        for query in ('server[server_name=a.com]', 'server[server_name=www.a.com]',
+                      'server[server_name=a.com www.a.com]'):
+            self.assertEqual(data.find(query), data.servers[:1], query)
+        self.assertEqual(data.find('server[server_name=a]'), [])
+
+    def test_render_cache(self):
+        cache = RenderCache()
+        for case in (TESTBLOCK_CASE_1, TESTBLOCK_CASE_4, TESTBLOCK_CASE_5):
+            data = loads(case)
+            self.assertEqual(cache.dumps(data), dumps(data))
+            self.assertEqual(cache.dumps(data.children[-1]), dumps(data.children[-1]))
+
+        data = loads(TESTBLOCK_CASE_4)
+        cache.dumps(data)
+        before = node_hash(data)
+        upstream_hash = node_hash(data.children[0])
+        data.find('server/location[/]/proxy_pass')[0].value = 'http://other'
+        misses = cache.misses
+        self.assertEqual(cache.dumps(data), dumps(data))
+        self.assertIn('http://other', cache.dumps(data))
+        # Only the changed location and its server are rendered again
+        self.assertEqual(cache.misses - misses, 2)
+        self.assertNotEqual(node_hash(data), before)
+        self.assertEqual(node_hash(data.children[0]), upstream_hash)
+
+        data.server.add(Location('/new', Key('return', '404')))
+        self.assertEqual(cache.dumps(data), dumps(data))
+        location = data.server.locations[0]
+        location.children.reverse()
+        location.invalidate()
+        self.assertEqual(cache.dumps(data), dumps(data))
+
+        small = RenderCache(max_size=100)
+        small.dumps(loads(TESTBLOCK_CASE_1))
+        self.assertLessEqual(small.size, 100)
+
+    def test_diff(self):
+        old = loads(TESTBLOCK_CASE_4)
+        self.assertEqual(diff(old, loads(TESTBLOCK_CASE_4)), [])
+
+        new = loads(TESTBLOCK_CASE_4)
+        new.find('upstream[xx.com_backend]')[0].remove(new.find('upstream[xx.com_backend]/server')[1])
+        new.find('server[listen=80]/location[/]/proxy_pass')[0].value = 'http://other'
+        new.server.add(Location('/static', Key('root', '/var/www')))
+        changes = diff(old, new)
+        self.assertEqual([(c.action, c.path) for c in changes],
+                         [('removed', 'upstream[xx.com_backend]/server'),
+                          ('added', 'server[listen=80]/location[/static]'),
+                          ('changed', 'server[listen=80]/location[/]/proxy_pass')])
+        self.assertEqual(changes[2].new.value, 'http://other')
+        self.assertEqual(str(changes[0]),
+                         '- upstream[xx.com_backend]/server: server 10.193.2.1:9061 weight=1 max_fails=2 '
+                         'fail_timeout=30s;')
+
+        before = loads(dumps(new))
+        new.find('server/location[/]')[0].children.reverse()
+        self.assertEqual([(c.action, c.path) for c in diff(before, new)],
+                         [('reordered', 'server[listen=80]/location[/]')])
+
+    def test_validate(self):
+        self.assertEqual(validate(loads(TESTBLOCK_CASE_4)), [])
+        self.assertEqual(validate(loads('server { location / { proxy_pass http://unix:/run/app.sock:; } }')), [])
+        self.assertEqual(parse_listen('[::]:80 default_server ipv6only=on'),
+                         ('[::]', 80, ['default_server', 'ipv6only=on']))
+        self.assertEqual(parse_listen('0.0.0.0:8080')[:2], ('*', 8080))
+
+        conf = loads("""
+            server {
+                listen 0.0.0.0:7000default_server;
+                location / { proxy_pass http://missing; }
+                location / { root html; }
+            }
+            server { listen 7000 default_server; server_name a; }
+            server { listen *:7000 default_server; server_name a; }
+        """)
+        problems = validate(conf)
+        self.assertEqual([(p.level, p.path) for p in problems],
+                         [('error', 'server[listen=0.0.0.0:7000default_server]/location[/]'),
+                          ('error', 'server[listen=0.0.0.0:7000default_server]/listen'),
+                          ('error', 'server[server_name=a]'),
+                          ('warning', 'server[server_name=a]'),
+                          ('error', 'server[listen=0.0.0.0:7000default_server]/location[/]/proxy_pass')])
+        self.assertIn("'0.0.0.0:7000default_server'", problems[1].message)
+        with self.assertRaises(ValidationError) as ctx:
+            check(conf)
+        self.assertEqual([str(p) for p in ctx.exception.problems], [str(p) for p in problems])
+
+        # Summaries of separately validated pieces are checked as one configuration
+        piece = summarize(loads('server { listen 80 default_server; location / { proxy_pass http://app; } }'))
+        self.assertEqual([p.level for p in merge([piece])], ['error'])
+        self.assertEqual([p.level for p in merge([summarize(loads('upstream app { server a:80; }')), piece, piece])],
+                         ['error', 'warning'])
+
+    def test_load_tree(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        def write(name, text):
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+            return path
+
+        path = write('nginx.conf', 'http {\n    include conf.d/*.conf;\n}\n')
+        write('conf.d/a.conf', TESTBLOCK_CASE_4.replace('set $xlocation', 'include "snippets/acl.conf";\n        set'))
+        write('conf.d/b.conf', TESTBLOCK_CASE_2)
+        write('snippets/acl.conf', 'allow 10.0.0.0/8;\ndeny all;\n')
+
+        cache = ParseCache()
+        for jobs in (1, 2):
+            tree = load_tree(path, jobs, cache)
+            self.assertEqual(len(tree.find('http/server')), 2)
+            self.assertEqual(tree.filter('Key'), [])
+            self.assertEqual(tree.find('http/server[listen=80]/location[/]/allow')[0].value, '10.0.0.0/8')
+        self.assertEqual([os.path.relpath(f, root) for f in tree.files],
+                         ['nginx.conf', 'conf.d/a.conf', 'conf.d/b.conf', 'snippets/acl.conf'])
+        self.assertEqual(tree.source_of(tree.find('http/upstream[test1]/send')[0]), os.path.join(root, 'conf.d/b.conf'))
+        self.assertEqual(tree.source_of(tree.find('http/server[listen=80]/location[/]/deny')[0]),
+                         os.path.join(root, 'snippets/acl.conf'))
+        self.assertEqual(tree.source_of(tree.find('http')[0]), os.path.join(root, 'nginx.conf'))
+        self.assertEqual(tree.source_of(Key('deny', 'all')), None)
+        self.assertEqual((cache.hits, cache.misses), (4, 4))
+
+        write('snippets/acl.conf', 'deny all;\n')
+        tree = load_tree(path, 1, cache)
+        self.assertEqual((cache.hits, cache.misses), (7, 5))
+        self.assertEqual(tree.find('http/server[listen=80]/location[/]/allow'), [])
+
+        write('snippets/acl.conf', 'include conf.d/a.conf;\n')
+        with self.assertRaises(IncludeCycleError) as ctx:
+            load_tree(path, 1)
+        self.assertEqual([os.path.relpath(f, root) for f in ctx.exception.chain],
+                         ['nginx.conf', 'conf.d/a.conf', 'snippets/acl.conf', 'conf.d/a.conf'])
+
+
+class TestNginxConfigGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sample_input = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         'resources', 'sample_input.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_batch_generation(self):
+        bad_input = os.path.join(self.tmpdir, 'broken.yaml')
+        with open(bad_input, 'w') as f:
+            f.write('app: [')
+        output_dir = os.path.join(self.tmpdir, 'out')
+        results = generate_batch([self.sample_input, bad_input], output_dir, jobs=2)
+        self.assertEqual(results[0][2], None)
+        self.assertTrue(results[1][2].startswith('ParserError'))
+        with open(os.path.join(output_dir, 'sample_input.conf')) as f:
+            self.assertEqual(len(loads(f.read()).servers), 3)
+
+        other = os.path.join(self.tmpdir, 'other', 'sample_input.yaml')
+        os.makedirs(os.path.dirname(other))
+        shutil.copy(self.sample_input, other)
+        with self.assertRaises(ValueError) as ctx:
+            generate_batch([self.sample_input, 'file://' + other], os.path.join(self.tmpdir, 'clash'), jobs=1)
+        self.assertIn(other, str(ctx.exception))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'clash')))
+
+    def test_cache_hit_keeps_output(self):
+        cache = ConfigCache(os.path.join(self.tmpdir, 'cache'))
+        output = os.path.join(self.tmpdir, 'nginx.conf')
+        self.assertEqual(generate_file(self.sample_input, output, GenerationOptions(cache)), 'miss')
+        os.utime(output, (0, 0))
+        self.assertEqual(generate_file(self.sample_input, output, GenerationOptions(cache)), 'hit')
+        self.assertEqual(os.stat(output).st_mtime, 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_cache_eviction(self):
+        cache = ConfigCache(os.path.join(self.tmpdir, 'cache'), max_bytes=10)
+        output = os.path.join(self.tmpdir, 'nginx.conf')
+        with open(output, 'w') as f:
+            f.write('0123456789')
+        cache.put('old', output)
+        os.utime(cache.path_for('old'), (0, 0))
+        cache.put('new', output)
+        self.assertEqual(cache.get('old'), None)
+        self.assertEqual(cache.get('new'), cache.path_for('new'))
+
+    def test_incremental_regeneration(self):
+        manifest = os.path.join(self.tmpdir, 'nginx.conf.manifest.json')
+        data = load_input(self.sample_input)
+        self.assertEqual(render_incremental(data, manifest), dumps(build_conf(data)))
+        index, before, texts_end = load_manifest(manifest)
+        data['app']['production']['runtime_port'] = 9000
+        with self.assertLogs('nginx_config_generator', 'INFO') as logs:
+            text = render_incremental(data, manifest)
+        self.assertIn('rebuilt 1 of 3 section(s)', '\n'.join(logs.output))
+        self.assertEqual(text, dumps(build_conf(data)))
+        # The texts of the unchanged sections are kept, the text of the rebuilt one is appended to the manifest
+        index, after, _ = load_manifest(manifest)
+        self.assertEqual(after[:texts_end], before[:texts_end])
+        self.assertEqual(index['sections']['app:production']['span'][0], texts_end)
+
+        # A list shared by several apps changes the hash of every app referencing it
+        data['ipfilter']['myfilter'].append('10.0.0.0/8')
+        with self.assertLogs('nginx_config_generator', 'INFO') as logs:
+            text = render_incremental(data, manifest)
+        self.assertIn('rebuilt 2 of 3 section(s)', '\n'.join(logs.output))
+        self.assertEqual(text, dumps(build_conf(data)))
+
+        # A manifest cut short by an interrupted run reads as empty
+        with open(manifest, 'r+b') as f:
+            f.truncate(texts_end)
+        with self.assertLogs('nginx_config_generator', 'INFO') as logs:
+            text = render_incremental(data, manifest)
+        self.assertIn('rebuilt 3 of 3 section(s)', '\n'.join(logs.output))
+        self.assertEqual(text, dumps(build_conf(data)))
+
+    def test_validation_blocks_write(self):
+        data = load_input(self.sample_input)
+        output = os.path.join(self.tmpdir, 'nginx.conf')
+        generate_data(data, output)
+        self.assertEqual(check(loads(open(output).read())), [])
+
+        data['catchall']['default']['port'] = 'x'
+        # The second incremental run validates the sections reused from the manifest
+        for incremental in (False, True, True):
+            with self.assertRaises(ValidationError), self.assertLogs('nginx_config_generator', 'ERROR'):
+                generate_data(data, output, GenerationOptions(incremental=incremental))
+        with open(output) as f:
+            self.assertIn('listen 0.0.0.0:7000;', f.read())
+        generate_data(data, output, GenerationOptions(validate=False))
+        with open(output) as f:
+            self.assertIn('listen 0.0.0.0:x;', f.read())
+
+    def test_sharded_output(self):
+        data = load_input(self.sample_input)
+        output = os.path.join(self.tmpdir, 'nginx.conf')
+        shard_dir = shard_dir_for(output)
+        generate_data(data, output, GenerationOptions(ipfilter_mode='geo', sharded=True))
+        self.assertEqual(sorted(os.listdir(shard_dir)),
+                         ['app-acceptance.conf', 'app-production.conf', 'default.conf', 'ipfilter-allowall.conf',
+                          'ipfilter-myfilter.conf'])
+        with open(output) as f:
+            self.assertEqual(f.readline(), 'include {};\n'.format(os.path.join(shard_dir, 'ipfilter-allowall.conf')))
+        self.assertEqual(diff(load_tree(output, 1), build_conf(data, 'geo')), [])
+
+        before = dict((name, os.stat(os.path.join(shard_dir, name)).st_ino) for name in os.listdir(shard_dir))
+        data['app']['production']['runtime_port'] = 9000
+        del data['app']['acceptance']
+        generate_data(data, output, GenerationOptions(ipfilter_mode='geo', sharded=True))
+        after = dict((name, os.stat(os.path.join(shard_dir, name)).st_ino) for name in os.listdir(shard_dir))
+        self.assertEqual(sorted(name for name in after if after[name] != before.get(name)), ['app-production.conf'])
+        self.assertNotIn('app-acceptance.conf', after)
+
+        generate_data(data, output, GenerationOptions(sharded=True, incremental=True))
+        with open(os.path.join(shard_dir, 'app-production.conf')) as f:
+            self.assertIn('include {};'.format(os.path.join(shard_dir, 'ipfilter-myfilter.conf')), f.read())
+        with open(os.path.join(shard_dir, 'ipfilter-myfilter.conf')) as f:
+            self.assertEqual(f.read().splitlines()[-1], 'deny all;')
+        with open(output) as f:
+            self.assertNotIn('ipfilter', f.read())
+
+    def test_upstream_backends(self):
+        data = load_input(self.sample_input)
+        data['app']['production'].update(
+            backends=['10.0.0.1', {'address': '[::1]:9000', 'weight': 2, 'max_fails': 3, 'fail_timeout': '30s'}],
+            balancing='least_conn', keepalive=16, upstream_host='ignored')
+        data['app']['acceptance']['upstream_host'] = '10.0.0.9'
+        conf = build_conf(data)
+        self.assertEqual([x.as_list for x in conf.find('upstream[production]')[0].children],
+                         [['least_conn', ''], ['server', '10.0.0.1:8001'],
+                          ['server', '[::1]:9000 weight=2 max_fails=3 fail_timeout=30s'], ['keepalive', '16']])
+        self.assertEqual(conf.find('upstream[acceptance]/server')[0].value, '10.0.0.9:8000')
+        for location in conf.find('server[server_name=myapp.com]/location'):
+            self.assertEqual([k.value for k in location.filter('Key', 'proxy_http_version')], ['1.1'])
+            self.assertEqual([k.value for k in location.filter('Key', 'proxy_set_header')], ['Connection ""'])
+        self.assertEqual(conf.find('server[server_name=myapp-accp.mendixcloud.com]/location/proxy_http_version'), [])
+        self.assertEqual(dumps(loads(dumps(conf))), dumps(conf))
+
+        for key, value in (('balancing', 'hash'), ('balancing', 'random'), ('keepalive', 0),
+                           ('backends', [{'address': '10.0.0.1', 'weight': 0}]), ('backends', [{'host': 'x'}])):
+            broken = load_input(self.sample_input)
+            broken['app']['production'][key] = value
+            with self.assertRaises(ValueError):
+                build_conf(broken)
+
+    def test_tuning_profiles(self):
+        data = load_input(self.sample_input)
+        data['tuning'] = {'profile': 'low-latency', 'cpus': 4, 'events': {'worker_connections': 1024},
+                          'http': {'gzip': False, 'proxy_buffer_size': None}}
+        data['app']['production']['tuning'] = {'client_max_body_size': '50m'}
+        conf = build_conf(data)
+        self.assertEqual([x.as_list for x in conf.filter('Key')],
+                         [['worker_processes', '3'], ['worker_rlimit_nofile', '2048'], ['worker_cpu_affinity', 'auto']])
+        self.assertEqual(conf.find('events/worker_connections')[0].value, '1024')
+        self.assertEqual(conf.find('http/gzip')[0].value, 'off')
+        self.assertEqual(conf.find('http/proxy_buffer_size'), [])
+        self.assertEqual(len(conf.find('http/server')), 3)
+        self.assertEqual(conf.find('http/server[server_name=myapp.com]/client_max_body_size')[0].value, '50m')
+        self.assertEqual(conf.find('http/server[server_name=myapp-accp.mendixcloud.com]/client_max_body_size'), [])
+        self.assertIsInstance(loads(dumps(conf)).children[-1], Http)
+        self.assertEqual(list(conf.children[-1].as_dict), ['http'])
+        self.assertEqual(conf.children[-2].as_dict,
+                         {'events': [{'worker_connections': '1024'}, {'multi_accept': 'off'}]})
+        self.assertEqual(dumps(loads(dumps(conf))), dumps(conf))
+        self.assertEqual(render_incremental(data, os.path.join(self.tmpdir, 'manifest.json')), dumps(conf))
+        del data['tuning']
+        self.assertIn('client_max_body_size 50m;', render_incremental(data, os.path.join(self.tmpdir, 'manifest.json')))
+
+        data['tuning'] = {'profile': 'high-throughput'}
+        self.assertEqual(build_conf(data).find('worker_processes')[0].value, 'auto')
+        output = os.path.join(self.tmpdir, 'nginx.conf')
+        generate_data(data, output, GenerationOptions(sharded=True))
+        self.assertEqual(diff(load_tree(output, 1), build_conf(data)), [])
+        data['tuning']['profile'] = 'low-latency'
+        del data['app']['acceptance']
+        generate_data(data, output, GenerationOptions(sharded=True))
+        self.assertEqual(sorted(os.listdir(shard_dir_for(output))),
+                         ['app-production.conf', 'default.conf', 'ipfilter-allowall.conf', 'ipfilter-myfilter.conf'])
+        self.assertEqual(diff(load_tree(output, 1), build_conf(data)), [])
+
+        for tuning in ({'profile': 'fast'}, {'profile': 'low-latency', 'cpus': 0},
+                       {'profile': 'low-latency', 'io': {}},
+                       {'profile': 'low-latency', 'events': {'worker_connections': '4k'}}):
+            data['tuning'] = tuning
+            with self.assertRaises(ValueError):
+                build_conf(data)
+        # Directives of the main, events or upstream context would make the server block invalid
+        del data['tuning']
+        for directive in ('worker_connections', 'worker_processes', 'keepalive'):
+            data['app']['production']['tuning'] = {directive: 8}
+            with self.assertRaisesRegex(ValueError, directive + ' of production'):
+                build_conf(data)
+
+    def test_geo_ipfilter_mode(self):
+        data = load_input(self.sample_input)
+        conf = build_conf(data, 'geo')
+        self.assertEqual([geo.value for geo in conf.find('geo')], ['$ipfilter_allowall', '$ipfilter_myfilter'])
+        self.assertEqual(len(conf.find('geo[$ipfilter_myfilter]')[0].keys), 3)
+        self.assertEqual(conf.find('server/location/allow'), [])
+        checks = conf.find('server/location/if[($ipfilter_myfilter = 0)]/return')
+        self.assertEqual([x.value for x in checks], ['403', '403'])
+        manifest = os.path.join(self.tmpdir, 'nginx.conf.manifest.json')
+        self.assertEqual(render_incremental(data, manifest, 'geo'), dumps(conf))
+        data['ipfilter']['myfilter'].append('10.0.0.0/8')
+        with self.assertLogs('nginx_config_generator', 'INFO') as logs:
+            text = render_incremental(data, manifest, 'geo')
+        self.assertIn('rebuilt 1 of 4 section(s)', '\n'.join(logs.output))
+        self.assertEqual(text, dumps(build_conf(data, 'geo')))
+
+    def test_aggregate_cidrs(self):
+        self.assertEqual(aggregate_cidrs(['10.0.0.0/25', '10.0.0.128/25', '10.0.0.5', '2001:db8::/32',
+                                          '2001:db8:1::/48', '192.168.1.7/24', '1.2.3.4/32', '1.2.3.4']),
+                         ['1.2.3.4', '10.0.0.0/24', '192.168.1.0/24', '2001:db8::/32'])
+        data = load_input(self.sample_input)
+        data['ipfilter']['myfilter'] += ['82.94.188.0/26', '82.94.188.128/25']
+        allows = build_conf(data).find('server/location[/secret]/allow')
+        self.assertEqual([x.value for x in allows], ['82.94.188.0/24', '2001:888:2177::/48'])
+        allows = build_conf(data, aggregate=False).find('server/location[/secret]/allow')
+        self.assertEqual(len(allows), 4)
+
+    def test_input_cache(self):
+        cache = ConfigCache(os.path.join(self.tmpdir, 'cache'))
+        data = load_input(self.sample_input, cache)
+        self.assertEqual(os.listdir(cache.cache_dir)[0][-7:], '.pickle')
+        with self.assertLogs('nginx_config_generator', 'INFO') as logs:
+            self.assertEqual(load_input(self.sample_input, cache), data)
+        self.assertIn('from the input cache', '\n'.join(logs.output))
+
+    def test_fetch_inputs(self):
+        served = os.path.join(self.tmpdir, 'served')
+        os.makedirs(served)
+        shutil.copy(self.sample_input, os.path.join(served, 'sample_input.yaml'))
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=served)
+        handler.log_message = lambda *args: None
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        uri = 'http://127.0.0.1:{}/sample_input.yaml'.format(server.server_address[1])
+        fetch_dir = os.path.join(self.tmpdir, 'fetched')
+        with self.assertLogs('nginx_config_generator', 'INFO') as logs:
+            (path, error), (_, missing) = fetch_inputs([uri, uri.replace('sample', 'missing')], fetch_dir)
+        self.assertIsNone(error)
+        self.assertIn('HTTP 404', missing)
+        self.assertIn('1 fetched', '\n'.join(logs.output))
+        self.assertEqual(load_input(path), load_input(self.sample_input))
+
+        with self.assertLogs('nginx_config_generator', 'INFO') as logs:
+            self.assertEqual(fetch_inputs([uri], fetch_dir), [(path, None)])
+        self.assertIn('1 not modified', '\n'.join(logs.output))
+
+        results = generate_batch([uri], os.path.join(self.tmpdir, 'out'), jobs=1,
+                                 options=GenerationOptions(fetch_dir=fetch_dir))
+        self.assertIsNone(results[0][2])
+        self.assertEqual(os.path.basename(results[0][1]), 'sample_input.conf')
+
+    def test_fetch_without_last_modified(self):
+        served = os.path.join(self.tmpdir, 'served')
+        os.makedirs(served)
+        shutil.copy(self.sample_input, os.path.join(served, 'sample_input.yaml'))
+        dates = []
+        conditions = []
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def send_header(self, keyword, value):
+                if keyword == 'Date':
+                    dates.append(value)
+                if keyword != 'Last-Modified':
+                    super(Handler, self).send_header(keyword, value)
+
+            def do_GET(self):
+                conditions.append(self.headers.get('If-Modified-Since'))
+                super(Handler, self).do_GET()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=served))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        # The server's Date, not the local clock, makes the next request conditional
+        uri = 'http://127.0.0.1:{}/sample_input.yaml'.format(server.server_address[1])
+        fetch_dir = os.path.join(self.tmpdir, 'fetched')
+        fetch_inputs([uri], fetch_dir)
+        fetch_inputs([uri], fetch_dir)
+        self.assertEqual(conditions, [None, dates[0]])
+
+    def test_stage_profiler(self):
+        output = os.path.join(self.tmpdir, 'profiled.conf')
+        with StageProfiler(cprofile=True) as profiler:
+            generate_file(self.sample_input, output)
+        stages = dict((record['name'], record) for record in profiler.records)
+        self.assertEqual(stages['build_ip_filters']['depth'], 1)
+        self.assertEqual(stages['app:production']['counts']['objects'], 15)
+        with open(output) as f:
+            self.assertEqual(stages['dump']['counts']['lines'], f.read().count('\n'))
+        self.assertTrue(all(record['peak_bytes'] >= 0 for record in profiler.records))
+        self.assertIn('apps (2)', '\n'.join(profiler.summary()))
+
+        profiler.write_json(os.path.join(self.tmpdir, 'profile.json'))
+        profiler.write_pstats(os.path.join(self.tmpdir, 'profile.pstats'))
+        with StageProfiler(trace_allocations=False) as profiler:
+            pass
+        generate_file(self.sample_input, output)
+        self.assertEqual(profiler.records, [])
+
+        # Python 3.8 has no tracemalloc.reset_peak, stages record their net allocations only
+        reset_peak = tracemalloc.reset_peak
+        del tracemalloc.reset_peak
+        self.addCleanup(setattr, tracemalloc, 'reset_peak', reset_peak)
+        with StageProfiler() as profiler:
+            generate_file(self.sample_input, output)
+        self.assertTrue(all('allocated_bytes' in record and 'peak_bytes' not in record for record in profiler.records))
+        self.assertIn('apps (2)', '\n'.join(profiler.summary()))
+
+    def test_concurrent_render(self):
+        data = load_input(self.sample_input)
+        expected = dumps(build_conf(data))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            rendered = list(executor.map(lambda _: dumps(render(data)), range(32)))
+        self.assertEqual(rendered, [expected] * 32)
+
+        buf = io.StringIO()
+        render_to(data, buf)
+        self.assertEqual(buf.getvalue(), expected)
+        self.assertIs(init_generator(data).cidr_filter_list, init_generator(data).cidr_filter_list)
+
+    def test_atomic_versioned_writes(self):
+        output = os.path.join(self.tmpdir, 'nginx.conf')
+        write_text('a;\n', output, keep_versions=2)
+        os.utime(output, (0, 0))
+        write_text('a;\n', output, keep_versions=2)
+        self.assertEqual(os.stat(output).st_mtime, 0)
+        self.assertEqual(len(list_versions(output)), 1)
+
+        for text in ('b;\n', 'c;\n'):
+            write_text(text, output, keep_versions=2)
+        versions = list_versions(output)
+        self.assertEqual(len(versions), 2)
+        with open(versions[0]) as f:
+            self.assertEqual(f.read(), 'b;\n')
+        with open(output) as f:
+            self.assertEqual(f.read(), 'c;\n')
+        self.assertEqual(os.stat(output).st_mode & 0o777, 0o644)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         sorted(['nginx.conf'] + [os.path.basename(v) for v in versions]))
+
+    def test_symlinked_output(self):
+        available = os.path.join(self.tmpdir, 'sites-available')
+        enabled = os.path.join(self.tmpdir, 'sites-enabled')
+        os.makedirs(available)
+        os.makedirs(enabled)
+        target = os.path.join(available, 'x.conf')
+        link = os.path.join(enabled, 'x.conf')
+        write_text('a;\n', target)
+        os.symlink(os.path.relpath(target, enabled), link)
+        write_text('b;\n', link, keep_versions=1)
+        self.assertTrue(os.path.islink(link))
+        with open(target) as f:
+            self.assertEqual(f.read(), 'b;\n')
+        self.assertEqual(os.listdir(enabled), ['x.conf'])
+        self.assertEqual(len(list_versions(target)), 1)
+
+    def test_watch(self):
+        for polling in (False, True):
+            workdir = tempfile.mkdtemp(dir=self.tmpdir)
+            input_path = os.path.join(workdir, 'input.yaml')
+            output = os.path.join(workdir, 'nginx.conf')
+            hook_log = os.path.join(workdir, 'hook.log')
+            shutil.copy(self.sample_input, input_path)
+            stop = threading.Event()
+            watcher = threading.Thread(target=watch, args=([(input_path, output)],),
+                                       kwargs={'debounce': 0.01, 'hook': 'echo run >> ' + hook_log,
+                                               'polling': polling, 'poll_interval': 0.01, 'stop': stop})
+            watcher.start()
+            self.addCleanup(watcher.join)
+            self.addCleanup(stop.set)
+            self.assertTrue(self.wait_for(lambda: os.path.exists(hook_log)))
+
+            with open(input_path) as f:
+                text = f.read()
+            # Editors save by writing a new file and renaming it over the old one
+            with open(input_path + '.swp', 'w') as f:
+                f.write(text.replace('8001', '8101'))
+            os.replace(input_path + '.swp', input_path)
+            self.assertTrue(self.wait_for(lambda: '127.0.0.1:8101' in open(output).read()))
+            self.assertTrue(self.wait_for(lambda: open(hook_log).read() == 'run\nrun\n'))
+            stop.set()
+
+    @staticmethod
+    def wait_for(condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
 
 if __name__ == '__main__':
     unittest.main()